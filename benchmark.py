@@ -0,0 +1,388 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+from fake_order_api import start_fake_order_api
+from storage import UserRecord
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of ``samples``, fraction between 0 and 1"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process in MB"""
+    # ru_maxrss survives exec on Linux, so a spawned worker would report its parent's peak
+    try:
+        with open("/proc/self/status", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API calls in process instead of sending them to Telegram.
+    
+    Every call is counted in ``calls`` by method name and answered after
+    ``latency`` seconds with a plausible result, so the handlers run
+    unchanged without network access.
+    """
+    
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+    
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+    
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.calls[endpoint] += 1
+        
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        if endpoint == "getMe":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", "")
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class UpdateFactory:
+    """Builds raw Telegram updates for simulated users"""
+    
+    def __init__(self):
+        self._ids = itertools.count(1)
+    
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+    
+    def message(self, user_id: int, text: str) -> Dict[str, Any]:
+        update_id = next(self._ids)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+    
+    def callback(self, user_id: int, data: str) -> Dict[str, Any]:
+        update_id = next(self._ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "📺 Ad Viewing"
+                }
+            }
+        }
+
+# One simulated session: (label, update builder). Labels name the handler
+# that does the work for that step.
+SCENARIO: List[Tuple[str, Callable[[UpdateFactory, int], Dict[str, Any]]]] = [
+    ("start_command", lambda updates, user_id: updates.message(user_id, "/start")),
+    ("handle_message", lambda updates, user_id: updates.message(user_id, "💳 Balance")),
+    ("handle_message", lambda updates, user_id: updates.message(user_id, "🪧 Watch Ads")),
+    ("handle_callback_query", lambda updates, user_id: updates.callback(user_id, f"watched_ad_{user_id}")),
+    ("handle_message", lambda updates, user_id: updates.message(user_id, "📦 Buy Views")),
+    ("handle_message", lambda updates, user_id: updates.message(user_id, f"https://example.com/video/{user_id}")),
+    ("process_order", lambda updates, user_id: updates.message(user_id, "1")),
+]
+
+async def run_handler_benchmark(users: int, api_latency: float, order_latency: float,
+                                broadcast: int = 0) -> Dict[str, Any]:
+    """Drive the bot's handlers with one SCENARIO session per simulated user.
+    
+    With ``broadcast`` a broadcast to that many more users runs alongside
+    the sessions, competing with their replies in the outbound queue.
+    Must run in a scratch directory: importing bot opens its storage files
+    in the working directory.
+    """
+    order_api, order_api_url = start_fake_order_api(latency=order_latency)
+    os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+    os.environ["ORDER_API_URL"] = order_api_url
+    
+    import bot
+    
+    bot_api = FakeBotAPI(api_latency)
+    application = bot.build_application(request=bot_api)
+    for user_id in range(1, users + 1):
+        bot.storage.create_user(user_id, f"user{user_id}", f"User {user_id}")
+        bot.storage.add_balance(user_id, 10, reason="benchmark")
+    for user_id in range(users + 1, users + broadcast + 1):
+        bot.storage.create_user(user_id, f"user{user_id}", f"User {user_id}")
+    
+    updates = UpdateFactory()
+    latencies: Dict[str, List[float]] = {label: [] for label, _ in SCENARIO}
+    
+    async def session(user_id: int):
+        for label, build in SCENARIO:
+            update = bot.Update.de_json(build(updates, user_id), application.bot)
+            started = time.perf_counter()
+            await application.update_processor.process_update(update, application.process_update(update))
+            latencies[label].append(time.perf_counter() - started)
+    
+    async with application:
+        await application.post_init(application)
+        # Runs the job queue, which sends the scheduled follow-ups
+        await application.start()
+        if broadcast:
+            bot.start_broadcast(application.bot, "Benchmark broadcast", bot.ADMIN_ID)
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(session(user_id) for user_id in range(1, users + 1)))
+        elapsed = time.perf_counter() - started
+        
+        # Let the dispatcher send the queued orders and the scheduler its follow-ups before shutting down
+        while bot.storage.get_queued_orders() or bot.scheduler.pending:
+            await asyncio.sleep(0.05)
+        drained = time.perf_counter() - started
+        
+        await application.stop()
+        await application.post_shutdown(application)
+    
+    order_api.shutdown()
+    return {
+        "users": users,
+        "broadcast": broadcast,
+        "updates": users * len(SCENARIO),
+        "elapsed": elapsed,
+        "drained": drained,
+        "latencies": latencies,
+        "orders_sent": len(order_api.orders),
+        "bot_api_calls": dict(bot_api.calls)
+    }
+
+def write_snapshot(filename: str, users: int, balance: int = 1000):
+    """Write a user_data.json snapshot with ``users`` synthetic users, one ledger entry each"""
+    now = datetime.now()
+    timestamp = int(now.timestamp())
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write('{"users":[')
+        for user_id in range(1, users + 1):
+            user = UserRecord(user_id, f"user{user_id}", f"User {user_id}", balance, user_id % 10, f"{user_id:08x}",
+                              join_date=timestamp, last_activity=timestamp)
+            file.write(("," if user_id > 1 else "") + json.dumps(user.to_row(), ensure_ascii=False))
+        
+        file.write('],"referrals":{},"orders":[],"ledger":[')
+        for user_id in range(1, users + 1):
+            entry = {"entry_id": user_id, "user_id": user_id, "amount": balance, "reason": "opening",
+                     "key": f"opening:{user_id}", "ref": None, "date": now.isoformat()}
+            file.write(("," if user_id > 1 else "") + json.dumps(entry))
+        file.write(']}')
+
+# Storage operations timed per call: (name, call(storage, random user_id, iteration))
+STORAGE_OPERATIONS: List[Tuple[str, Callable[[Any, int, int], Any]]] = [
+    ("get_user", lambda storage, user_id, i: storage.get_user(user_id)),
+    ("update_user_activity", lambda storage, user_id, i: storage.update_user_activity(user_id)),
+    ("add_ad_view", lambda storage, user_id, i: storage.add_ad_view(user_id, key=f"benchmark:{i}")),
+    ("add_balance", lambda storage, user_id, i: storage.add_balance(user_id, 1, reason="benchmark")),
+    ("reserve_order", lambda storage, user_id, i: storage.reserve_order(user_id, "https://example.com/video", 1)),
+    ("get_user_orders", lambda storage, user_id, i: storage.get_user_orders(user_id)),
+    ("get_ledger", lambda storage, user_id, i: storage.get_ledger(user_id)),
+    ("get_stats", lambda storage, user_id, i: storage.get_stats()),
+]
+
+def run_storage_benchmark(users: int, backend: str, ops: int, journal: bool, seed: int = 1) -> Dict[str, Any]:
+    """Time storage loading and each STORAGE_OPERATIONS call at the given number of users"""
+    from sqlite_storage import SQLiteUserDataStorage, migrate_json_to_sqlite
+    from storage import UserDataStorage
+    
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        json_filename = os.path.join(directory, "user_data.json")
+        db_filename = os.path.join(directory, "user_data.db")
+        write_snapshot(json_filename, users)
+        
+        started = time.perf_counter()
+        if backend == "sqlite":
+            migrate_json_to_sqlite(json_filename, db_filename)
+            storage = SQLiteUserDataStorage(db_filename, activity_flush_interval=0)
+            data_filename = db_filename
+        elif backend == "binary":
+            data_filename = os.path.join(directory, "user_data.snap")
+            UserDataStorage(json_filename, activity_flush_interval=0).export(data_filename)
+            started = time.perf_counter()
+            storage = UserDataStorage(data_filename, journal=journal, activity_flush_interval=0, binary=True)
+        else:
+            storage = UserDataStorage(json_filename, journal=journal, activity_flush_interval=0)
+            data_filename = json_filename
+        load = time.perf_counter() - started
+        
+        timings: Dict[str, List[float]] = {}
+        for name, operation in STORAGE_OPERATIONS:
+            samples = timings[name] = []
+            for i in range(ops):
+                user_id = rng.randint(1, users)
+                started = time.perf_counter()
+                operation(storage, user_id, i)
+                samples.append(time.perf_counter() - started)
+        
+        samples = timings["create_user"] = []
+        for user_id in range(users + 1, users + ops + 1):
+            started = time.perf_counter()
+            storage.create_user(user_id, f"user{user_id}", f"User {user_id}")
+            samples.append(time.perf_counter() - started)
+        
+        for name, operation in (("flush_activity", storage.flush_activity), ("compact", storage.compact)):
+            started = time.perf_counter()
+            operation()
+            timings[name] = [time.perf_counter() - started]
+        
+        size = os.path.getsize(data_filename)
+        storage.close()
+    
+    return {"users": users, "backend": backend, "load": load, "size": size, "timings": timings,
+            "peak_rss_mb": peak_rss_mb()}
+
+def measure_startup(filename: str, binary: bool, users: int, lookups: int, seed: int = 1) -> Dict[str, Any]:
+    """Open a snapshot and look up users, meant to run in a fresh process so memory is not shared"""
+    from storage import UserDataStorage
+    
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    storage = UserDataStorage(filename, activity_flush_interval=0, binary=binary)
+    load = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    storage.get_user(rng.randint(1, users))
+    first = time.perf_counter() - started
+    
+    samples = []
+    for _ in range(lookups):
+        user_id = rng.randint(1, users)
+        started = time.perf_counter()
+        storage.get_user(user_id)
+        samples.append(time.perf_counter() - started)
+    
+    return {"load": load, "first_lookup": first, "lookups": samples, "peak_rss_mb": peak_rss_mb()}
+
+def run_startup_benchmark(users: int, lookups: int) -> Dict[str, Any]:
+    """Compare opening a JSON snapshot with opening the equivalent binary snapshot"""
+    from storage import UserDataStorage
+    
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        json_filename = os.path.join(directory, "user_data.json")
+        binary_filename = os.path.join(directory, "user_data.snap")
+        write_snapshot(json_filename, users)
+        UserDataStorage(json_filename, activity_flush_interval=0).export(binary_filename)
+        
+        results = {"users": users, "sizes": {"json": os.path.getsize(json_filename),
+                                             "binary": os.path.getsize(binary_filename)}}
+        for label, filename, binary in (("json", json_filename, False), ("binary", binary_filename, True)):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results[label] = pool.submit(measure_startup, filename, binary, users, lookups).result()
+    return results
+
+def print_handler_report(result: Dict[str, Any]):
+    print(f"🤖 Handlers: {result['users']} users, {result['updates']} updates in {result['elapsed']:.2f}s "
+          f"→ {result['updates'] / result['elapsed']:.0f} updates/s"
+          + (f", broadcasting to {result['broadcast']} users meanwhile" if result["broadcast"] else ""))
+    for label, samples in result["latencies"].items():
+        print(f"  {label:<24} p50 {percentile(samples, 0.5) * 1000:9.2f} ms   "
+              f"p99 {percentile(samples, 0.99) * 1000:9.2f} ms   n={len(samples)}")
+    print(f"  📦 {result['orders_sent']} orders sent, queue drained after {result['drained']:.2f}s")
+    print(f"  📡 Bot API calls: {result['bot_api_calls']}")
+
+def print_startup_report(result: Dict[str, Any]):
+    print(f"🚀 Startup: {result['users']} users")
+    for label in ("json", "binary"):
+        measured = result[label]
+        lookups = measured["lookups"]
+        print(f"  {label:<8} load {measured['load'] * 1000:10.1f} ms   "
+              f"first get_user {measured['first_lookup'] * 1e6:8.1f} µs   "
+              f"get_user p99 {percentile(lookups, 0.99) * 1e6:8.1f} µs   "
+              f"{result['sizes'][label] / 1e6:7.1f} MB on disk   peak RSS {measured['peak_rss_mb']:6.0f} MB")
+    print(f"  ⚡ binary loads {result['json']['load'] / result['binary']['load']:.0f}x faster")
+
+def print_storage_report(result: Dict[str, Any]):
+    print(f"💾 Storage ({result['backend']}): {result['users']} users, loaded in {result['load']:.2f}s, "
+          f"{result['size'] / 1e6:.1f} MB on disk, peak RSS {result['peak_rss_mb']:.0f} MB")
+    for name, samples in result["timings"].items():
+        print(f"  {name:<24} mean {sum(samples) / len(samples) * 1e6:10.1f} µs   "
+              f"p99 {percentile(samples, 0.99) * 1e6:10.1f} µs   max {max(samples) * 1e6:10.1f} µs")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the bot's handlers and storage")
+    subparsers = parser.add_subparsers(dest="suite", required=True)
+    
+    handlers = subparsers.add_parser("handlers", help="simulate users talking to the bot")
+    handlers.add_argument("--users", type=int, default=1000)
+    handlers.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    handlers.add_argument("--api-latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    handlers.add_argument("--order-latency", type=float, default=0.0, help="seconds per fake order API call")
+    handlers.add_argument("--outbound-rate", type=float, default=10000, help="Bot API requests per second")
+    handlers.add_argument("--broadcast", type=int, default=0, help="users of a broadcast run during the sessions")
+    
+    storage_parser = subparsers.add_parser("storage", help="time storage operations at several sizes")
+    storage_parser.add_argument("--users", default="1000,100000,1000000", help="comma separated user counts")
+    storage_parser.add_argument("--backend", choices=("json", "binary", "sqlite"), default="json")
+    storage_parser.add_argument("--ops", type=int, default=1000, help="calls timed per operation")
+    storage_parser.add_argument("--no-journal", action="store_true", help="rewrite the JSON file on every change")
+    
+    startup = subparsers.add_parser("startup", help="compare JSON and binary snapshot load time")
+    startup.add_argument("--users", default="1000,100000,1000000", help="comma separated user counts")
+    startup.add_argument("--lookups", type=int, default=1000, help="get_user calls timed after loading")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.WARNING)
+    
+    if args.suite == "handlers":
+        os.environ["STORAGE_BACKEND"] = args.backend
+        os.environ.setdefault("ACTIVITY_FLUSH_INTERVAL", "0")
+        os.environ["OUTBOUND_RATE"] = str(args.outbound_rate)
+        with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+            os.chdir(directory)
+            print_handler_report(asyncio.run(run_handler_benchmark(args.users, args.api_latency, args.order_latency,
+                                                                   args.broadcast)))
+    elif args.suite == "startup":
+        for users in (int(count) for count in args.users.split(",")):
+            print_startup_report(run_startup_benchmark(users, args.lookups))
+    else:
+        for users in (int(count) for count in args.users.split(",")):
+            print_storage_report(run_storage_benchmark(users, args.backend, args.ops, not args.no_journal))
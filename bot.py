@@ -1,24 +1,147 @@
+import asyncio
+import io
 import os
-import requests
 import logging
+import functools
+import tempfile
 import threading
+import time
 from datetime import datetime
-from flask import Flask, jsonify
+from typing import Any, List, Optional
+from flask import Flask, Response, abort, jsonify, request
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
-from storage import UserDataStorage
+from telegram.request import BaseRequest
+from storage import UserDataStorage, refund_amount
+from sqlite_storage import SQLiteUserDataStorage
+from order_client import OrderAPIClient
+from order_queue import OrderDispatcher, OrderReconciler
+from broadcast import BroadcastEngine
+from outbound import BULK, CALLBACK, OutboundQueue, send_priority
+from webhook import create_asgi_app
+from state_store import StateStore
+from update_processor import PerUserUpdateProcessor
+from scheduler import Scheduler
+from profiler import SamplingProfiler
+from sharding import ShardClient, ShardError, referral_code_suffix, shard_of, shard_of_referral_code, shard_path
+import exports
+import metrics
+import slowlog
 
 # Configuration
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable is required")
-    
+
 ADMIN_ID = int(os.environ.get('ADMIN_ID', '7981712298'))
-ORDER_API_URL = "https://testuser2.onrender.com/order"
+ORDER_API_URL = os.environ.get('ORDER_API_URL', "https://testuser2.onrender.com/order")
+ORDER_API_MAX_CONNECTIONS = int(os.environ.get('ORDER_API_MAX_CONNECTIONS', '20'))
+ORDER_API_CONCURRENCY = int(os.environ.get('ORDER_API_CONCURRENCY', '10'))
+ORDER_API_TIMEOUT = float(os.environ.get('ORDER_API_TIMEOUT', '30'))
+ORDER_WORKERS = int(os.environ.get('ORDER_WORKERS', '4'))
+ORDER_BATCH_SIZE = int(os.environ.get('ORDER_BATCH_SIZE', '10'))
+ORDER_MAX_ATTEMPTS = int(os.environ.get('ORDER_MAX_ATTEMPTS', '5'))
+ORDER_STATUS_URL = os.environ.get('ORDER_STATUS_URL')  # enables checking dispatched orders for delivery
+ORDER_RECONCILE_INTERVAL = float(os.environ.get('ORDER_RECONCILE_INTERVAL', '300'))
+ORDER_RECONCILE_BATCH_SIZE = int(os.environ.get('ORDER_RECONCILE_BATCH_SIZE', '50'))  # orders per status request
+ORDER_RECONCILE_CONCURRENCY = int(os.environ.get('ORDER_RECONCILE_CONCURRENCY', '4'))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '20'))
+OUTBOUND_RATE = float(os.environ.get('OUTBOUND_RATE', '30'))  # Bot API requests per second, all replies included
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # e.g. https://example.com, enables webhook mode
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+STATE_TTL = float(os.environ.get('STATE_TTL', '3600'))
+STATE_MAX_ENTRIES = int(os.environ.get('STATE_MAX_ENTRIES', '100000'))
+STATE_PERSIST = os.environ.get('STATE_PERSIST', '1') == '1'
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '256'))
+MAX_WAITING_UPDATES_PER_USER = int(os.environ.get('MAX_WAITING_UPDATES_PER_USER', '10'))
+ORDERS_PAGE_SIZE = 20
+PROFILE_MAX_SECONDS = 120
+PROFILE_TOP_FUNCTIONS = 15
+SLOWLOG_SHOWN = 10
+USERS_PAGE_SIZE = 10
+# /admin users sort option -> (storage sort field, label)
+USER_SORTS = {
+    "balance": ("balance", "💰 Balance"),
+    "referrals": ("referrals_count", "🔗 Referrals"),
+    "ads": ("ads_watched", "📺 Ads"),
+    "joined": ("join_date", "🆕 Joined"),
+}
+EXPORT_TOKEN = os.environ.get('EXPORT_TOKEN')  # enables GET /export/<users|orders|referrals>.<csv|ndjson>
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
 ADS_SCRIPT = "https://libtl.com/sdk.js?zone=9870348&sdk=show_9870348"
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')  # "json" or "sqlite"
+STORAGE_JOURNAL = os.environ.get('STORAGE_JOURNAL', '1') == '1'
+STORAGE_SNAPSHOT = os.environ.get('STORAGE_SNAPSHOT', 'json')  # "json" or "binary", for the json backend
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', 'user_data.snap')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'user_data.db')
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', '60'))
+COMPACT_INTERVAL = float(os.environ.get('COMPACT_INTERVAL', '300'))  # seconds between storage snapshots
+STATE_EXPIRE_INTERVAL = float(os.environ.get('STATE_EXPIRE_INTERVAL', '300'))
+STATS_ROLLUP_INTERVAL = float(os.environ.get('STATS_ROLLUP_INTERVAL', '60'))
+MENU_FOLLOWUP_DELAY = 1.0  # seconds before the main menu is offered again after an ad
+SHARDS = int(os.environ.get('SHARDS', '1'))  # worker processes started by `python sharding.py run`
+SHARD = int(os.environ.get('SHARD', '0'))  # shard served by this process, set by sharding.run_worker
+JSON_PATH = shard_path('user_data.json', SHARD, SHARDS)
+REFERRAL_CODE_SUFFIX = referral_code_suffix(SHARD, SHARDS)
+REFERRAL_RETRY_INTERVAL = 60.0  # seconds between retries of referral credits another shard did not get
+# Storage state table of referral credits sent to another shard, by referred user ID, until that shard confirmed
+REFERRAL_OUTBOX = "referral_outbox"
+REFERRAL_OUTBOX_TTL = 30 * 86400
 
 # Initialize storage
-storage = UserDataStorage()
+# Each shard keeps its own files: user_data.json becomes user_data.shard<n>.json
+# Activity flushes and periodic snapshots run as scheduled jobs (see schedule_maintenance)
+if STORAGE_BACKEND == 'sqlite':
+    storage = SQLiteUserDataStorage(shard_path(SQLITE_PATH, SHARD, SHARDS), activity_flush_interval=0,
+                                    referral_code_suffix=REFERRAL_CODE_SUFFIX)
+elif STORAGE_SNAPSHOT == 'binary':
+    snapshot_path = shard_path(SNAPSHOT_PATH, SHARD, SHARDS)
+    # First start on the binary format: import the JSON data once
+    if not os.path.exists(snapshot_path) and os.path.exists(JSON_PATH):
+        json_storage = UserDataStorage(JSON_PATH, journal=os.path.exists(JSON_PATH + '.journal'),
+                                       activity_flush_interval=0)
+        json_storage.export(snapshot_path)
+        json_storage.close()
+    storage = UserDataStorage(snapshot_path, journal=STORAGE_JOURNAL, compact_interval=0, activity_flush_interval=0,
+                              binary=True, referral_code_suffix=REFERRAL_CODE_SUFFIX)
+else:
+    storage = UserDataStorage(JSON_PATH, journal=STORAGE_JOURNAL, compact_interval=0, activity_flush_interval=0,
+                              referral_code_suffix=REFERRAL_CODE_SUFFIX)
+metrics.instrument_storage(storage)
+
+# Shared HTTP client for the order API, opened in post_init and closed in post_shutdown
+order_client = OrderAPIClient(
+    ORDER_API_URL,
+    max_connections=ORDER_API_MAX_CONNECTIONS,
+    max_concurrency=ORDER_API_CONCURRENCY,
+    timeout=ORDER_API_TIMEOUT,
+    status_url=ORDER_STATUS_URL
+)
+
+# Background workers that send queued orders to the order API
+order_dispatcher = OrderDispatcher(
+    storage,
+    order_client,
+    workers=ORDER_WORKERS,
+    batch_size=ORDER_BATCH_SIZE,
+    max_attempts=ORDER_MAX_ATTEMPTS
+)
+
+# Periodic check of dispatched orders against the order API, see schedule_maintenance
+order_reconciler = OrderReconciler(
+    storage,
+    order_client,
+    batch_size=ORDER_RECONCILE_BATCH_SIZE,
+    concurrency=ORDER_RECONCILE_CONCURRENCY
+)
+
+# Rate-aware broadcast sender, resumes an interrupted broadcast on startup.
+# Every shard broadcasts to its own users, sharing the bot's rate limit.
+broadcast_engine = BroadcastEngine(storage, state_filename=shard_path("broadcast_state.json", SHARD, SHARDS),
+                                   concurrency=BROADCAST_CONCURRENCY)
+
+# Connection to the other shards in a worker process, None when running as a single process
+shard_client: Optional[ShardClient] = None
 
 # Main menu keyboard
 MAIN_KEYBOARD = ReplyKeyboardMarkup([
@@ -27,14 +150,23 @@ MAIN_KEYBOARD = ReplyKeyboardMarkup([
     ["📞 Contact Admin"]
 ], resize_keyboard=True)
 
-# User states for conversation flow
-user_states = {}
+# User states for conversation flow (expire after STATE_TTL seconds of inactivity)
+state_backend = storage if STATE_PERSIST else None
+user_states = StateStore("user_states", STATE_TTL, STATE_MAX_ENTRIES, state_backend)
+order_drafts = StateStore("order_drafts", STATE_TTL, STATE_MAX_ENTRIES, state_backend)  # video link being ordered
 WAITING_FOR_VIDEO_LINK = "waiting_for_video_link"
 WAITING_FOR_QUANTITY = "waiting_for_quantity"
 WAITING_FOR_BROADCAST = "waiting_for_broadcast"
 
-# Rate limiting for ads (simple in-memory tracking)
-user_last_ad_time = {}
+# Rate limiting for ads, entries expire with the cooldown
+AD_COOLDOWN = 30
+user_last_ad_time = StateStore("user_last_ad_time", AD_COOLDOWN, STATE_MAX_ENTRIES, state_backend)
+
+# Samples the event loop for /admin profile
+sampling_profiler = SamplingProfiler()
+
+# Deferred follow-ups and periodic maintenance, on the application's job queue
+scheduler = Scheduler(state_backend)
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
@@ -51,7 +183,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Process referral if applicable
     if is_new_user and referral_code:
-        if storage.process_referral(user_id, referral_code):
+        if await process_referral(user_id, referral_code):
             await update.message.reply_text(
                 "🎉 Welcome! You've been referred by another user. Both of you received rewards!",
                 reply_markup=MAIN_KEYBOARD
@@ -69,6 +201,68 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     storage.update_user_activity(user_id)
 
+async def process_referral(user_id: int, referral_code: str) -> bool:
+    """Credit a referral, on the shard that created the referral code when running sharded"""
+    if shard_client is None:
+        return storage.process_referral(user_id, referral_code)
+    
+    try:
+        shard = shard_of_referral_code(referral_code, SHARDS)
+        if shard is None:
+            # Codes from before sharding were unique in the store split_storage divided, at most one shard has it
+            owners = [(shard, referrer_id) for shard, referrer_id in
+                      enumerate(await shard_client.gather("find_referrer", referral_code)) if referrer_id is not None]
+            if not owners:
+                return False
+            shard, referrer_id = owners[0]
+        elif shard != SHARD:
+            referrer_id = await shard_client.request(shard, "find_referrer", referral_code)
+    except (ValueError, ShardError) as e:
+        # The user still gets the plain welcome
+        logging.warning(f"Referral code {referral_code!r} of user {user_id} not processed: {e}")
+        return False
+    if shard == SHARD:
+        return storage.process_referral(user_id, referral_code)
+    
+    user = storage.get_user(user_id)
+    if referrer_id is None or referrer_id == user_id or user is None or user["referred_by"] is not None:
+        return False
+    # Kept until the other shard confirmed the credit, so a failed request is retried by replay_referral_credits
+    storage.save_state(REFERRAL_OUTBOX, str(user_id), {"shard": shard, "referrer_id": referrer_id},
+                       time.time() + REFERRAL_OUTBOX_TTL)
+    if not storage.claim_referral(user_id, referrer_id):
+        storage.delete_states(REFERRAL_OUTBOX, [str(user_id)])
+        return False
+    
+    await send_referral_credit(user_id, shard, referrer_id)
+    return True
+
+async def send_referral_credit(user_id: int, shard: int, referrer_id: int) -> bool:
+    """Credit the referrer on its shard and clear the outbox entry, False if the shard could not be reached"""
+    try:
+        # Credited once per referred user, so sending it again is harmless
+        credited = await shard_client.request(shard, "credit_referral", referrer_id, user_id)
+    except ShardError as e:
+        logging.warning(f"Crediting referrer {referrer_id} for user {user_id} failed, will retry: {e}")
+        return False
+    
+    if not credited:
+        logging.warning(f"Referrer {referrer_id} was already credited for user {user_id}")
+    storage.delete_states(REFERRAL_OUTBOX, [str(user_id)])
+    return True
+
+async def replay_referral_credits_job(context: ContextTypes.DEFAULT_TYPE):
+    """Send again the referral credits another shard did not confirm, such as those pending at a restart"""
+    if shard_client is None:
+        return
+    for key, (entry, _) in storage.load_states(REFERRAL_OUTBOX).items():
+        user = storage.get_user(int(key))
+        if user is None or user["referred_by"] != entry["referrer_id"]:
+            # Recorded but never claimed
+            storage.delete_states(REFERRAL_OUTBOX, [key])
+            continue
+        await send_referral_credit(int(key), entry["shard"], entry["referrer_id"])
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle all text messages"""
     user_id = update.effective_user.id
@@ -258,7 +452,7 @@ async def handle_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if state == WAITING_FOR_VIDEO_LINK:
         # Store video link and ask for quantity
-        context.user_data['video_link'] = message_text
+        order_drafts[user_id] = message_text
         user_states[user_id] = WAITING_FOR_QUANTITY
         
         user_data = storage.get_user(user_id)
@@ -295,9 +489,9 @@ async def handle_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             
             # Process the order
-            video_link = context.user_data.get('video_link', '')
+            video_link = order_drafts.pop(user_id, '')
             await process_order(update, context, user_id, video_link, quantity)
-            
+        
         except ValueError:
             await update.message.reply_text("❌ Please enter a valid number.")
     
@@ -307,60 +501,90 @@ async def handle_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_states.pop(user_id, None)
 
 async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, video_link: str, quantity: int):
-    """Process order through API"""
+    """Reserve balance and queue the order for background dispatch"""
     try:
-        import urllib.parse
+        # A redelivered update reuses the key, so the balance is only held once
+        key = f"order:{update.effective_chat.id}:{update.message.message_id}"
+        order_id = storage.reserve_order(user_id, video_link, quantity, key=key)
         
-        # URL encode parameters properly
-        encoded_video = urllib.parse.quote(video_link, safe='')
-        api_url = f"{ORDER_API_URL}?video={encoded_video}&qty={quantity}"
-        response = requests.get(api_url, timeout=30)
-        
-        if response.status_code == 200:
-            # Deduct balance
-            if storage.subtract_balance(user_id, quantity):
-                # Create order record
-                order_id = storage.create_order(user_id, video_link, quantity, quantity)
-                
-                message = f"✅ **Order Confirmed!**\n\n"
-                message += f"🆔 Order ID: `{order_id}`\n"
-                message += f"🔗 Video: {video_link}\n"
-                message += f"📦 Quantity: {quantity} views\n"
-                message += f"💰 Cost: {quantity} balance points\n\n"
-                message += f"🚀 Your order is being processed!\n"
-                message += f"📊 Views will be delivered within 24 hours.\n\n"
-                
-                user_data = storage.get_user(user_id)
-                remaining_balance = user_data.get("balance", 0)
-                message += f"💳 Remaining balance: {remaining_balance} views"
-                
-                await update.message.reply_text(
-                    message,
-                    parse_mode='Markdown',
-                    reply_markup=MAIN_KEYBOARD
-                )
-            else:
-                await update.message.reply_text(
-                    "❌ Failed to process payment. Please try again.",
-                    reply_markup=MAIN_KEYBOARD
-                )
+        if order_id:
+            # The order is only sent once the balance hold is on disk
+            await asyncio.wrap_future(storage.sync())
+            order = storage.get_order(order_id)
+            if order["status"] == "pending":
+                order_dispatcher.enqueue(order)
+            
+            message = f"✅ **Order Placed!**\n\n"
+            message += f"🆔 Order ID: `{order_id}`\n"
+            message += f"🔗 Video: {video_link}\n"
+            message += f"📦 Quantity: {quantity} views\n"
+            message += f"💰 Cost: {quantity} balance points\n\n"
+            message += f"🚀 Your order is queued and will be sent shortly!\n"
+            message += f"📊 You'll get a message once it's submitted.\n\n"
+            
+            user_data = storage.get_user(user_id)
+            remaining_balance = user_data.get("balance", 0)
+            message += f"💳 Remaining balance: {remaining_balance} views"
+            
+            await update.message.reply_text(
+                message,
+                parse_mode='Markdown',
+                reply_markup=MAIN_KEYBOARD
+            )
         else:
             await update.message.reply_text(
-                f"❌ Order failed. API returned status: {response.status_code}\n"
-                f"Please contact admin if this persists.",
+                "❌ Failed to process payment. Please try again.",
                 reply_markup=MAIN_KEYBOARD
             )
     
-    except requests.RequestException as e:
-        await update.message.reply_text(
-            "❌ Network error while processing order.\n"
-            "Please try again later or contact admin.",
-            reply_markup=MAIN_KEYBOARD
-        )
-    
     finally:
         user_states.pop(user_id, None)
 
+async def notify_order_result(bot, order: dict, status: str):
+    """Tell the user how their queued order ended up"""
+    if status == "submitted":
+        text = (
+            f"✅ **Order Confirmed!**\n\n"
+            f"🆔 Order ID: `{order['order_id']}`\n"
+            f"📦 Quantity: {order['quantity']} views\n\n"
+            f"📊 Views will be delivered within 24 hours."
+        )
+    elif status == "completed":
+        text = (
+            f"🎉 **Order Completed!**\n\n"
+            f"🆔 Order ID: `{order['order_id']}`\n"
+            f"📦 {order['quantity']} views were delivered."
+        )
+    elif status == "partial":
+        text = (
+            f"⚠️ **Order Partially Delivered**\n\n"
+            f"🆔 Order ID: `{order['order_id']}`\n"
+            f"📦 {order['quantity'] - order['remains']} of {order['quantity']} views were delivered.\n"
+            f"💰 {refund_amount(order, status, order['remains'])} views were refunded to your balance."
+        )
+    elif status == "canceled":
+        text = (
+            f"🚫 **Order Canceled**\n\n"
+            f"🆔 Order ID: `{order['order_id']}`\n"
+            f"The order was canceled by the provider and no views were delivered.\n"
+            f"💰 {refund_amount(order, status)} views were refunded to your balance."
+        )
+    else:
+        text = (
+            f"❌ **Order Failed**\n\n"
+            f"🆔 Order ID: `{order['order_id']}`\n"
+            f"💰 {order['total_cost']} views were refunded to your balance.\n"
+            f"Please contact admin if this persists."
+        )
+    
+    with send_priority(CALLBACK):
+        await bot.send_message(
+            chat_id=order["user_id"],
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=MAIN_KEYBOARD
+        )
+
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin commands"""
     user_id = update.effective_user.id
@@ -374,7 +598,13 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message += f"📊 **Available Commands:**\n"
         message += f"• `/admin stats` - Show bot statistics\n"
         message += f"• `/admin broadcast` - Broadcast message to all users\n"
-        message += f"• `/admin users` - Show user count\n"
+        message += f"• `/admin users [balance|referrals|ads|joined]` - Browse users, sorted\n"
+        message += f"• `/admin ledger <user_id>` - Show a user's balance history\n"
+        message += f"• `/admin reconcile` - Check balances against the ledger\n"
+        message += f"• `/admin orders <user_id> [before_order_id]` - Show a user's orders, newest first\n"
+        message += f"• `/admin export <users|orders|referrals> [csv|ndjson]` - Export as a gzipped document\n"
+        message += f"• `/admin profile <seconds>` - Profile the event loop, with a flamegraph file\n"
+        message += f"• `/admin slowlog` - Show the slowest recent updates and where their time went\n"
         
         await update.message.reply_text(message, parse_mode='Markdown')
         return
@@ -382,11 +612,15 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     command = context.args[0].lower()
     
     if command == "stats":
-        stats = storage.get_stats()
+        stats = await get_stats()
         message = f"📊 **Bot Statistics**\n\n"
         message += f"👥 Total users: {stats['total_users']}\n"
         message += f"📦 Total orders: {stats['total_orders']}\n"
         message += f"🔗 Total referrals: {stats['total_referrals']}\n"
+        message += f"💰 Balance outstanding: {stats['total_balance']} views\n"
+        message += f"📺 Ads watched: {stats['total_ads_watched']}\n"
+        message += f"🟢 Active today: {stats['active_users_today']}\n"
+        message += f"📅 Active this week: {stats['active_users_week']}\n"
         
         await update.message.reply_text(message, parse_mode='Markdown')
     
@@ -399,49 +633,235 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif command == "users":
-        all_users = storage.get_all_users()
-        message = f"👥 **User List**\n\n"
-        message += f"Total users: {len(all_users)}\n\n"
+        sort = context.args[1].lower() if len(context.args) > 1 else "balance"
+        if sort not in USER_SORTS:
+            await update.message.reply_text("Usage: /admin users [balance|referrals|ads|joined]")
+            return
         
-        for user_id_str, user_data in list(all_users.items())[:10]:  # Show first 10
-            username = user_data.get('username', 'No username')
-            balance = user_data.get('balance', 0)
-            message += f"• @{username} (ID: {user_id_str}) - {balance} views\n"
+        message, keyboard = render_users_page(sort)
+        await update.message.reply_text(message, reply_markup=keyboard)
+    
+    elif command == "ledger":
+        if len(context.args) < 2 or not context.args[1].isdigit():
+            await update.message.reply_text("Usage: /admin ledger <user_id>")
+            return
         
-        if len(all_users) > 10:
-            message += f"\n... and {len(all_users) - 10} more users"
+        target_id = int(context.args[1])
+        user_data = await call_user_shard(target_id, "get_user", target_id)
+        if not user_data:
+            await update.message.reply_text("❌ User not found.")
+            return
         
-        await update.message.reply_text(message, parse_mode='Markdown')
+        message = f"📒 **Ledger for {target_id}**\n\n"
+        message += f"💰 Balance: {user_data['balance']} views\n\n"
+        for entry in await call_user_shard(target_id, "get_ledger", target_id, 20):
+            message += f"• #{entry['entry_id']} {entry['date'][:16]} {entry['amount']:+d} ({entry['reason']})\n"
+        
+        await update.message.reply_text(message)
+    
+    elif command == "orders":
+        if len(context.args) < 2 or not context.args[1].isdigit():
+            await update.message.reply_text("Usage: /admin orders <user_id> [before_order_id]")
+            return
+        
+        target_id = int(context.args[1])
+        before = context.args[2] if len(context.args) > 2 else None
+        orders = await call_user_shard(target_id, "get_user_orders", target_id, ORDERS_PAGE_SIZE, before)
+        if not orders:
+            await update.message.reply_text("📭 No orders found.")
+            return
+        
+        message = f"📦 Orders for {target_id}\n\n"
+        for order in orders:
+            message += (f"• {order['order_id']} {order['created_at'][:16]} {order['quantity']} views "
+                        f"({order['status']})\n")
+        if len(orders) == ORDERS_PAGE_SIZE:
+            message += f"\nOlder: /admin orders {target_id} {orders[-1]['order_id']}"
+        
+        await update.message.reply_text(message)
+    
+    elif command == "export":
+        name = context.args[1].lower() if len(context.args) > 1 else ""
+        fmt = context.args[2].lower() if len(context.args) > 2 else "csv"
+        if name not in exports.EXPORTS or fmt not in exports.FORMATS:
+            await update.message.reply_text("Usage: /admin export <users|orders|referrals> [csv|ndjson]")
+            return
+        
+        await update.message.reply_text("⏳ Preparing export...")
+        filename = exports.export_filename(name, fmt) + ".gz"
+        with tempfile.TemporaryDirectory(prefix="export-") as directory:
+            path = os.path.join(directory, filename)
+            # Rows are streamed to disk on a worker thread so the event loop keeps serving updates
+            size = await asyncio.to_thread(exports.write_export, storage, name, fmt, path)
+            if size > TELEGRAM_DOCUMENT_LIMIT:
+                await update.message.reply_text(
+                    f"❌ The export is {size / 1e6:.0f} MB, over Telegram's document limit. "
+                    f"Download it from /export/{name}.{fmt} instead."
+                )
+                return
+            
+            with open(path, 'rb') as file:
+                await update.message.reply_document(file, filename=filename)
+    
+    elif command == "profile":
+        if (len(context.args) < 2 or not context.args[1].isdigit()
+                or not 1 <= int(context.args[1]) <= PROFILE_MAX_SECONDS):
+            await update.message.reply_text(f"Usage: /admin profile <seconds, 1-{PROFILE_MAX_SECONDS}>")
+            return
+        if sampling_profiler.running:
+            await update.message.reply_text("⏳ A profile is already running.")
+            return
+        
+        seconds = int(context.args[1])
+        profile = sampling_profiler.start(seconds)
+        await update.message.reply_text(f"🔬 Profiling the event loop for {seconds}s...")
+        # Sent from the background, so the admin's next updates are not held up meanwhile
+        context.application.create_task(send_profile(context.bot, update.effective_chat.id, profile), update=update)
+    
+    elif command == "slowlog":
+        traces = slowlog.SLOWLOG.slowest(SLOWLOG_SHOWN)
+        if not traces:
+            await update.message.reply_text("📭 No updates handled yet.")
+            return
+        
+        now = time.time()
+        message = f"🐢 Slowest of the last {len(slowlog.SLOWLOG)} updates (ms)\n\n"
+        for trace in traces:
+            phases = " · ".join(f"{phase} {trace.phases.get(phase, 0) * 1000:.1f}" for phase in slowlog.PHASES)
+            message += (f"• {trace.duration * 1000:.0f} {trace.handler}, user {trace.user_id}, "
+                        f"{now - trace.finished_at:.0f}s ago\n"
+                        f"  {phases} · other {trace.other * 1000:.1f}\n")
+        
+        await update.message.reply_text(message)
+    
+    elif command == "reconcile":
+        mismatches = await reconcile_balances()
+        if not mismatches:
+            await update.message.reply_text("✅ All balances match the ledger.")
+            return
+        
+        message = f"⚠️ {len(mismatches)} balances differ from the ledger:\n\n"
+        for target_id, (cached, total) in list(mismatches.items())[:20]:
+            message += f"• {target_id}: cached {cached}, ledger {total}\n"
+        
+        await update.message.reply_text(message)
 
-async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    """Broadcast message to all users"""
-    all_users = storage.get_all_users()
-    success_count = 0
-    fail_count = 0
+async def send_profile(bot, chat_id: int, profile_future: asyncio.Future):
+    """Once a profile is done, send its hottest functions and collapsed stacks"""
+    profile = await profile_future
+    busy = max(profile.busy, 1)
+    message = (f"🔬 Profile of {profile.seconds:.0f}s: {profile.samples} samples, "
+               f"event loop busy in {profile.busy / max(profile.samples, 1):.0%}\n\n"
+               f"% of busy samples in the function and its callees / in the function itself\n")
+    for name, total, own in profile.top(PROFILE_TOP_FUNCTIONS):
+        message += f"{total / busy:6.1%} {own / busy:6.1%}  {name}\n"
+    await bot.send_message(chat_id, message)
     
-    await update.message.reply_text(
-        f"📢 Broadcasting message to {len(all_users)} users..."
-    )
+    filename = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+    await bot.send_document(chat_id, io.BytesIO(profile.collapsed().encode()), filename=filename,
+                            caption="Collapsed stacks, open in speedscope.app or render with flamegraph.pl")
+
+async def get_stats() -> dict:
+    """Storage statistics, summed over every shard when running sharded"""
+    if shard_client is None:
+        return storage.get_stats()
     
-    for user_id_str, user_data in all_users.items():
-        try:
-            await context.bot.send_message(
-                chat_id=int(user_id_str),
-                text=f"📢 **Message from Admin:**\n\n{message_text}",
-                parse_mode='Markdown'
-            )
-            success_count += 1
-        except Exception as e:
-            fail_count += 1
-            logging.error(f"Failed to send message to {user_id_str}: {e}")
+    shard_stats = await shard_client.gather("get_stats")
+    return {key: sum(stats[key] for stats in shard_stats) for key in shard_stats[0]}
+
+async def reconcile_balances() -> dict:
+    """Balances differing from the ledger on any shard, {user_id: (cached, ledger)}"""
+    if shard_client is None:
+        return storage.reconcile_balances()
     
-    await update.message.reply_text(
-        f"✅ **Broadcast Complete**\n\n"
-        f"📤 Sent successfully: {success_count}\n"
-        f"❌ Failed: {fail_count}",
-        parse_mode='Markdown',
-        reply_markup=MAIN_KEYBOARD
+    return {user_id: tuple(balances) for mismatches in await shard_client.gather("reconcile_balances")
+            for user_id, balances in mismatches}
+
+async def call_user_shard(user_id: int, method: str, *args: Any) -> Any:
+    """Call a storage method on the shard owning ``user_id``"""
+    if shard_client is None or shard_of(user_id, SHARDS) == SHARD:
+        return getattr(storage, method)(*args)
+    return await shard_client.request(shard_of(user_id, SHARDS), method, *args)
+
+# Storage methods other shards may call through handle_shard_request
+SHARD_STORAGE_METHODS = ("find_referrer", "credit_referral", "get_stats", "get_user", "get_ledger", "get_user_orders")
+
+async def handle_shard_request(application: Application, method: str, args: List[Any]) -> Any:
+    """Serve a request from another shard (see sharding.py), the result is sent back as JSON"""
+    if method in SHARD_STORAGE_METHODS:
+        return getattr(storage, method)(*args)
+    if method == "reconcile_balances":
+        return list(storage.reconcile_balances().items())
+    if method == "start_broadcast":
+        text, admin_chat_id = args
+        return start_broadcast(application.bot, text, admin_chat_id)
+    raise ValueError(f"Unknown shard request {method}")
+
+def start_broadcast(bot, text: str, admin_chat_id: int, progress_message_id: Optional[int] = None) -> bool:
+    """Start a broadcast on this shard, its sends queue behind interactive replies"""
+    # The broadcast task inherits the priority of the context that created it
+    with send_priority(BULK):
+        return broadcast_engine.start(bot, text, admin_chat_id=admin_chat_id, progress_message_id=progress_message_id)
+
+def render_users_page(sort: str, after: Optional[int] = None, before: Optional[int] = None):
+    """Text and paging keyboard for one page of /admin users"""
+    if not storage.sort_indexes_ready():
+        # Built on a background thread after startup, waiting for them would block the event loop
+        return "⏳ The user list indexes are still building, try again in a moment.", None
+    
+    field, label = USER_SORTS[sort]
+    # One extra user tells whether there is a page further in that direction
+    if before is not None:
+        page = storage.get_users_page(field, limit=USERS_PAGE_SIZE + 1, before=before)
+        has_previous, has_next = len(page) > USERS_PAGE_SIZE, True
+        page = page[-USERS_PAGE_SIZE:]
+    else:
+        page = storage.get_users_page(field, limit=USERS_PAGE_SIZE + 1, after=after)
+        has_previous, has_next = after is not None, len(page) > USERS_PAGE_SIZE
+        page = page[:USERS_PAGE_SIZE]
+    
+    message = f"👥 User List by {label}\n\n"
+    message += f"Total users: {storage.get_stats()['total_users']}\n\n"
+    for user_data in page:
+        username = user_data.get('username') or 'No username'
+        value = str(user_data[field])[:10] if field == "join_date" else user_data[field]
+        message += f"• @{username} (ID: {user_data['user_id']}) - {value}\n"
+    if not page:
+        message += "No users.\n"
+    
+    navigation = []
+    if page and has_previous:
+        navigation.append(InlineKeyboardButton("◀️ Previous", callback_data=f"users:{sort}:prev:{page[0]['user_id']}"))
+    if page and has_next:
+        navigation.append(InlineKeyboardButton("Next ▶️", callback_data=f"users:{sort}:next:{page[-1]['user_id']}"))
+    sorts = [InlineKeyboardButton(other_label, callback_data=f"users:{other}:top:0")
+             for other, (_, other_label) in USER_SORTS.items() if other != sort]
+    return message, InlineKeyboardMarkup([navigation, sorts] if navigation else [sorts])
+
+async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    """Broadcast message to all users in the background"""
+    if shard_client is not None:
+        # Every shard sends to its own users and reports its own progress
+        started = await shard_client.gather("start_broadcast", message_text, update.effective_chat.id)
+        if not any(started):
+            text = "⏳ A broadcast is already running. Please wait for it to finish."
+        else:
+            text = f"📢 Starting broadcast on {sum(started)} of {SHARDS} shards..."
+        await update.message.reply_text(text, reply_markup=MAIN_KEYBOARD)
+        return
+    
+    if broadcast_engine.running:
+        await update.message.reply_text(
+            "⏳ A broadcast is already running. Please wait for it to finish.",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return
+    
+    progress_message = await update.message.reply_text(
+        "📢 Starting broadcast..."
     )
+    
+    start_broadcast(context.bot, message_text, update.effective_chat.id, progress_message.message_id)
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel any ongoing process"""
@@ -461,7 +881,21 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     callback_data = query.data
     user_id = query.from_user.id
     
-    if callback_data.startswith("watched_ad_"):
+    if callback_data.startswith("users:"):
+        if user_id != ADMIN_ID:
+            return
+        
+        _, sort, direction, cursor = callback_data.split(":")
+        if direction == "next":
+            message, keyboard = render_users_page(sort, after=int(cursor))
+        elif direction == "prev":
+            message, keyboard = render_users_page(sort, before=int(cursor))
+        else:
+            message, keyboard = render_users_page(sort)
+        # Keeps the buttons to try again while the indexes are building
+        await query.edit_message_text(message, reply_markup=keyboard or query.message.reply_markup)
+    
+    elif callback_data.startswith("watched_ad_"):
         # Extract user_id from callback data
         ad_user_id = int(callback_data.split("_")[-1])
         
@@ -484,7 +918,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         # Update last ad time and add ad view
         user_last_ad_time[user_id] = current_time
-        ads_watched = storage.add_ad_view(user_id)
+        ads_watched = storage.add_ad_view(user_id, key=f"ad:{query.message.chat.id}:{query.message.message_id}")
         
         # Calculate rewards
         views_earned = ads_watched // 10
@@ -506,37 +940,136 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             parse_mode='Markdown'
         )
         
-        # Send main menu after 3 seconds
-        import asyncio
-        await asyncio.sleep(1)
+        # Offer the main menu again shortly, without holding the handler open
+        scheduler.run_once("main_menu", MENU_FOLLOWUP_DELAY, {"chat_id": user_id})
+
+async def send_main_menu(context: ContextTypes.DEFAULT_TYPE):
+    """Scheduled follow-up offering the main menu"""
+    with send_priority(CALLBACK):
         await context.bot.send_message(
-            chat_id=user_id,
+            chat_id=context.job.data["chat_id"],
             text="Choose your next action:",
             reply_markup=MAIN_KEYBOARD
         )
 
-def run_bot():
-    """Run the Telegram bot with polling"""
-    # Setup logging
+scheduler.register("main_menu", send_main_menu)
+
+async def flush_activity_job(context: ContextTypes.DEFAULT_TYPE):
+    """Persist buffered last_activity timestamps"""
+    await asyncio.to_thread(storage.flush_activity)
+
+async def compact_job(context: ContextTypes.DEFAULT_TYPE):
+    """Write a storage snapshot if anything changed"""
+    await asyncio.to_thread(storage.compact)
+
+async def expire_states_job(context: ContextTypes.DEFAULT_TYPE):
+    """Drop expired conversation states and cooldowns, which are otherwise only dropped when read"""
+    expired = sum(store.expire() for store in (user_states, order_drafts, user_last_ad_time))
+    if expired:
+        logging.info(f"Expired {expired} conversation states")
+
+async def reconcile_orders_job(context: ContextTypes.DEFAULT_TYPE):
+    """Update dispatched orders from the order API and tell users about delivered ones"""
+    changed = await order_reconciler.reconcile(functools.partial(notify_order_result, context.bot))
+    if changed:
+        logging.info(f"Reconciled the status of {changed} orders")
+
+async def stats_rollup_job(context: ContextTypes.DEFAULT_TYPE):
+    """Publish the storage totals on /metrics"""
+    for stat, value in storage.get_stats().items():
+        metrics.STORAGE_STATS.set(value, stat=stat)
+
+def schedule_maintenance():
+    """Periodic storage and state upkeep, each job skipped while its previous run is still going"""
+    if ACTIVITY_FLUSH_INTERVAL > 0:
+        scheduler.run_repeating("flush_activity", flush_activity_job, ACTIVITY_FLUSH_INTERVAL)
+    if COMPACT_INTERVAL > 0:
+        scheduler.run_repeating("compact", compact_job, COMPACT_INTERVAL)
+    scheduler.run_repeating("expire_states", expire_states_job, STATE_EXPIRE_INTERVAL)
+    if ORDER_STATUS_URL:
+        scheduler.run_repeating("reconcile_orders", reconcile_orders_job, ORDER_RECONCILE_INTERVAL)
+    scheduler.run_repeating("stats_rollup", stats_rollup_job, STATS_ROLLUP_INTERVAL, first=0)
+    if SHARDS > 1:
+        # First run soon after start, once the worker is connected to the other shards
+        scheduler.run_repeating("referral_credits", replay_referral_credits_job, REFERRAL_RETRY_INTERVAL, first=5)
+
+async def post_init(application: Application):
+    """Open shared resources once the application starts"""
+    application.bot_data["event_loop_monitor"] = metrics.start_event_loop_monitor()
+    scheduler.start(application)
+    schedule_maintenance()
+    await order_client.start()
+    await order_dispatcher.start(on_result=functools.partial(notify_order_result, application.bot))
+    with send_priority(BULK):
+        broadcast_engine.resume(application.bot)
+
+async def post_shutdown(application: Application):
+    """Release shared resources and flush storage on shutdown"""
+    await broadcast_engine.stop()
+    await order_dispatcher.stop()
+    await order_client.close()
+    storage.close()
+    application.bot_data["event_loop_monitor"].cancel()
+
+def setup_logging():
+    """Configure logging for the bot process"""
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.INFO
     )
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    """Create the Telegram application with all handlers registered.
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    ``request`` replaces the HTTP transport to the Bot API, benchmark.py uses
+    it to run the handlers against a fake Bot API.
+    """
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES, MAX_WAITING_UPDATES_PER_USER))
+        # One prioritized queue for every Bot API request, sharing Telegram's per-bot limit across shards
+        .rate_limiter(OutboundQueue(rate=OUTBOUND_RATE / SHARDS))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
     
-    # Add handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CommandHandler("cancel", cancel_command))
-    application.add_handler(CallbackQueryHandler(handle_callback_query))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Add handlers, each timed for /metrics
+    application.add_handler(CommandHandler("start", metrics.instrument_handler(start_command)))
+    application.add_handler(CommandHandler("admin", metrics.instrument_handler(admin_command)))
+    application.add_handler(CommandHandler("cancel", metrics.instrument_handler(cancel_command)))
+    application.add_handler(CallbackQueryHandler(metrics.instrument_handler(handle_callback_query)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, metrics.instrument_handler(handle_message)))
+    
+    return application
+
+def run_bot():
+    """Run the Telegram bot with polling"""
+    setup_logging()
+    application = build_application()
     
     # Start polling
     print("🚀 Bot started with polling...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+def create_webhook_app():
+    """Create the ASGI app that receives updates through a Telegram webhook"""
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL environment variable is required in webhook mode")
+    setup_logging()
+    return create_asgi_app(build_application(), WEBHOOK_URL, WEBHOOK_SECRET, storage=storage,
+                           export_token=EXPORT_TOKEN)
+
+def run_webhook():
+    """Run the Telegram bot in webhook mode on an ASGI server"""
+    import uvicorn
+    
+    port = int(os.environ.get('PORT', 5000))
+    uvicorn.run(create_webhook_app(), host='0.0.0.0', port=port)
+
 # Simple Flask app to keep service alive on hosting platforms
 app = Flask(__name__)
 
@@ -552,16 +1085,38 @@ def home():
 def health():
     return jsonify({"status": "healthy"})
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/export/<name>.<fmt>')
+def export_endpoint(name: str, fmt: str):
+    if not EXPORT_TOKEN or name not in exports.EXPORTS or fmt not in exports.FORMATS:
+        abort(404)
+    if request.headers.get('Authorization') != f"Bearer {EXPORT_TOKEN}":
+        abort(403)
+    
+    # A generator body is sent with chunked transfer encoding as it is produced
+    return Response(
+        exports.iter_export(storage, name, fmt),
+        content_type=exports.FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={exports.export_filename(name, fmt)}"}
+    )
+
 def run_flask():
     """Run Flask app in background"""
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
 
 if __name__ == '__main__':
-    # Start Flask in background thread to keep service alive
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
-    
-    # Start bot with polling
-    run_bot()
\ No newline at end of file
+    if WEBHOOK_URL:
+        # Webhook mode serves updates and health checks from one server
+        run_webhook()
+    else:
+        # Start Flask in background thread to keep service alive
+        flask_thread = threading.Thread(target=run_flask)
+        flask_thread.daemon = True
+        flask_thread.start()
+        
+        # Start bot with polling
+        run_bot()
\ No newline at end of file
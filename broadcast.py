@@ -0,0 +1,224 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+class TokenBucket:
+    """Async token bucket allowing ``rate`` acquisitions per second"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Stop handing out tokens for the given time (flood control)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+    
+    def try_acquire(self) -> bool:
+        """Take a token without waiting, False if none is free or another caller is already waiting"""
+        now = time.monotonic()
+        if self._lock.locked() or now < self._paused_until:
+            return False
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """RetryAfter.retry_after is an int or a timedelta depending on PTB settings"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class BroadcastEngine:
+    """Sends one message to every user concurrently within Telegram's rate limits.
+    
+    Recipients are processed in ascending user ID order, ``chunk_size`` at a
+    time. After every chunk the progress is saved to ``state_filename``, so a
+    broadcast interrupted by a crash or restart resumes after the last
+    completed chunk (users in the interrupted chunk may get the message
+    twice). Users that blocked the bot are marked in storage and
+    skipped by later broadcasts.
+    
+    The pace is set by the bot's OutboundQueue: broadcasts are started under
+    send_priority(BULK), so their sends take the slots replies to users leave
+    free, and a RetryAfter pauses the whole queue. ``concurrency`` only
+    bounds the sends waiting in the queue at a time.
+    """
+    
+    def __init__(self, storage, state_filename: str = "broadcast_state.json", concurrency: int = 20,
+                 chunk_size: int = 200, progress_interval: float = 5.0, max_retries: int = 3):
+        self.storage = storage
+        self.state_filename = state_filename
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.max_retries = max_retries
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    def load_state(self) -> Optional[Dict[str, Any]]:
+        """Return the saved progress of an unfinished broadcast, if any"""
+        try:
+            with open(self.state_filename, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            logging.error(f"Ignoring corrupt broadcast state in {self.state_filename}")
+            return None
+    
+    def _save_state(self, state: Dict[str, Any]):
+        tmp_filename = self.state_filename + ".tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(tmp_filename, self.state_filename)
+    
+    def start(self, bot: Bot, text: str, admin_chat_id: int, progress_message_id: Optional[int] = None) -> bool:
+        """Start a new broadcast in the background, returns False if one is running"""
+        if self.running:
+            return False
+        
+        state = {
+            "text": text,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress_message_id,
+            "cursor": None,
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "started_at": datetime.now().isoformat()
+        }
+        self._save_state(state)
+        self._task = asyncio.create_task(self._run(bot, state), name="broadcast")
+        return True
+    
+    def resume(self, bot: Bot) -> bool:
+        """Continue an interrupted broadcast, returns False if there is none"""
+        state = self.load_state()
+        if state is None or self.running:
+            return False
+        
+        logging.info(f"Resuming broadcast after user {state['cursor']}")
+        self._task = asyncio.create_task(self._run(bot, state), name="broadcast")
+        return True
+    
+    async def stop(self):
+        """Cancel a running broadcast, its saved progress is kept for resume()"""
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+    
+    async def _run(self, bot: Bot, state: Dict[str, Any]):
+        recipients = self.storage.get_broadcast_recipients()
+        start = 0 if state["cursor"] is None else bisect.bisect_right(recipients, state["cursor"])
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
+        already_done = state["sent"] + state["failed"] + state["blocked"]
+        total = already_done + len(recipients) - start
+        last_report = 0.0
+        
+        async def send(user_id: int):
+            async with semaphore:
+                state[await self._send(bot, user_id, state["text"])] += 1
+        
+        for offset in range(start, len(recipients), self.chunk_size):
+            chunk = recipients[offset:offset + self.chunk_size]
+            await asyncio.gather(*(send(user_id) for user_id in chunk))
+            
+            state["cursor"] = chunk[-1]
+            self._save_state(state)
+            
+            if time.monotonic() - last_report >= self.progress_interval:
+                last_report = time.monotonic()
+                done = state["sent"] + state["failed"] + state["blocked"]
+                rate = (done - already_done) / max(last_report - started, 1e-6)
+                await self._report(bot, state, f"📢 **Broadcasting...**\n\n{self._summary(state, total)}\n"
+                                               f"⚡ Throughput: {rate:.1f} msg/s")
+        
+        os.remove(self.state_filename)
+        elapsed = time.monotonic() - started
+        await self._report(bot, state, f"✅ **Broadcast Complete**\n\n{self._summary(state, total)}\n"
+                                       f"⏱ Took {elapsed:.0f}s")
+    
+    async def _send(self, bot: Bot, user_id: int, text: str) -> str:
+        """Deliver the message to one user, returns the counter to increment"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=f"📢 **Message from Admin:**\n\n{text}",
+                    parse_mode='Markdown'
+                )
+                return "sent"
+            except RetryAfter as e:
+                # The outbound queue gave up on its own retries, it is paused for as long already
+                await asyncio.sleep(retry_after_seconds(e))
+            except Forbidden:
+                self.storage.set_user_blocked(user_id)
+                return "blocked"
+            except BadRequest as e:
+                logging.error(f"Failed to send broadcast to {user_id}: {e}")
+                return "failed"
+            except TelegramError as e:
+                logging.warning(f"Broadcast to {user_id} attempt {attempt + 1} failed: {e}")
+                await asyncio.sleep(2 ** attempt)
+        
+        return "failed"
+    
+    def _summary(self, state: Dict[str, Any], total: int) -> str:
+        done = state["sent"] + state["failed"] + state["blocked"]
+        return (
+            f"📤 Sent: {state['sent']}\n"
+            f"🚫 Blocked: {state['blocked']}\n"
+            f"❌ Failed: {state['failed']}\n"
+            f"📊 Progress: {done}/{total}"
+        )
+    
+    async def _report(self, bot: Bot, state: Dict[str, Any], text: str):
+        try:
+            if state["progress_message_id"] is not None:
+                await bot.edit_message_text(
+                    text,
+                    chat_id=state["admin_chat_id"],
+                    message_id=state["progress_message_id"],
+                    parse_mode='Markdown'
+                )
+            else:
+                message = await bot.send_message(state["admin_chat_id"], text, parse_mode='Markdown')
+                state["progress_message_id"] = message.message_id
+        except TelegramError as e:
+            logging.warning(f"Failed to report broadcast progress: {e}")
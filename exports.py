@@ -0,0 +1,60 @@
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterator, Tuple
+
+from sqlite_storage import ORDER_COLUMNS
+from storage import USER_FIELDS
+
+# Export name -> (storage method streaming the rows, CSV columns)
+EXPORTS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "users": ("iter_users", USER_FIELDS),
+    "orders": ("iter_orders", ORDER_COLUMNS),
+    "referrals": ("iter_referrals", ("referrer_id", "user_id", "date", "reward")),
+}
+
+# Format -> content type
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+def export_filename(name: str, fmt: str) -> str:
+    return f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+
+def iter_export(storage: Any, name: str, fmt: str, chunk_size: int = 1 << 16) -> Iterator[bytes]:
+    """Encode an export as NDJSON or CSV, yielding chunks of about ``chunk_size`` bytes.
+    
+    Rows come straight from the storage iterators, so memory stays flat
+    however many rows there are.
+    """
+    method, columns = EXPORTS[name]
+    buffer = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(buffer, columns, extrasaction="ignore")
+        writer.writeheader()
+    
+    for row in getattr(storage, method)():
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False) + "\n")
+        
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def write_export(storage: Any, name: str, fmt: str, path: str) -> int:
+    """Write a gzip-compressed export to ``path``, returns the compressed size"""
+    with gzip.open(path, 'wb') as file:
+        for chunk in iter_export(storage, name, fmt):
+            file.write(chunk)
+    return os.path.getsize(path)
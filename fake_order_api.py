@@ -0,0 +1,139 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+class FakeOrderAPI(ThreadingHTTPServer):
+    """Local stand-in for ORDER_API_URL and ORDER_STATUS_URL, for tests and benchmarks.
+    
+    ``GET /order?video=...&qty=...&ref=...`` answers 200 after ``latency``
+    seconds, or 503 with probability ``failure_rate``. Received orders are
+    kept in ``orders`` so callers can assert on what was dispatched.
+    
+    ``GET /status?orders=ref1,ref2`` reports each order placed with a ref:
+    ``in_progress`` for ``completion_time`` seconds, then ``canceled`` with
+    probability ``cancel_rate``, ``partial`` (with the undelivered views in
+    ``remains``) with probability ``partial_rate``, else ``completed``.
+    Unknown refs are ``not_found``.
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self, port: int = 0, latency: float = 0.0, failure_rate: float = 0.0,
+                 completion_time: float = 0.0, cancel_rate: float = 0.0, partial_rate: float = 0.0):
+        super().__init__(("127.0.0.1", port), _FakeOrderAPIHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.completion_time = completion_time
+        self.cancel_rate = cancel_rate
+        self.partial_rate = partial_rate
+        self.orders: List[Dict[str, Any]] = []
+        # ref -> (time the order was received, final status, views not delivered)
+        self.outcomes: Dict[str, Tuple[float, str, int]] = {}
+        self.status_requests = 0
+        self.lock = threading.Lock()
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/order"
+    
+    @property
+    def status_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/status"
+    
+    def place(self, params: Dict[str, str]):
+        """Record a received order and decide how it will end"""
+        quantity = int(params["qty"])
+        outcome = random.random()
+        if outcome < self.cancel_rate:
+            status, remains = "canceled", quantity
+        elif outcome < self.cancel_rate + self.partial_rate:
+            status, remains = "partial", random.randint(1, quantity) if quantity else 0
+        else:
+            status, remains = "completed", 0
+        
+        with self.lock:
+            self.orders.append(params)
+            if "ref" in params:
+                self.outcomes[params["ref"]] = (time.monotonic(), status, remains)
+    
+    def status(self, ref: str) -> Dict[str, Any]:
+        with self.lock:
+            outcome = self.outcomes.get(ref)
+        if outcome is None:
+            return {"status": "not_found"}
+        received_at, status, remains = outcome
+        if time.monotonic() - received_at < self.completion_time:
+            return {"status": "in_progress"}
+        return {"status": status, "remains": remains}
+
+class _FakeOrderAPIHandler(BaseHTTPRequestHandler):
+    server: FakeOrderAPI
+    
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        
+        if url.path == "/status":
+            self._status(params)
+        elif url.path != "/order":
+            self._reply(404, {"error": "not found"})
+        elif "video" not in params or not params.get("qty", "").isdigit():
+            self._reply(400, {"error": "video and qty are required"})
+        elif random.random() < self.server.failure_rate:
+            self._reply(503, {"error": "temporarily unavailable"})
+        else:
+            self.server.place(params)
+            self._reply(200, {"status": "ok"})
+    
+    def _status(self, params: Dict[str, str]):
+        if not params.get("orders"):
+            self._reply(400, {"error": "orders is required"})
+            return
+        
+        with self.server.lock:
+            self.server.status_requests += 1
+        refs = params["orders"].split(",")
+        self._reply(200, {"orders": {ref: self.server.status(ref) for ref in refs}})
+    
+    def _reply(self, status: int, body: Dict[str, Any]):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_order_api(port: int = 0, latency: float = 0.0, failure_rate: float = 0.0,
+                         completion_time: float = 0.0, cancel_rate: float = 0.0,
+                         partial_rate: float = 0.0) -> Tuple[FakeOrderAPI, str]:
+    """Start the fake order API on a background thread, return the server and its order URL"""
+    server = FakeOrderAPI(port, latency, failure_rate, completion_time, cancel_rate, partial_rate)
+    threading.Thread(target=server.serve_forever, name="fake-order-api", daemon=True).start()
+    return server, server.url
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the order API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability of answering 503")
+    parser.add_argument("--completion-time", type=float, default=60.0,
+                        help="seconds an order stays in_progress before its final status")
+    parser.add_argument("--cancel-rate", type=float, default=0.0, help="probability of an order ending canceled")
+    parser.add_argument("--partial-rate", type=float, default=0.0, help="probability of an order ending partial")
+    args = parser.parse_args()
+    
+    server = FakeOrderAPI(args.port, args.latency, args.failure_rate, args.completion_time, args.cancel_rate,
+                          args.partial_rate)
+    print(f"🚀 Fake order API listening on {server.url}, order status on {server.status_url}")
+    server.serve_forever()
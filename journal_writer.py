@@ -0,0 +1,116 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
+import metrics
+
+class JournalWriter:
+    """Appends journal lines from a dedicated thread with group commit.
+    
+    ``append`` only queues a line, so callers never wait on the disk. The
+    writer thread takes everything queued so far, writes it, then flushes
+    and fsyncs once for the whole batch. The Future returned for a line is
+    resolved once it is durable, for callers that need to know.
+    """
+    
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = open(filename, 'a', encoding='utf-8')
+        # (kind, payload, future): kind is "line", "sync", "rotate" or "stop"
+        self._queue: "queue.SimpleQueue[Tuple[str, Optional[str], Future]]" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="storage-journal-writer", daemon=True)
+        self._thread.start()
+    
+    def append(self, line: str) -> Future:
+        """Queue a line (ending in a newline), returns a Future resolved once it is on disk"""
+        future = Future()
+        self._queue.put(("line", line, future))
+        return future
+    
+    def sync(self) -> Future:
+        """Future resolved once every line queued before this call is on disk"""
+        future = Future()
+        self._queue.put(("sync", None, future))
+        return future
+    
+    def rotate(self, rotated: str) -> Future:
+        """Move the lines queued so far to ``rotated`` (appending if it exists) and start a new journal"""
+        future = Future()
+        self._queue.put(("rotate", rotated, future))
+        return future
+    
+    def close(self):
+        """Write everything queued and stop the writer thread"""
+        future = Future()
+        self._queue.put(("stop", None, future))
+        future.result()
+        self._thread.join()
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            pending: List[Future] = []
+            size = 0
+            started = time.perf_counter()
+            for kind, payload, future in batch:
+                try:
+                    if kind == "line":
+                        self._file.write(payload)
+                        size += len(payload.encode('utf-8'))
+                        pending.append(future)
+                    elif kind == "sync":
+                        pending.append(future)
+                    elif kind == "rotate":
+                        self._commit(pending, started, size)
+                        pending, size = [], 0
+                        self._rotate(payload)
+                        future.set_result(None)
+                    else:
+                        self._commit(pending, started, size)
+                        self._file.close()
+                        future.set_result(None)
+                        return
+                except OSError as e:
+                    logging.error(f"Journal write failed: {e}")
+                    for waiting in pending + [future]:
+                        if not waiting.done():
+                            waiting.set_exception(e)
+                    pending, size = [], 0
+            self._commit(pending, started, size)
+    
+    def _commit(self, pending: List[Future], started: float, size: int):
+        """Make the lines written so far durable and resolve their futures"""
+        if not pending:
+            return
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            logging.error(f"Journal fsync failed: {e}")
+            for future in pending:
+                future.set_exception(e)
+            return
+        metrics.record_write("journal", started, size)
+        for future in pending:
+            future.set_result(None)
+    
+    def _rotate(self, rotated: str):
+        self._file.close()
+        if os.path.exists(rotated):
+            # A compaction was interrupted, keep its records ahead of the new ones
+            with open(rotated, 'a', encoding='utf-8') as old, open(self.filename, 'r', encoding='utf-8') as current:
+                old.write(current.read())
+            os.remove(self.filename)
+        else:
+            os.replace(self.filename, rotated)
+        self._file = open(self.filename, 'a', encoding='utf-8')
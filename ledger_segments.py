@@ -0,0 +1,121 @@
+import itertools
+import json
+import logging
+import mmap
+import os
+from typing import Any, Dict, Iterator, List, Optional
+
+from snapshot import LedgerPart, LedgerSections, _Section, _dumps, read_sections, write_ledger
+
+MAGIC = b"FBLEDG01"
+
+class LedgerSegments:
+    """Sealed ledger entries, one memory-mapped file per month, searched in place.
+    
+    A segment ``<directory>/YYYY-MM.ledger`` holds entries in entry_id order
+    with the user and idempotency key indexes of a binary snapshot (see
+    snapshot.write_ledger), so entries are never held in memory: opening
+    only maps the files, and lookups binary search them. Entries are sealed
+    oldest first, so each segment continues the previous one.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        # month -> entries, oldest month first
+        self._segments: Dict[str, LedgerSections] = {}
+        
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".ledger"):
+                    self._open(name[:-len(".ledger")])
+    
+    def _path(self, month: str) -> str:
+        return os.path.join(self.directory, month + ".ledger")
+    
+    def _open(self, month: str):
+        path = self._path(month)
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        sections = read_sections(buffer, MAGIC, path)
+        start, length = sections["meta"]
+        meta = json.loads(buffer[start:start + length])
+        self._segments[month] = LedgerSections(buffer, sections, meta["first"])
+    
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self._segments.values())
+    
+    @property
+    def months(self) -> List[str]:
+        return sorted(self._segments)
+    
+    @property
+    def last_id(self) -> int:
+        """entry_id of the last sealed entry, 0 without any"""
+        return max((segment.last_id for segment in self._segments.values() if len(segment)), default=0)
+    
+    def find_key(self, key: str) -> Optional[Dict[str, Any]]:
+        """The sealed entry posted with an idempotency key, newest month first"""
+        for month in sorted(self._segments, reverse=True):
+            entry = self._segments[month].find_key(key)
+            if entry is not None:
+                return entry
+        return None
+    
+    def user_entries(self, user_id: int, before: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """A user's sealed entries newest first, only those with entry_id below ``before`` if given"""
+        for month in sorted(self._segments, reverse=True):
+            segment = self._segments[month]
+            if before is not None and before <= segment.first_id:
+                continue
+            for position in reversed(segment.user_positions(user_id)):
+                if before is None or segment.first_id + position < before:
+                    yield segment.entry(position)
+    
+    def iter_entries(self) -> Iterator[Dict[str, Any]]:
+        """Stream every entry sealed so far in entry_id order, later seals are not seen"""
+        return itertools.chain.from_iterable(segment.entries() for segment in self.segments())
+    
+    def segments(self) -> List[LedgerSections]:
+        """The segments oldest first"""
+        return [self._segments[month] for month in self.months]
+    
+    def seal(self, month: str, parts: List[LedgerPart]):
+        """Append entries that follow every sealed one to the segment of ``month``"""
+        existing = self._segments.get(month)
+        if existing is not None:
+            parts = [(existing, 0, len(existing))] + parts
+        self._write(month, parts)
+    
+    def truncate(self, last_id: int) -> int:
+        """Drop entries after ``last_id``, sealed by a compaction whose snapshot was not written, returns how many.
+        
+        The snapshot still holds them, or its journal does.
+        """
+        dropped = 0
+        for month in sorted(self._segments, reverse=True):
+            segment = self._segments[month]
+            if segment.last_id <= last_id:
+                break
+            keep = max(0, last_id - segment.first_id + 1)
+            dropped += len(segment) - keep
+            if keep:
+                self._write(month, [(segment, 0, keep)])
+            else:
+                del self._segments[month]
+                os.remove(self._path(month))
+        if dropped:
+            logging.warning(f"Dropped {dropped} sealed ledger entries newer than the snapshot")
+        return dropped
+    
+    def _write(self, month: str, parts: List[LedgerPart]):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_filename = self._path(month) + ".tmp"
+        with open(tmp_filename, 'wb') as file:
+            file.write(MAGIC)
+            _, first_id = write_ledger(file, parts)
+            with _Section(file, b"meta") as section:
+                section.write(_dumps({"month": month, "first": first_id}))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, self._path(month))
+        self._open(month)
@@ -0,0 +1,282 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import slowlog
+
+# Latency buckets in seconds, from fast storage reads up to slow API calls
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, le: Optional[str] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class _Metric:
+    kind = ""
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+    
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """Monotonically increasing count per label set"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+    
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+    
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+class Gauge(Counter):
+    """Value that can go up and down per label set"""
+    
+    kind = "gauge"
+    
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets per label set"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self._values: Dict[LabelValues, List[Any]] = {}
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+    
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+class Registry:
+    """Set of metrics rendered together in the Prometheus text format"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+    
+    def register(self, metric: _Metric) -> Any:
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+HANDLER_UPDATES = REGISTRY.register(Counter(
+    "bot_handler_updates_total", "Updates handled, by handler", ("handler",)))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "bot_handler_errors_total", "Handler calls that raised, by handler", ("handler",)))
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    "bot_handler_duration_seconds", "Time spent in each handler", ("handler",)))
+STORAGE_CALLS = REGISTRY.register(Counter(
+    "storage_calls_total", "Storage method calls, by method", ("method",)))
+STORAGE_LATENCY = REGISTRY.register(Histogram(
+    "storage_call_duration_seconds", "Time spent in each storage method", ("method",)))
+STORAGE_WRITE_LATENCY = REGISTRY.register(Histogram(
+    "storage_write_duration_seconds",
+    "Time spent writing storage files: save (snapshot without a journal), journal (one group commit) or compact", ("kind",)))
+STORAGE_WRITE_BYTES = REGISTRY.register(Counter(
+    "storage_written_bytes_total", "Bytes written to storage files, by kind of write", ("kind",)))
+ORDER_API_LATENCY = REGISTRY.register(Histogram(
+    "order_api_request_duration_seconds", "Order API request latency, by outcome", ("outcome",)))
+ORDER_API_ERRORS = REGISTRY.register(Counter(
+    "order_api_errors_total", "Failed order API requests: HTTP error status or network error", ("reason",)))
+UPDATES_DROPPED = REGISTRY.register(Counter(
+    "bot_updates_dropped_total", "Updates dropped because too many of the same user's updates were waiting"))
+OUTBOUND_WAIT = REGISTRY.register(Histogram(
+    "bot_outbound_wait_seconds", "Time Bot API requests waited in the outbound queue, by priority", ("priority",)))
+OUTBOUND_COALESCED = REGISTRY.register(Counter(
+    "bot_outbound_coalesced_total", "Message edits replaced by a later edit of the same message before being sent"))
+OUTBOUND_RETRY_AFTER = REGISTRY.register(Counter(
+    "bot_outbound_retry_after_total", "Bot API requests answered with flood control (RetryAfter)"))
+ORDERS_RECONCILED = REGISTRY.register(Counter(
+    "orders_reconciled_total", "Order status changes found by asking the order API, by new status", ("status",)))
+SCHEDULED_JOB_LATENCY = REGISTRY.register(Histogram(
+    "bot_scheduled_job_duration_seconds", "Time spent in each scheduled job run, by job", ("job",)))
+SCHEDULED_JOB_ERRORS = REGISTRY.register(Counter(
+    "bot_scheduled_job_errors_total", "Scheduled job runs that raised, by job", ("job",)))
+STORAGE_STATS = REGISTRY.register(Gauge(
+    "storage_stats", "Totals from storage get_stats, refreshed by the stats rollup job", ("stat",)))
+EVENT_LOOP_LAG = REGISTRY.register(Gauge(
+    "event_loop_lag_seconds", "How late the last event loop lag probe woke up"))
+EVENT_LOOP_LAG_HISTOGRAM = REGISTRY.register(Histogram(
+    "event_loop_lag_probe_seconds", "Distribution of event loop lag probes"))
+
+def instrument_handler(callback: Callable) -> Callable:
+    """Wrap an async PTB handler callback to count calls, errors and latency, and trace it for the slow log"""
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    async def wrapper(update, *args, **kwargs):
+        started = time.perf_counter()
+        user = getattr(update, "effective_user", None)
+        try:
+            with slowlog.SLOWLOG.trace(name, user.id if user else None, getattr(update, "update_id", None)):
+                return await callback(update, *args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_UPDATES.inc(handler=name)
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+    
+    return wrapper
+
+# Set while an instrumented storage method runs, so the methods it calls in turn
+# (subtract_balance -> add_balance, ...) are not counted again
+_in_storage_call: contextvars.ContextVar[bool] = contextvars.ContextVar("in_storage_call", default=False)
+
+def instrument_storage(storage: Any, exclude: Tuple[str, ...] = ("close",)) -> Any:
+    """Replace the public methods of a storage backend with versions that record calls and latency.
+    
+    Only the outermost call is recorded. Iterators a method returns are
+    timed while they are consumed, and recorded once exhausted or closed.
+    """
+    for name, method in inspect.getmembers(storage, inspect.ismethod):
+        if name.startswith("_") or name in exclude:
+            continue
+        setattr(storage, name, _timed_method(name, method))
+    return storage
+
+def _timed_method(name: str, method: Callable) -> Callable:
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _in_storage_call.get():
+            return method(*args, **kwargs)
+        
+        started = time.perf_counter()
+        token = _in_storage_call.set(True)
+        try:
+            with slowlog.phase("storage"):
+                result = method(*args, **kwargs)
+        except BaseException:
+            STORAGE_CALLS.inc(method=name)
+            STORAGE_LATENCY.observe(time.perf_counter() - started, method=name)
+            raise
+        finally:
+            _in_storage_call.reset(token)
+        
+        if isinstance(result, Iterator):
+            return _timed_iterator(name, result, time.perf_counter() - started)
+        STORAGE_CALLS.inc(method=name)
+        STORAGE_LATENCY.observe(time.perf_counter() - started, method=name)
+        return result
+    
+    return wrapper
+
+def _timed_iterator(name: str, iterator: Iterator[Any], elapsed: float) -> Iterator[Any]:
+    """Pass on the items of an iterator returned by a storage method, adding the time spent producing them"""
+    try:
+        while True:
+            started = time.perf_counter()
+            token = _in_storage_call.set(True)
+            try:
+                with slowlog.phase("storage"):
+                    item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _in_storage_call.reset(token)
+                elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+        STORAGE_CALLS.inc(method=name)
+        STORAGE_LATENCY.observe(elapsed, method=name)
+
+def record_write(kind: str, started: float, size: int):
+    """Record a storage file write that began at perf_counter() ``started``"""
+    STORAGE_WRITE_LATENCY.observe(time.perf_counter() - started, kind=kind)
+    STORAGE_WRITE_BYTES.inc(size, kind=kind)
+
+async def monitor_event_loop(interval: float = 1.0):
+    """Measure how late the event loop wakes up from a sleep, until cancelled"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        EVENT_LOOP_LAG.set(lag)
+        EVENT_LOOP_LAG_HISTOGRAM.observe(lag)
+
+def start_event_loop_monitor(interval: float = 1.0) -> Optional[asyncio.Task]:
+    """Start monitor_event_loop on the running loop"""
+    return asyncio.create_task(monitor_event_loop(interval), name="event-loop-monitor")
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+import metrics
+import slowlog
+
+class OrderAPIClient:
+    """Pooled async HTTP client for the order API, shared by all handlers"""
+    
+    def __init__(self, api_url: str, max_connections: int = 20, max_keepalive_connections: int = 10,
+                 max_concurrency: int = 10, timeout: float = 30.0, connect_timeout: float = 5.0,
+                 status_url: Optional[str] = None):
+        self.api_url = api_url
+        self.status_url = status_url
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+    
+    async def start(self):
+        """Open the connection pool (call once at application startup)"""
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections
+            ),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout)
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+    
+    async def close(self):
+        """Close the connection pool (call once at application shutdown)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def submit_order(self, video_link: str, quantity: int, ref: Optional[str] = None) -> httpx.Response:
+        """Submit an order, ``ref`` identifies it in order_statuses, raises httpx.HTTPError on network failures"""
+        params: Dict[str, Any] = {"video": video_link, "qty": quantity}
+        if ref is not None:
+            params["ref"] = ref
+        return await self._get(self.api_url, params)
+    
+    async def order_statuses(self, refs: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Status of several submitted orders in one request, ref -> {"status": ..., "remains": ...}.
+        
+        Raises httpx.HTTPError on network failures and error responses.
+        """
+        if self.status_url is None:
+            raise RuntimeError("No order status URL configured")
+        
+        response = await self._get(self.status_url, {"orders": ",".join(refs)})
+        response.raise_for_status()
+        return response.json()["orders"]
+    
+    async def _get(self, url: str, params: Dict[str, Any]) -> httpx.Response:
+        if self._client is None:
+            raise RuntimeError("OrderAPIClient.start() has not been called")
+        
+        # Waiting for a free slot counts as HTTP time in the slow log too
+        with slowlog.phase("http"):
+            async with self._semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await self._client.get(url, params=params)
+                except httpx.HTTPError as e:
+                    metrics.ORDER_API_LATENCY.observe(time.perf_counter() - started, outcome="error")
+                    metrics.ORDER_API_ERRORS.inc(reason=type(e).__name__)
+                    raise
+        
+        metrics.ORDER_API_LATENCY.observe(time.perf_counter() - started, outcome=f"{response.status_code // 100}xx")
+        if response.is_error:
+            metrics.ORDER_API_ERRORS.inc(reason=str(response.status_code))
+        return response
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import random
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+import metrics
+from order_client import OrderAPIClient
+from storage import FINAL_ORDER_STATUSES
+
+# Called with (order, status) once an order is submitted, has failed or got its final status
+# from the order API; orders reconciled to "partial" carry the undelivered views in "remains"
+OrderResultCallback = Callable[[Dict[str, Any], str], Awaitable[None]]
+
+# Statuses the order API reports that are taken over, anything else ("not_found") leaves the order as it is
+REPORTED_STATUSES = ("in_progress",) + FINAL_ORDER_STATUSES
+
+async def _notify(on_result: Optional[OrderResultCallback], order: Dict[str, Any], status: str):
+    if on_result is None:
+        return
+    try:
+        await on_result(order, status)
+    except Exception as e:
+        logging.error(f"Failed to notify user {order['user_id']} about order {order['order_id']}: {e}")
+
+class OrderDispatcher:
+    """Background workers that dispatch reserved orders to the order API.
+    
+    Orders are durable in storage (``reserve_order`` puts them in the order
+    queue), so the in-memory asyncio queue is rebuilt from storage at startup.
+    Each worker takes up to ``batch_size`` queued orders, sends them
+    concurrently and persists their final statuses in one storage write.
+    Transient failures (network errors, 429 and 5xx responses) are retried
+    with exponential backoff; after ``max_attempts`` the order fails and the
+    storage refunds the reserved balance. If persisting a batch fails, only
+    the write is retried, after a backoff that grows with every consecutive
+    failure: the order API already accepted its submitted orders, so they
+    are never sent again.
+    """
+    
+    def __init__(self, storage, client: OrderAPIClient, workers: int = 4, batch_size: int = 10,
+                 max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.storage = storage
+        self.client = client
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        
+        self.on_result: Optional[OrderResultCallback] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._attempts: Dict[str, int] = {}
+        self._retry_handles: Dict[str, asyncio.TimerHandle] = {}
+        # Consecutive failed writes of batch statuses, and orders whose status waits for one
+        self._persist_failures = 0
+        self._unpersisted = 0
+    
+    async def start(self, on_result: Optional[OrderResultCallback] = None):
+        """Load queued orders from storage and start the worker pool"""
+        self.on_result = on_result
+        self._queue = asyncio.Queue()
+        
+        for order in self.storage.get_queued_orders():
+            self.enqueue(order)
+        
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"order-dispatcher-{number}")
+            for number in range(self.workers)
+        ]
+    
+    async def stop(self):
+        """Stop the workers, unfinished orders stay queued in storage"""
+        for handle in self._retry_handles.values():
+            handle.cancel()
+        self._retry_handles.clear()
+        
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def enqueue(self, order: Dict[str, Any]):
+        """Hand a freshly reserved order to the workers"""
+        if order["order_id"] in self._attempts:
+            return
+        self._attempts[order["order_id"]] = 0
+        self._queue.put_nowait(order)
+    
+    def pending_count(self) -> int:
+        """Number of orders waiting for dispatch or retry"""
+        return self._queue.qsize() + len(self._retry_handles) + self._unpersisted if self._queue else 0
+    
+    async def _worker(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            results = await asyncio.gather(*(self._dispatch(order) for order in batch))
+            
+            statuses = {
+                order["order_id"]: status
+                for order, status in zip(batch, results)
+                if status is not None
+            }
+            # The orders keep their attempts entry until it succeeds, so enqueue does not take them again
+            self._unpersisted += len(statuses)
+            try:
+                await self._persist(statuses)
+            finally:
+                self._unpersisted -= len(statuses)
+            
+            for order, status in zip(batch, results):
+                if status is not None:
+                    self._attempts.pop(order["order_id"], None)
+                    await _notify(self.on_result, order, status)
+    
+    async def _dispatch(self, order: Dict[str, Any]) -> Optional[str]:
+        """Send one order, returning its final status or None if a retry was scheduled"""
+        order_id = order["order_id"]
+        attempt = self._attempts[order_id] + 1
+        self._attempts[order_id] = attempt
+        
+        try:
+            response = await self.client.submit_order(order["video_link"], order["quantity"], ref=order_id)
+        except httpx.HTTPError as e:
+            logging.warning(f"Order {order_id} attempt {attempt} failed: {e}")
+        else:
+            if response.status_code == 200:
+                return "submitted"
+            if response.status_code != 429 and response.status_code < 500:
+                logging.error(f"Order {order_id} rejected by the order API with status {response.status_code}")
+                return "failed"
+            logging.warning(f"Order {order_id} attempt {attempt} got status {response.status_code}")
+        
+        if attempt >= self.max_attempts:
+            return "failed"
+        
+        self._retry_handles[order_id] = asyncio.get_running_loop().call_later(
+            self._backoff(attempt), self._requeue, order
+        )
+        return None
+    
+    async def _persist(self, statuses: Dict[str, str]):
+        """Write the statuses of a batch, retrying until it succeeds"""
+        while True:
+            try:
+                self.storage.update_order_statuses(statuses)
+            except Exception as e:
+                self._persist_failures += 1
+                delay = self._backoff(self._persist_failures)
+                logging.error(f"Failed to persist order statuses {statuses}, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+            else:
+                self._persist_failures = 0
+                return
+    
+    def _backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+    
+    def _requeue(self, order: Dict[str, Any]):
+        self._retry_handles.pop(order["order_id"], None)
+        self._queue.put_nowait(order)
+
+class OrderReconciler:
+    """Brings the status of dispatched orders in line with the order API.
+    
+    Each run takes up to ``max_orders`` open orders from the storage's index
+    of orders not final yet (the next run goes on after the last of them),
+    asks the order API for their status ``batch_size`` orders per request,
+    at most ``concurrency`` requests at a time, and persists every change in
+    one storage write, which refunds canceled and partial orders. Users are
+    notified once their order is final. Orders the API does not know, or
+    whose request failed, are asked about again on the next run.
+    """
+    
+    def __init__(self, storage, client: OrderAPIClient, batch_size: int = 50, concurrency: int = 4,
+                 max_orders: int = 1000):
+        self.storage = storage
+        self.client = client
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_orders = max_orders
+        self._after: Optional[str] = None
+    
+    async def reconcile(self, on_result: Optional[OrderResultCallback] = None) -> int:
+        """Run once, returns the number of orders whose status changed"""
+        orders = self.storage.get_open_orders(self.max_orders, self._after)
+        # Start over from the oldest open order once the end of the index is reached
+        self._after = orders[-1]["order_id"] if len(orders) == self.max_orders else None
+        if not orders:
+            return 0
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        batches = [orders[start:start + self.batch_size] for start in range(0, len(orders), self.batch_size)]
+        reports = await asyncio.gather(*(self._query(batch, semaphore) for batch in batches))
+        
+        statuses: Dict[str, str] = {}
+        remains: Dict[str, int] = {}
+        changed = []
+        for batch, reported in zip(batches, reports):
+            for order in batch:
+                report = reported.get(order["order_id"]) or {}
+                status = report.get("status")
+                if status not in REPORTED_STATUSES or status == order["status"]:
+                    continue
+                statuses[order["order_id"]] = status
+                if status == "partial":
+                    remains[order["order_id"]] = int(report.get("remains") or 0)
+                changed.append(order)
+        if not statuses:
+            return 0
+        
+        try:
+            self.storage.update_order_statuses(statuses, remains)
+        except Exception as e:
+            logging.error(f"Failed to persist reconciled order statuses {statuses}: {e}")
+            return 0
+        
+        for status in statuses.values():
+            metrics.ORDERS_RECONCILED.inc(status=status)
+        await asyncio.gather(*(
+            _notify(on_result, {**order, "status": statuses[order["order_id"]],
+                                "remains": remains.get(order["order_id"], 0)}, statuses[order["order_id"]])
+            for order in changed if statuses[order["order_id"]] in FINAL_ORDER_STATUSES
+        ))
+        return len(statuses)
+    
+    async def _query(self, batch: List[Dict[str, Any]], semaphore: asyncio.Semaphore) -> Dict[str, Dict[str, Any]]:
+        async with semaphore:
+            try:
+                return await self.client.order_statuses([order["order_id"] for order in batch])
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                logging.warning(f"Order status request for {len(batch)} orders failed: {e!r}")
+                return {}
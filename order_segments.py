@@ -0,0 +1,138 @@
+import json
+import mmap
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from snapshot import LedgerSections, _Section, _dumps, read_sections, write_ledger
+
+MAGIC = b"FBORDS01"
+
+class OrderSegments:
+    """Sealed orders, one memory-mapped file per month, searched in place.
+    
+    A segment ``<directory>/YYYY-MM.orders`` holds the orders created in that
+    month, oldest first, indexed by user and by order ID like the ledger of
+    a binary snapshot (see snapshot.write_ledger). Only the number of orders
+    and the range of creation times of each month are kept in memory;
+    orders are decoded when looked up. Segments in the former JSON lines
+    layout (``YYYY-MM.jsonl``) are converted when opened.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        # month -> orders, and the created_at of its first and last order
+        self._segments: Dict[str, LedgerSections] = {}
+        self._ranges: Dict[str, Tuple[str, str]] = {}
+        
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".jsonl"):
+                    self._convert(name[:-len(".jsonl")])
+                elif name.endswith(".orders"):
+                    self._open(name[:-len(".orders")])
+    
+    def _path(self, month: str) -> str:
+        return os.path.join(self.directory, month + ".orders")
+    
+    def _open(self, month: str):
+        path = self._path(month)
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        sections = read_sections(buffer, MAGIC, path)
+        start, length = sections["meta"]
+        meta = json.loads(buffer[start:start + length])
+        self._segments[month] = LedgerSections(buffer, sections, None, fields=None, key="order_id")
+        self._ranges[month] = (meta["first"], meta["last"])
+    
+    def _convert(self, month: str):
+        legacy = os.path.join(self.directory, month + ".jsonl")
+        orders = {}
+        with open(legacy, 'r', encoding='utf-8') as file:
+            file.readline()
+            for line in file:
+                order = json.loads(line)
+                orders[order["order_id"]] = order
+        self._write(month, list(orders.values()))
+        os.remove(legacy)
+    
+    @property
+    def months(self) -> List[str]:
+        """Sealed months, oldest first"""
+        return sorted(self._segments)
+    
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self._segments.values())
+    
+    def __contains__(self, order_id: str) -> bool:
+        return self.month_of(order_id) is not None
+    
+    def _find(self, order_id: str) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        for month in sorted(self._segments, reverse=True):
+            order = self._segments[month].find_key(order_id)
+            if order is not None:
+                return month, order
+        return None, None
+    
+    def month_of(self, order_id: str) -> Optional[str]:
+        return self._find(order_id)[0]
+    
+    def get(self, order_id: str) -> Optional[Dict[str, Any]]:
+        return self._find(order_id)[1]
+    
+    def range_of(self, month: str) -> Tuple[str, str]:
+        """created_at of the first and last order of a sealed month"""
+        return self._ranges[month]
+    
+    def load(self, month: str) -> Dict[str, Dict[str, Any]]:
+        """All orders of a sealed month by order ID, oldest first"""
+        segment = self._segments.get(month)
+        return {order["order_id"]: order for order in segment.entries()} if segment is not None else {}
+    
+    def user_months(self, user_id: int) -> List[str]:
+        """Sealed months in which the user placed orders, newest first"""
+        return [month for month in sorted(self._segments, reverse=True)
+                if self._segments[month].user_positions(user_id)]
+    
+    def user_orders(self, user_id: int, month: str) -> List[Dict[str, Any]]:
+        """The user's orders in a sealed month, oldest first"""
+        segment = self._segments.get(month)
+        if segment is None:
+            return []
+        return [segment.entry(position) for position in segment.user_positions(user_id)]
+    
+    def iter_orders(self) -> Iterator[Dict[str, Any]]:
+        """Stream every sealed order, oldest month first"""
+        for month in self.months:
+            yield from self._segments[month].entries()
+    
+    def seal(self, orders: List[Dict[str, Any]]):
+        """Add orders to the segments of the months they were created in.
+        
+        Orders already sealed are replaced, which is also how changes to a
+        sealed order are saved, and makes sealing the same orders again after
+        an interrupted compaction harmless.
+        """
+        by_month: Dict[str, List[Dict[str, Any]]] = {}
+        for order in orders:
+            by_month.setdefault(order["created_at"][:7], []).append(order)
+        
+        for month, added in by_month.items():
+            merged = self.load(month)
+            for order in added:
+                merged[order["order_id"]] = order
+            self._write(month, list(merged.values()))
+    
+    def _write(self, month: str, orders: List[Dict[str, Any]]):
+        orders = sorted(orders, key=lambda order: (order["created_at"], order["order_id"]))
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_filename = self._path(month) + ".tmp"
+        with open(tmp_filename, 'wb') as file:
+            file.write(MAGIC)
+            write_ledger(file, [orders], fields=None, key="order_id")
+            with _Section(file, b"meta") as section:
+                section.write(_dumps({"month": month, "first": orders[0]["created_at"],
+                                      "last": orders[-1]["created_at"]}))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, self._path(month))
+        self._open(month)
@@ -0,0 +1,200 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, Iterator, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+import slowlog
+from broadcast import TokenBucket, retry_after_seconds
+
+# Priority classes, lowest value sent first
+INTERACTIVE = 0  # replies to a user's message
+CALLBACK = 1  # inline button edits and notifications
+BULK = 2  # broadcasts
+PRIORITY_NAMES = {INTERACTIVE: "interactive", CALLBACK: "callback", BULK: "bulk"}
+
+# Bot API methods that count towards Telegram's flood limits and go through the queue
+QUEUED_PREFIXES = ("send", "edit", "copy", "forward")
+# Edits of the same message still waiting in the queue are coalesced, only the last one is sent
+COALESCED_ENDPOINTS = ("editMessageText", "editMessageReplyMarkup", "editMessageCaption")
+
+# Priority of requests made by the current task when the call does not say,
+# set by send_priority() for whole background jobs such as a broadcast
+_priority: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("outbound_priority", default=None)
+
+@contextlib.contextmanager
+def send_priority(priority: int) -> Iterator[None]:
+    """Send the Bot API requests made inside the block (and tasks started there) with ``priority``"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class _Request:
+    __slots__ = ("callback", "args", "kwargs", "priority", "futures", "key", "queued_at", "attempts")
+    
+    def __init__(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any, kwargs: Dict[str, Any],
+                 priority: int, key: Optional[Tuple[Any, ...]]):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.futures: List[asyncio.Future] = []
+        self.key = key
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+class OutboundQueue(BaseRateLimiter[Dict[str, Any]]):
+    """Sends all Bot API requests of the bot through one prioritized, rate-limited queue.
+    
+    Installed as the application's rate limiter, so every ``reply_text``,
+    ``edit_message_text`` and ``send_message`` passes through it. Requests
+    leave at most ``rate`` per second, interactive replies first, then
+    callback edits and notifications, then bulk sends, so a broadcast never
+    delays a user's reply by more than one slot. The priority comes from
+    ``rate_limit_args={"priority": ...}``, else from send_priority(), else
+    from the method (edits are CALLBACK, other sends INTERACTIVE). A
+    RetryAfter pauses the whole queue and the request is sent again.
+    """
+    
+    def __init__(self, rate: float = 30.0, max_retries: int = 3):
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        # (priority, sequence, request), the sequence keeps each class in arrival order
+        self._heap: List[Tuple[int, int, _Request]] = []
+        self._sequence = itertools.count()
+        self._pending_edits: Dict[Tuple[Any, ...], _Request] = {}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._sending: set = set()
+    
+    async def initialize(self) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch(), name="outbound-queue")
+    
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        await asyncio.gather(*self._sending, return_exceptions=True)
+    
+    @property
+    def queued(self) -> int:
+        return len(self._heap)
+    
+    def _priority_of(self, endpoint: str, rate_limit_args: Optional[Dict[str, Any]]) -> int:
+        if rate_limit_args and "priority" in rate_limit_args:
+            return rate_limit_args["priority"]
+        priority = _priority.get()
+        if priority is not None:
+            return priority
+        return CALLBACK if endpoint.startswith("edit") else INTERACTIVE
+    
+    async def process_request(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any,
+                              kwargs: Dict[str, Any], endpoint: str, data: Dict[str, Any],
+                              rate_limit_args: Optional[Dict[str, Any]]) -> Any:
+        # Time waiting in the queue and for the Bot API both count as Telegram time in the slow log
+        with slowlog.phase("telegram"):
+            return await self._process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+    
+    async def _process_request(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any,
+                               kwargs: Dict[str, Any], endpoint: str, data: Dict[str, Any],
+                               rate_limit_args: Optional[Dict[str, Any]]) -> Any:
+        if not endpoint.startswith(QUEUED_PREFIXES) or self._dispatcher is None:
+            return await callback(*args, **kwargs)
+        
+        priority = self._priority_of(endpoint, rate_limit_args)
+        attempts = 0
+        if not self._heap and self.bucket.try_acquire():
+            # Nothing is waiting and a slot is free: send right away instead of a round trip through the queue
+            metrics.OUTBOUND_WAIT.observe(0, priority=PRIORITY_NAMES.get(priority, priority))
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if not self._flood_control(e, attempts=1):
+                    raise
+                attempts = 1
+        
+        future = asyncio.get_running_loop().create_future()
+        key = None
+        if endpoint in COALESCED_ENDPOINTS:
+            key = (endpoint, data.get("chat_id"), data.get("message_id"), data.get("inline_message_id"))
+            pending = self._pending_edits.get(key)
+            if pending is not None:
+                # Not sent yet: send this edit in its place, both callers get its result
+                pending.callback, pending.args, pending.kwargs = callback, args, kwargs
+                pending.futures.append(future)
+                metrics.OUTBOUND_COALESCED.inc()
+                return await future
+        
+        request = _Request(callback, args, kwargs, priority, key)
+        request.attempts = attempts
+        request.futures.append(future)
+        if key is not None:
+            self._pending_edits[key] = request
+        self._push(request, next(self._sequence))
+        return await future
+    
+    def _push(self, request: _Request, sequence: int):
+        heapq.heappush(self._heap, (request.priority, sequence, request))
+        self._wakeup.set()
+    
+    async def _dispatch(self):
+        while True:
+            while not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            
+            # Pick the request only once a slot is free, so later, more urgent requests go first
+            await self.bucket.acquire()
+            _, sequence, request = heapq.heappop(self._heap)
+            if request.key is not None and self._pending_edits.get(request.key) is request:
+                del self._pending_edits[request.key]
+            metrics.OUTBOUND_WAIT.observe(time.monotonic() - request.queued_at,
+                                          priority=PRIORITY_NAMES.get(request.priority, request.priority))
+            
+            task = asyncio.create_task(self._send(request, sequence))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+    
+    async def _send(self, request: _Request, sequence: int):
+        try:
+            result = await request.callback(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            request.attempts += 1
+            if self._flood_control(e, request.attempts):
+                # Keeps its place ahead of requests of its class that came later
+                self._push(request, sequence)
+                return
+            self._resolve(request, error=e)
+        except Exception as e:
+            self._resolve(request, error=e)
+        else:
+            self._resolve(request, result=result)
+    
+    def _flood_control(self, error: RetryAfter, attempts: int) -> bool:
+        """Hold back every request for the RetryAfter time, True if the request may be sent again"""
+        # Flood control applies to the whole bot, not to one chat
+        self.bucket.pause(retry_after_seconds(error))
+        metrics.OUTBOUND_RETRY_AFTER.inc()
+        if attempts > self.max_retries:
+            return False
+        logging.warning(f"Flood control, retrying in {retry_after_seconds(error):.0f}s")
+        return True
+    
+    def _resolve(self, request: _Request, result: Any = None, error: Optional[BaseException] = None):
+        for future in request.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -0,0 +1,120 @@
+import asyncio
+import sys
+import sysconfig
+import threading
+import time
+from collections import Counter
+from types import CodeType, FrameType
+from typing import Dict, List, Optional, Tuple
+
+STDLIB = sysconfig.get_paths()["stdlib"]
+# Frame of the event loop running one callback or task step, the frames under it are the loop itself
+LOOP_FRAME = "asyncio.events:Handle._run"
+# Where the event loop thread waits for I/O when it has nothing to do
+IDLE_FRAMES = frozenset(f"selectors:{name}.select" for name in
+                        ("SelectSelector", "PollSelector", "EpollSelector", "DevpollSelector", "KqueueSelector"))
+
+class Profile:
+    """Stacks sampled from one thread, root frame first, with how often each was seen"""
+    
+    def __init__(self, stacks: Counter, samples: int, idle: int, seconds: float, stdlib: frozenset = frozenset()):
+        self.stacks = stacks
+        self.samples = samples
+        self.idle = idle
+        self.seconds = seconds
+        # Labels of the standard library frames in the stacks
+        self.stdlib = stdlib
+    
+    @property
+    def busy(self) -> int:
+        return self.samples - self.idle
+    
+    def collapsed(self) -> str:
+        """Stacks in the collapsed format of flamegraph.pl (also read by speedscope)"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+    
+    def top(self, count: int = 15) -> List[Tuple[str, int, int]]:
+        """Hottest functions as (name, samples in it or its callees, samples in it), idle time left out.
+        
+        Only frames above the event loop count, and standard library frames
+        only as leaves, otherwise the loop and asyncio internals would top
+        the list at 100%.
+        """
+        total: Counter = Counter()
+        own: Counter = Counter()
+        for stack, samples in self.stacks.items():
+            if stack[-1] in IDLE_FRAMES:
+                continue
+            if LOOP_FRAME in stack:
+                stack = stack[len(stack) - 1 - stack[::-1].index(LOOP_FRAME):]
+            own[stack[-1]] += samples
+            for name in set(stack):
+                if name not in self.stdlib:
+                    total[name] += samples
+        for name in own:
+            total[name] = max(total[name], own[name])
+        return [(name, samples, own[name]) for name, samples in total.most_common(count)]
+
+class SamplingProfiler:
+    """Samples the stack of the event loop thread every ``interval`` seconds from a helper thread.
+    
+    Costs nothing while not running, and while running only the sampling
+    thread's ``interval`` wake-ups, so it is safe to use on the live bot.
+    """
+    
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.running = False
+        self._labels: Dict[CodeType, str] = {}
+        self._stdlib: set = set()
+    
+    def start(self, seconds: float) -> "asyncio.Future[Profile]":
+        """Profile the thread running the event loop for ``seconds``, the future gives the Profile"""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        
+        self.running = True
+        future = asyncio.ensure_future(asyncio.to_thread(self.sample, threading.get_ident(), seconds))
+        future.add_done_callback(self._finished)
+        return future
+    
+    def _finished(self, future: asyncio.Future):
+        self.running = False
+    
+    def sample(self, thread_id: int, seconds: float) -> Profile:
+        """Sample the stack of ``thread_id`` until ``seconds`` have passed"""
+        stacks: Counter = Counter()
+        samples = idle = 0
+        started = time.monotonic()
+        deadline = started + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            
+            stack = self._stack(frame)
+            stacks[stack] += 1
+            samples += 1
+            if stack[-1] in IDLE_FRAMES:
+                idle += 1
+            del frame
+            time.sleep(self.interval)
+        return Profile(stacks, samples, idle, time.monotonic() - started, frozenset(self._stdlib))
+    
+    def _stack(self, frame: Optional[FrameType]) -> Tuple[str, ...]:
+        stack = []
+        while frame is not None:
+            stack.append(self._label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+    
+    def _label(self, frame: FrameType) -> str:
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            module = frame.f_globals.get("__name__", "?")
+            label = self._labels[code] = f"{module}:{code.co_qualname}"
+            if code.co_filename.startswith(STDLIB) and "site-packages" not in code.co_filename:
+                self._stdlib.add(label)
+        return label
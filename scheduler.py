@@ -0,0 +1,122 @@
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram.ext import Application, CallbackContext, JobQueue
+
+import metrics
+
+JobCallback = Callable[[CallbackContext], Awaitable[Any]]
+
+class Scheduler:
+    """Deferred and periodic work on the application's PTB job queue.
+    
+    One-shot jobs are given by a registered ``kind`` and JSON data, so they
+    can be persisted: with a ``backend`` (a UserDataStorage or
+    SQLiteUserDataStorage) each one is kept in the state tables until it
+    ran, and start() schedules it again after a restart, right away if it
+    fell due while the bot was down. Jobs more than ``missed_grace``
+    seconds late are dropped instead.
+    
+    Periodic jobs run every ``interval`` seconds with random jitter, and a
+    run is skipped while the previous one is still going, so slow
+    maintenance never piles up.
+    """
+    
+    TABLE = "scheduled_jobs"
+    
+    def __init__(self, backend=None, missed_grace: float = 3600.0):
+        self.backend = backend
+        self.missed_grace = missed_grace
+        self._kinds: Dict[str, JobCallback] = {}
+        # job_id -> kind of one-shot jobs that have not run yet
+        self._pending: Dict[str, str] = {}
+        self._job_queue: Optional[JobQueue] = None
+    
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+    
+    def register(self, kind: str, callback: JobCallback):
+        """Make ``kind`` available to run_once, the callback gets the job data as ``context.job.data``"""
+        self._kinds[kind] = callback
+    
+    def start(self, application: Application):
+        """Attach to the application's job queue and reschedule the persisted one-shot jobs"""
+        if application.job_queue is None:
+            raise RuntimeError("The job queue is not available, install python-telegram-bot[job-queue]")
+        self._job_queue = application.job_queue
+        if self.backend is None:
+            return
+        
+        now = time.time()
+        dropped = []
+        for job_id, (entry, expires_at) in self.backend.load_states(self.TABLE).items():
+            if entry["kind"] not in self._kinds:
+                logging.warning(f"Dropping scheduled job {job_id} of unknown kind {entry['kind']}")
+                dropped.append(job_id)
+                continue
+            if expires_at <= now:
+                logging.warning(f"Dropping scheduled {entry['kind']} job {job_id}, {now - entry['due']:.0f}s overdue")
+                dropped.append(job_id)
+                continue
+            self._schedule(job_id, entry["kind"], max(0.0, entry["due"] - now), entry["data"])
+        if dropped:
+            self.backend.delete_states(self.TABLE, dropped)
+    
+    def run_once(self, kind: str, delay: float, data: Optional[Dict[str, Any]] = None) -> str:
+        """Run the ``kind`` job once in ``delay`` seconds, returns its id"""
+        if kind not in self._kinds:
+            raise ValueError(f"Unknown job kind {kind}")
+        
+        job_id = uuid.uuid4().hex
+        data = data or {}
+        if self.backend is not None:
+            due = time.time() + delay
+            self.backend.save_state(self.TABLE, job_id, {"kind": kind, "due": due, "data": data},
+                                    due + self.missed_grace)
+        self._schedule(job_id, kind, delay, data)
+        return job_id
+    
+    def _schedule(self, job_id: str, kind: str, delay: float, data: Dict[str, Any]):
+        callback = self._kinds[kind]
+        
+        async def run(context: CallbackContext):
+            try:
+                await self._timed(kind, callback, context)
+            finally:
+                # Ran or failed, either way it is not retried after a restart
+                self._pending.pop(job_id, None)
+                if self.backend is not None:
+                    self.backend.delete_states(self.TABLE, [job_id])
+        
+        self._pending[job_id] = kind
+        self._job_queue.run_once(run, delay, data=data, name=kind)
+    
+    def run_repeating(self, name: str, callback: JobCallback, interval: float, jitter: float = 0.1,
+                      first: Optional[float] = None):
+        """Run ``callback`` every ``interval`` seconds, each run moved by up to ``jitter`` × interval.
+        
+        Jitter keeps jobs with the same interval (and shards started
+        together) from all running at the same moment.
+        """
+        async def run(context: CallbackContext):
+            await self._timed(name, callback, context)
+        
+        self._job_queue.run_repeating(
+            run, interval, first=interval if first is None else first, name=name,
+            # A run still going when the next one is due makes APScheduler skip that one
+            job_kwargs={"jitter": interval * jitter, "max_instances": 1, "coalesce": True},
+        )
+    
+    @staticmethod
+    async def _timed(name: str, callback: JobCallback, context: CallbackContext):
+        started = time.perf_counter()
+        try:
+            await callback(context)
+        except Exception:
+            metrics.SCHEDULED_JOB_ERRORS.inc(job=name)
+            logging.exception(f"Scheduled job {name} failed")
+        finally:
+            metrics.SCHEDULED_JOB_LATENCY.observe(time.perf_counter() - started, job=name)
@@ -0,0 +1,493 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import zlib
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+# Multi-worker mode: a front process receives updates (polling or webhook) and
+# routes each one to the worker process owning its user, shard_of(user_id).
+# Every worker runs the bot with its own storage files and conversation state.
+#
+# Processes talk over a Unix socket with length-prefixed JSON messages:
+#   front -> worker   {"type": "update", "update": <Update JSON>}
+#                     {"type": "stop"}
+#   worker -> front   {"type": "hello", "shard": n} once connected
+#   either way        {"type": "request", "id": n, "shard": n | null, "method": str, "args": [...]}
+#                     {"type": "response", "id": n, "result": ...} or {"type": "response", "id": n, "error": str}
+# A worker's request for shard null goes to every shard and the result is the
+# list of their results in shard order. Workers serve requests with
+# bot.handle_shard_request; the front only forwards them.
+
+_LENGTH = struct.Struct("<I")
+
+class ShardError(Exception):
+    """A request to another shard failed or could not be delivered"""
+
+def shard_of(user_id: int, shards: int) -> int:
+    """Shard owning a user"""
+    return zlib.crc32(str(user_id).encode('ascii')) % shards
+
+def referral_code_suffix(shard: int, shards: int) -> str:
+    """End of the referral codes a shard creates, so codes are unique across shards and tell their shard"""
+    return f"s{shard}" if shards > 1 else ""
+
+def shard_of_referral_code(referral_code: str, shards: int) -> Optional[int]:
+    """Shard that created a referral code, None for codes from before sharding (8 hex digits).
+    
+    Raises ValueError if the code names a shard that does not exist.
+    """
+    code, separator, shard = referral_code.rpartition("s")
+    if not separator or len(code) != 8 or not shard.isdigit():
+        return None
+    if int(shard) >= shards:
+        raise ValueError(f"Referral code {referral_code!r} names shard {shard} of {shards}")
+    return int(shard)
+
+def shard_path(path: str, shard: int, shards: int) -> str:
+    """Storage file of a shard: user_data.json -> user_data.shard2.json, unchanged with a single shard"""
+    if shards == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard{shard}{extension}"
+
+async def send_message(writer: asyncio.StreamWriter, message: Dict[str, Any]):
+    payload = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    writer.write(_LENGTH.pack(len(payload)) + payload)
+    await writer.drain()
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+    """Next message, None once the other side closed the connection"""
+    try:
+        (length,) = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+        return json.loads(await reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        return None
+
+class ShardClient:
+    """A worker's connection to the front process.
+    
+    Updates received are handed to ``handle_update`` and requests from
+    other shards to ``handle_request(method, args)``, each in its own task.
+    ``request`` and ``gather`` call methods on other shards.
+    """
+    
+    def __init__(self, shard: int, shards: int, socket_path: str,
+                 handle_update: Callable[[Dict[str, Any]], Awaitable[None]],
+                 handle_request: Callable[[str, List[Any]], Awaitable[Any]], timeout: float = 30.0):
+        self.shard = shard
+        self.shards = shards
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._handle_update = handle_update
+        self._handle_request = handle_request
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._tasks: set = set()
+    
+    async def run(self):
+        """Connect to the front process and serve it until it sends stop or disconnects"""
+        reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+        await send_message(self._writer, {"type": "hello", "shard": self.shard})
+        
+        while True:
+            message = await read_message(reader)
+            if message is None or message["type"] == "stop":
+                break
+            if message["type"] == "response":
+                future = self._pending.pop(message["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+            elif message["type"] == "update":
+                self._spawn(self._handle_update(message["update"]))
+            elif message["type"] == "request":
+                self._spawn(self._serve(message))
+        
+        for future in self._pending.values():
+            future.set_exception(ShardError("Disconnected from the front process"))
+        self._writer.close()
+    
+    def _spawn(self, coroutine: Awaitable[Any]):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _serve(self, message: Dict[str, Any]):
+        try:
+            reply = {"type": "response", "id": message["id"],
+                     "result": await self._handle_request(message["method"], message["args"])}
+        except Exception as e:
+            logging.exception(f"Shard request {message['method']} failed")
+            reply = {"type": "response", "id": message["id"], "error": f"{type(e).__name__}: {e}"}
+        await send_message(self._writer, reply)
+    
+    async def _call(self, shard: Optional[int], method: str, args: List[Any]) -> Any:
+        if self._writer is None:
+            raise ShardError("Not connected to the front process")
+        
+        request_id = next(self._ids)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        await send_message(self._writer, {"type": "request", "id": request_id, "shard": shard,
+                                          "method": method, "args": args})
+        try:
+            response = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise ShardError(f"{method} on shard {shard} timed out") from None
+        finally:
+            self._pending.pop(request_id, None)
+        
+        if "error" in response:
+            raise ShardError(response["error"])
+        return response["result"]
+    
+    async def request(self, shard: int, method: str, *args: Any) -> Any:
+        """Call ``method`` on one shard, this one included"""
+        return await self._call(shard, method, list(args))
+    
+    async def gather(self, method: str, *args: Any) -> List[Any]:
+        """Call ``method`` on every shard, returns their results in shard order"""
+        return await self._call(None, method, list(args))
+
+class ShardRouter:
+    """The front process side: routes updates to workers and forwards requests between them"""
+    
+    def __init__(self, shards: int, timeout: float = 30.0):
+        self.shards = shards
+        self.timeout = timeout
+        self.ready = asyncio.Event()
+        self._writers: Dict[int, asyncio.StreamWriter] = {}
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._tasks: set = set()
+        self._stopping = False
+    
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Connection handler for asyncio.start_unix_server"""
+        hello = await read_message(reader)
+        if hello is None or hello.get("type") != "hello":
+            writer.close()
+            return
+        
+        shard = hello["shard"]
+        self._writers[shard] = writer
+        logging.info(f"Shard {shard} connected")
+        if len(self._writers) == self.shards:
+            self.ready.set()
+        
+        while True:
+            message = await read_message(reader)
+            if message is None:
+                break
+            if message["type"] == "request":
+                task = asyncio.ensure_future(self._forward(shard, message))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            elif message["type"] == "response":
+                future = self._pending.pop(message["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        
+        if not self._stopping:
+            logging.error(f"Shard {shard} disconnected")
+        if self._writers.get(shard) is writer:
+            del self._writers[shard]
+    
+    async def route(self, update: Dict[str, Any]):
+        """Send an update (as JSON) to the worker owning its user, shard 0 for updates without one"""
+        user = Update.de_json(update, None).effective_user
+        shard = shard_of(user.id, self.shards) if user is not None else 0
+        writer = self._writers.get(shard)
+        if writer is None:
+            logging.error(f"Dropping update {update.get('update_id')}, shard {shard} is not connected")
+            return
+        await send_message(writer, {"type": "update", "update": update})
+    
+    async def _forward(self, source: int, message: Dict[str, Any]):
+        shards = range(self.shards) if message["shard"] is None else [message["shard"]]
+        reply: Dict[str, Any] = {"type": "response", "id": message["id"]}
+        try:
+            results = await asyncio.gather(*(self._call(shard, message["method"], message["args"])
+                                             for shard in shards))
+            reply["result"] = results if message["shard"] is None else results[0]
+        except ShardError as e:
+            reply["error"] = str(e)
+        
+        writer = self._writers.get(source)
+        if writer is not None:
+            await send_message(writer, reply)
+    
+    async def _call(self, shard: int, method: str, args: List[Any]) -> Any:
+        writer = self._writers.get(shard)
+        if writer is None:
+            raise ShardError(f"Shard {shard} is not connected")
+        
+        request_id = next(self._ids)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        await send_message(writer, {"type": "request", "id": request_id, "method": method, "args": args})
+        try:
+            response = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise ShardError(f"{method} on shard {shard} timed out") from None
+        finally:
+            self._pending.pop(request_id, None)
+        
+        if "error" in response:
+            raise ShardError(f"Shard {shard}: {response['error']}")
+        return response["result"]
+    
+    async def stop(self):
+        """Ask every worker to shut down"""
+        self._stopping = True
+        for writer in list(self._writers.values()):
+            try:
+                await send_message(writer, {"type": "stop"})
+            except ConnectionError:
+                pass
+
+def run_worker(shard: int, shards: int, socket_path: str):
+    """Entry point of a worker process, serves the users of one shard"""
+    os.environ["SHARD"] = str(shard)
+    os.environ["SHARDS"] = str(shards)
+    # Imported only now, so bot.py opens the storage files of this shard
+    import bot
+    
+    bot.setup_logging()
+    asyncio.run(_serve_worker(bot, shard, shards, socket_path))
+
+async def _serve_worker(bot: Any, shard: int, shards: int, socket_path: str):
+    application = bot.build_application()
+    
+    async def handle_update(data: Dict[str, Any]):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    
+    async def handle_request(method: str, args: List[Any]) -> Any:
+        return await bot.handle_shard_request(application, method, args)
+    
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        
+        bot.shard_client = ShardClient(shard, shards, socket_path, handle_update, handle_request)
+        try:
+            await bot.shard_client.run()
+        finally:
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+class ShardedBot:
+    """The front process: starts the workers and feeds them updates from polling or a webhook"""
+    
+    def __init__(self, shards: int, token: str, socket_path: str = "shards.sock"):
+        self.shards = shards
+        self.socket_path = socket_path
+        self.bot = Bot(token)
+        self.router = ShardRouter(shards)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._processes: List[multiprocessing.Process] = []
+    
+    async def start(self):
+        """Start the workers and wait until all of them are connected"""
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = await asyncio.start_unix_server(self.router.serve, path=self.socket_path)
+        
+        context = multiprocessing.get_context("spawn")
+        for shard in range(self.shards):
+            process = context.Process(target=run_worker, args=(shard, self.shards, self.socket_path),
+                                      name=f"bot-shard-{shard}")
+            process.start()
+            self._processes.append(process)
+        
+        await self.router.ready.wait()
+        await self.bot.initialize()
+        logging.info(f"🚀 {self.shards} bot workers started")
+    
+    async def stop(self):
+        """Stop the workers, which flush their storage, and wait for them to exit"""
+        await self.router.stop()
+        for process in self._processes:
+            await asyncio.to_thread(process.join, 60)
+            if process.is_alive():
+                logging.error(f"Terminating unresponsive worker {process.name}")
+                process.terminate()
+        self._server.close()
+        await self.bot.shutdown()
+    
+    async def poll(self):
+        """Long-poll Telegram and route every update, until cancelled"""
+        await self.bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except TelegramError as e:
+                logging.warning(f"Polling failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            for update in updates:
+                await self.router.route(update.to_dict())
+                offset = update.update_id + 1
+    
+    def create_webhook_app(self, webhook_url: str, secret_token: Optional[str] = None):
+        """ASGI app receiving updates through a Telegram webhook, like webhook.create_asgi_app"""
+        from contextlib import asynccontextmanager
+        
+        from starlette.applications import Starlette
+        from starlette.requests import Request
+        from starlette.responses import JSONResponse, Response
+        from starlette.routing import Route
+        
+        from webhook import WEBHOOK_PATH
+        
+        @asynccontextmanager
+        async def lifespan(_: Starlette):
+            await self.start()
+            await self.bot.set_webhook(
+                url=webhook_url.rstrip("/") + WEBHOOK_PATH,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+            yield
+            await self.stop()
+        
+        async def telegram(request: Request) -> Response:
+            if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+                return Response(status_code=403)
+            
+            try:
+                data = await request.json()
+            except ValueError:
+                return Response(status_code=400)
+            if not isinstance(data, dict):
+                return Response(status_code=400)
+            
+            await self.router.route(data)
+            return Response()
+        
+        async def home(request: Request) -> JSONResponse:
+            return JSONResponse({
+                "status": "Bot is running",
+                "mode": f"webhook, {self.shards} workers",
+                "timestamp": datetime.now().isoformat()
+            })
+        
+        async def health(request: Request) -> JSONResponse:
+            return JSONResponse({"status": "healthy"})
+        
+        return Starlette(
+            routes=[
+                Route(WEBHOOK_PATH, telegram, methods=["POST"]),
+                Route("/", home),
+                Route("/health", health),
+            ],
+            lifespan=lifespan
+        )
+
+async def _run_polling(front: ShardedBot):
+    await front.start()
+    try:
+        await front.poll()
+    finally:
+        await front.stop()
+
+def split_storage(source: str, shards: int, destination: str = "user_data.json") -> List[int]:
+    """Split a single-process store into one JSON snapshot per shard, returns the users per shard.
+    
+    ``source`` is user_data.json or a binary snapshot, with its journal and
+    sealed orders. Ledger entries are renumbered per shard; a binary worker
+    imports its JSON snapshot on first start.
+    """
+    from scheduler import Scheduler
+    from storage import UserDataStorage
+    
+    targets = [shard_path(destination, shard, shards) for shard in range(shards)]
+    existing = [target for target in targets if os.path.exists(target)]
+    if existing:
+        raise FileExistsError(f"{', '.join(existing)} already exist")
+    
+    binary = not source.endswith(".json")
+    storage = UserDataStorage(source, journal=os.path.exists(source + ".journal"), activity_flush_interval=0,
+                              binary=binary)
+    parts = [{"users": {}, "referrals": {}, "orders": [], "order_queue": {}, "open_orders": {}, "states": {},
+              "ledger": []}
+             for _ in range(shards)]
+    
+    def part(user_id: Any) -> Dict[str, Any]:
+        return parts[shard_of(int(user_id), shards)]
+    
+    for user in storage.iter_users():
+        part(user["user_id"])["users"][str(user["user_id"])] = user
+    for referral in storage.iter_referrals():
+        referrer_id = referral.pop("referrer_id")
+        part(referrer_id)["referrals"].setdefault(str(referrer_id), []).append(referral)
+    for order in storage.iter_orders():
+        part(order["user_id"])["orders"].append(order)
+    for order_id, created_at in storage.data["order_queue"].items():
+        part(storage.get_order(order_id)["user_id"])["order_queue"][order_id] = created_at
+    for order_id, created_at in storage.data["open_orders"].items():
+        part(storage.get_order(order_id)["user_id"])["open_orders"][order_id] = created_at
+    for entry in storage.iter_ledger():
+        ledger = part(entry["user_id"])["ledger"]
+        ledger.append({**entry, "entry_id": len(ledger) + 1})
+    for name, table in storage.data["states"].items():
+        for key, entry in table.items():
+            if name == Scheduler.TABLE:
+                # Keyed by job ID: a job goes with the chat it sends to (a user's private chat), else to shard 0
+                chat_id = entry[0]["data"].get("chat_id")
+                target = part(chat_id) if chat_id is not None else parts[0]
+            else:
+                target = part(key)
+            target["states"].setdefault(name, {})[key] = entry
+    storage.close()
+    
+    for target, data in zip(targets, parts):
+        tmp_filename = target + ".tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, target)
+    return [len(data["users"]) for data in parts]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the bot as several worker processes sharded by user ID")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    
+    run = subcommands.add_parser("run", help="run the front process and SHARDS workers")
+    run.add_argument("--shards", type=int, default=int(os.environ.get('SHARDS', '2')))
+    
+    split = subcommands.add_parser("split", help="split single-process storage into per-shard snapshots")
+    split.add_argument("source", nargs="?", default="user_data.json",
+                       help="user_data.json or a binary snapshot such as user_data.snap")
+    split.add_argument("--shards", type=int, default=int(os.environ.get('SHARDS', '2')))
+    split.add_argument("--destination", default="user_data.json",
+                       help="snapshot name the shard files are derived from")
+    args = parser.parse_args()
+    
+    if args.command == "split":
+        counts = split_storage(args.source, args.shards, args.destination)
+        for shard, count in enumerate(counts):
+            print(f"✅ {shard_path(args.destination, shard, args.shards)}: {count} users")
+    else:
+        logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+        front = ShardedBot(args.shards, os.environ['BOT_TOKEN'], os.environ.get('SHARD_SOCKET', 'shards.sock'))
+        webhook_url = os.environ.get('WEBHOOK_URL')
+        if webhook_url:
+            import uvicorn
+            
+            app = front.create_webhook_app(webhook_url, os.environ.get('WEBHOOK_SECRET'))
+            uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
+        else:
+            asyncio.run(_run_polling(front))
@@ -0,0 +1,99 @@
+import contextlib
+import contextvars
+import heapq
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional
+
+# Phases an update's time is split into, the rest of it is "other" (handler code, waiting for the loop)
+PHASES = ("storage", "http", "telegram")
+
+class UpdateTrace:
+    """Where the time of one handled update went"""
+    
+    __slots__ = ("handler", "user_id", "update_id", "started", "finished_at", "duration", "phases", "_open")
+    
+    def __init__(self, handler: str, user_id: Optional[int], update_id: Optional[int]):
+        self.handler = handler
+        self.user_id = user_id
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.finished_at: Optional[float] = None
+        self.duration: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        # phase -> [calls in flight, perf_counter() when the first of them started]
+        self._open: Dict[str, List[Any]] = {}
+    
+    @property
+    def other(self) -> float:
+        return max(0.0, self.duration - sum(self.phases.values()))
+
+# Trace of the update the current task is handling, tasks started by a handler inherit it
+_current: contextvars.ContextVar[Optional[UpdateTrace]] = contextvars.ContextVar("update_trace", default=None)
+
+class phase:
+    """Count the time spent in the ``with`` block towards ``name`` of the current update.
+    
+    Nested or concurrent calls of the same phase are counted once, while
+    any of them is in flight, so a storage method calling another one or
+    two Bot API requests sent together are not added up twice. A class
+    rather than a generator context manager: it wraps every storage call.
+    """
+    
+    __slots__ = ("name", "_trace", "_entry")
+    
+    def __init__(self, name: str):
+        self.name = name
+        self._trace: Optional[UpdateTrace] = None
+        self._entry: Optional[List[Any]] = None
+    
+    def __enter__(self):
+        trace = _current.get()
+        if trace is None or trace.duration is not None:
+            # Not handling an update, or a task that outlived the handler which started it
+            return
+        entry = trace._open.get(self.name)
+        if entry is None:
+            entry = trace._open[self.name] = [0, 0.0]
+        if entry[0] == 0:
+            entry[1] = time.perf_counter()
+        entry[0] += 1
+        self._trace, self._entry = trace, entry
+    
+    def __exit__(self, *exc_info):
+        entry = self._entry
+        if entry is None:
+            return
+        entry[0] -= 1
+        if entry[0] == 0:
+            trace = self._trace
+            trace.phases[self.name] = trace.phases.get(self.name, 0.0) + time.perf_counter() - entry[1]
+
+class SlowLog:
+    """The last ``size`` handled updates, to find the slowest ones and where their time went"""
+    
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self._traces: deque = deque(maxlen=size)
+    
+    @contextlib.contextmanager
+    def trace(self, handler: str, user_id: Optional[int] = None,
+              update_id: Optional[int] = None) -> Iterator[UpdateTrace]:
+        """Trace the update handled in the block"""
+        trace = UpdateTrace(handler, user_id, update_id)
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            _current.reset(token)
+            trace.duration = time.perf_counter() - trace.started
+            trace.finished_at = time.time()
+            self._traces.append(trace)
+    
+    def slowest(self, count: int = 10) -> List[UpdateTrace]:
+        return heapq.nlargest(count, list(self._traces), key=lambda trace: trace.duration)
+    
+    def __len__(self) -> int:
+        return len(self._traces)
+
+SLOWLOG = SlowLog()
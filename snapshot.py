@@ -0,0 +1,457 @@
+import argparse
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# Binary snapshot layout: MAGIC, then sections of (name, length, payload).
+#   data       JSON: the small data sections (orders, order queue, states, ...)
+#   users      user records, each prefixed with its length, in user_id order
+#   uindex     (user_id, offset in users) pairs in user_id order
+#   codes      (referral code, user_id) pairs in referral code order
+#   ledger     ledger entries as JSON arrays, each prefixed with its length, in entry_id order
+#   lids       offset in ledger of each entry, in entry_id order
+#   lusers     (user_id, entry position) pairs in that order
+#   lkeys      (idempotency key hash, entry position) pairs in that order
+#   refs       referrals as JSON lines
+#   meta       JSON: running statistics and counts
+# Sections are found by name, in any order. The file is memory-mapped and the
+# indexes are binary searched, so opening it only parses meta and data; users
+# and ledger entries are decoded when first looked up.
+
+MAGIC = b"FBSNAP01"
+_SECTION = struct.Struct("<8sQ")
+# user_id, balance, ads_watched, referred_by, referrals_count, join_date, last_activity, flags
+_USER = struct.Struct("<qqqqqqqB")
+_LENGTH = struct.Struct("<I")
+_STRING_LENGTH = struct.Struct("<H")
+_USER_INDEX = struct.Struct("<qQ")
+_CODE_INDEX = struct.Struct("<16sq")
+_OFFSET = struct.Struct("<Q")
+# (user_id or key hash, entry position)
+_LEDGER_INDEX = struct.Struct("<qI")
+
+# Field order of the values of a ledger entry in the ledger section
+LEDGER_FIELDS = ("entry_id", "user_id", "amount", "reason", "key", "ref", "date")
+
+_NO_STRING = 0xFFFF
+_BLOCKED = 1
+_REFERRED = 2
+
+def _encode_string(value: Optional[str]) -> bytes:
+    if value is None:
+        return _STRING_LENGTH.pack(_NO_STRING)
+    encoded = value.encode('utf-8')
+    return _STRING_LENGTH.pack(len(encoded)) + encoded
+
+def encode_user(row: List[Any]) -> bytes:
+    """Encode a user row (storage.USER_FIELDS order) as a length-prefixed record"""
+    (user_id, username, first_name, balance, ads_watched, referral_code, referred_by,
+     referrals_count, join_date, last_activity, blocked, last_ad_key) = row
+    flags = (_BLOCKED if blocked else 0) | (_REFERRED if referred_by is not None else 0)
+    record = b"".join((
+        _USER.pack(user_id, balance, ads_watched, referred_by or 0, referrals_count, join_date, last_activity, flags),
+        _encode_string(username),
+        _encode_string(first_name),
+        _encode_string(referral_code),
+        _encode_string(last_ad_key),
+    ))
+    return _LENGTH.pack(len(record)) + record
+
+def decode_user(buffer: Any, offset: int) -> List[Any]:
+    """Decode the record at ``offset`` (its length prefix) back into a user row"""
+    offset += _LENGTH.size
+    user_id, balance, ads_watched, referred_by, referrals_count, join_date, last_activity, flags = \
+        _USER.unpack_from(buffer, offset)
+    offset += _USER.size
+    
+    strings = []
+    for _ in range(4):
+        (length,) = _STRING_LENGTH.unpack_from(buffer, offset)
+        offset += _STRING_LENGTH.size
+        if length == _NO_STRING:
+            strings.append(None)
+        else:
+            strings.append(bytes(buffer[offset:offset + length]).decode('utf-8'))
+            offset += length
+    username, first_name, referral_code, last_ad_key = strings
+    
+    return [user_id, username, first_name, balance, ads_watched, referral_code,
+            referred_by if flags & _REFERRED else None, referrals_count, join_date, last_activity,
+            bool(flags & _BLOCKED), last_ad_key]
+
+def code_key(referral_code: str) -> bytes:
+    """Fixed-width key of a referral code in the codes index"""
+    encoded = referral_code.encode('utf-8')
+    if len(encoded) > 16:
+        raise ValueError(f"Referral code {referral_code!r} is longer than 16 bytes")
+    return encoded.ljust(16, b"\0")
+
+def key_hash(key: str) -> int:
+    """Signed 64-bit hash of a ledger idempotency key, as kept in the lkeys index"""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+class _Section:
+    """Write a section whose length is only known at the end: a placeholder header, patched on exit"""
+    
+    def __init__(self, file: BinaryIO, name: bytes):
+        self.file = file
+        self.name = name
+        self.length = 0
+    
+    def __enter__(self) -> "_Section":
+        self.header = self.file.tell()
+        self.file.write(_SECTION.pack(self.name, 0))
+        return self
+    
+    def write(self, payload: bytes):
+        self.file.write(payload)
+        self.length += len(payload)
+    
+    def __exit__(self, *exc_info):
+        end = self.file.tell()
+        self.file.seek(self.header)
+        self.file.write(_SECTION.pack(self.name, self.length))
+        self.file.seek(end)
+
+def _dumps(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _write_pairs(file: BinaryIO, name: bytes, pairs: Iterable[Tuple[int, int]], batch_size: int = 1000):
+    with _Section(file, name) as section:
+        for batch in iter(lambda: list(itertools.islice(pairs, batch_size)), []):
+            section.write(b"".join(_LEDGER_INDEX.pack(*pair) for pair in batch))
+
+def _shifted(pairs: Iterator[Tuple[int, int]], start: int, stop: int, base: int) -> Iterator[Tuple[int, int]]:
+    """Index pairs of the positions start to stop, moved by ``base``"""
+    return ((value, position + base) for value, position in pairs if start <= position < stop)
+
+# Part of the entries written by write_ledger: positions start to stop of existing
+# LedgerSections, copied without decoding, or new entries in entry_id order
+LedgerPart = Union[Tuple["LedgerSections", int, int], List[Dict[str, Any]]]
+
+def write_ledger(file: BinaryIO, parts: Iterable[LedgerPart], fields: Optional[Tuple[str, ...]] = LEDGER_FIELDS,
+                 key: str = "key") -> Tuple[int, Optional[int]]:
+    """Write the ledger, lids, lusers and lkeys sections, return the number of entries and the first entry_id.
+    
+    ``parts`` follow each other in entry_id order. Their index pairs are
+    already sorted (new entries are sorted here, a batch at a time is small),
+    so the indexes are merged while they are written. Entries are stored as
+    the values of ``fields``, whole JSON objects without them, and indexed
+    by their ``key`` field; sealed orders use the same sections.
+    """
+    count = 0
+    first_id = None
+    users, keys = [], []
+    with tempfile.TemporaryFile() as offsets:
+        with _Section(file, b"ledger") as section:
+            for part in parts:
+                if isinstance(part, tuple):
+                    reader, start, stop = part
+                    if start >= stop:
+                        continue
+                    if first_id is None:
+                        first_id = reader.first_id + start
+                    shift = section.length - reader.offset(start)
+                    for position in range(start, stop):
+                        offsets.write(_OFFSET.pack(reader.offset(position) + shift))
+                    for chunk in reader.raw(start, stop):
+                        section.write(chunk)
+                    users.append(_shifted(reader.user_pairs(), start, stop, count - start))
+                    keys.append(_shifted(reader.key_pairs(), start, stop, count - start))
+                    count += stop - start
+                elif part:
+                    if first_id is None:
+                        first_id = part[0].get("entry_id")
+                    for position, entry in enumerate(part, start=count):
+                        record = _dumps([entry[field] for field in fields] if fields else entry)
+                        offsets.write(_OFFSET.pack(section.length))
+                        section.write(_LENGTH.pack(len(record)) + record)
+                    users.append(iter(sorted((entry["user_id"], position)
+                                             for position, entry in enumerate(part, start=count))))
+                    keys.append(iter(sorted((key_hash(entry[key]), position)
+                                            for position, entry in enumerate(part, start=count))))
+                    count += len(part)
+        with _Section(file, b"lids") as section:
+            offsets.seek(0)
+            shutil.copyfileobj(offsets, file)
+            section.length = count * _OFFSET.size
+    
+    _write_pairs(file, b"lusers", heapq.merge(*users))
+    _write_pairs(file, b"lkeys", heapq.merge(*keys))
+    return count, first_id
+
+def write_snapshot(file: BinaryIO, users: Iterable[Tuple[int, bytes]], codes: Iterable[Tuple[bytes, int]],
+                   data: Dict[str, Any], meta: Dict[str, Any], ledger: Iterable[LedgerPart] = (),
+                   referrals: Iterable[Dict[str, Any]] = (), batch_size: int = 1000) -> int:
+    """Write a binary snapshot to ``file`` as it is produced, return its size.
+    
+    ``users`` yields (user_id, encoded record) and ``codes`` yields
+    (code_key, user_id), both already sorted; ``ledger`` gives the parts of
+    the ledger (see write_ledger) and ``referrals`` yields
+    {referrer_id, user_id, date, reward}. Memory use does not grow with
+    the number of users: records go straight to the file while the user
+    index is spooled to a temporary file, and meta, which holds the counts,
+    comes last.
+    """
+    file.write(MAGIC)
+    with _Section(file, b"data") as section:
+        # A key, and long lists batch_size items, at a time, like the JSON snapshot
+        section.write(b"{")
+        for position, (key, value) in enumerate(data.items()):
+            section.write((b"," if position else b"") + _dumps(key) + b":")
+            if isinstance(value, list):
+                section.write(b"[")
+                for start in range(0, len(value), batch_size):
+                    section.write((b"," if start else b"") + _dumps(value[start:start + batch_size])[1:-1])
+                section.write(b"]")
+            else:
+                section.write(_dumps(value))
+        section.write(b"}")
+    
+    count = 0
+    with tempfile.TemporaryFile() as user_index:
+        with _Section(file, b"users") as section:
+            for user_id, record in users:
+                user_index.write(_USER_INDEX.pack(user_id, section.length))
+                section.write(record)
+                count += 1
+        with _Section(file, b"uindex") as section:
+            user_index.seek(0)
+            shutil.copyfileobj(user_index, file)
+            section.length = count * _USER_INDEX.size
+    
+    with _Section(file, b"codes") as section:
+        batch = []
+        for key, user_id in codes:
+            batch.append(_CODE_INDEX.pack(key, user_id))
+            if len(batch) >= batch_size:
+                section.write(b"".join(batch))
+                batch = []
+        section.write(b"".join(batch))
+    
+    _, ledger_first = write_ledger(file, ledger)
+    
+    with _Section(file, b"refs") as section:
+        for batch in iter(lambda: list(itertools.islice(referrals, batch_size)), []):
+            section.write(b"".join(_dumps(referral) + b"\n" for referral in batch))
+    
+    with _Section(file, b"meta") as section:
+        section.write(_dumps({**meta, "user_count": count, "ledger_first": ledger_first}))
+    return file.tell()
+
+def read_sections(buffer: Any, magic: bytes, filename: str) -> Dict[str, Tuple[int, int]]:
+    """Section name -> (offset, length) of a memory-mapped file starting with ``magic``"""
+    if buffer[:len(magic)] != magic:
+        raise ValueError(f"{filename} is not a {magic[:6].decode('ascii')} file")
+    
+    sections: Dict[str, Tuple[int, int]] = {}
+    offset = len(magic)
+    while offset < len(buffer):
+        name, length = _SECTION.unpack_from(buffer, offset)
+        offset += _SECTION.size
+        sections[name.rstrip(b"\0").decode('ascii')] = (offset, length)
+        offset += length
+    return sections
+
+class LedgerSections:
+    """Ledger entries written by write_ledger, read in place from a memory-mapped file.
+    
+    Entries are addressed by position (entry_id - first_id) and found by
+    user or by idempotency key with a binary search of the indexes.
+    ``fields`` and ``key`` are those they were written with.
+    """
+    
+    def __init__(self, buffer: Any, sections: Dict[str, Tuple[int, int]], first_id: Optional[int],
+                 fields: Optional[Tuple[str, ...]] = LEDGER_FIELDS, key: str = "key"):
+        self._mmap = buffer
+        self.fields = fields
+        self.key = key
+        self._entries_offset, self._entries_length = sections["ledger"]
+        self._offsets_offset, offsets_length = sections["lids"]
+        self._users_offset, _ = sections["lusers"]
+        self._keys_offset, _ = sections["lkeys"]
+        self.count = offsets_length // _OFFSET.size
+        self.first_id = first_id or 1
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    @property
+    def last_id(self) -> int:
+        """entry_id of the last entry, first_id - 1 without entries"""
+        return self.first_id + self.count - 1
+    
+    def offset(self, position: int) -> int:
+        """Offset of an entry in the ledger section, its end for position == count"""
+        if position >= self.count:
+            return self._entries_length
+        return _OFFSET.unpack_from(self._mmap, self._offsets_offset + position * _OFFSET.size)[0]
+    
+    def entry(self, position: int) -> Dict[str, Any]:
+        start = self._entries_offset + self.offset(position)
+        (length,) = _LENGTH.unpack_from(self._mmap, start)
+        value = json.loads(self._mmap[start + _LENGTH.size:start + _LENGTH.size + length])
+        return dict(zip(self.fields, value)) if self.fields else value
+    
+    def entries(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        for position in range(start, self.count if stop is None else min(stop, self.count)):
+            yield self.entry(position)
+    
+    def raw(self, start: int, stop: int, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+        """Encoded entries start to stop, in chunks"""
+        end = self._entries_offset + self.offset(stop)
+        for offset in range(self._entries_offset + self.offset(start), end, chunk_size):
+            yield self._mmap[offset:min(offset + chunk_size, end)]
+    
+    def _pairs(self, table: int) -> Iterator[Tuple[int, int]]:
+        for position in range(self.count):
+            yield _LEDGER_INDEX.unpack_from(self._mmap, table + position * _LEDGER_INDEX.size)
+    
+    def user_pairs(self) -> Iterator[Tuple[int, int]]:
+        return self._pairs(self._users_offset)
+    
+    def key_pairs(self) -> Iterator[Tuple[int, int]]:
+        return self._pairs(self._keys_offset)
+    
+    def _matching(self, table: int, value: int) -> Iterator[int]:
+        """Positions of the entries paired with ``value`` in an index, in entry order"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if _LEDGER_INDEX.unpack_from(self._mmap, table + middle * _LEDGER_INDEX.size)[0] < value:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.count:
+            found, position = _LEDGER_INDEX.unpack_from(self._mmap, table + low * _LEDGER_INDEX.size)
+            if found != value:
+                return
+            yield position
+            low += 1
+    
+    def user_positions(self, user_id: int) -> List[int]:
+        """Positions of a user's entries, oldest first"""
+        return list(self._matching(self._users_offset, user_id))
+    
+    def find_key(self, key: str) -> Optional[Dict[str, Any]]:
+        """The entry posted with an idempotency key, None if there is none"""
+        for position in self._matching(self._keys_offset, key_hash(key)):
+            entry = self.entry(position)
+            if entry[self.key] == key:
+                return entry
+        return None
+
+class BinarySnapshot:
+    """Read-only, memory-mapped view of a binary snapshot file"""
+    
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        sections = read_sections(self._mmap, MAGIC, filename)
+        
+        def section(name: str) -> bytes:
+            start, length = sections[name]
+            return self._mmap[start:start + length]
+        
+        self.meta: Dict[str, Any] = json.loads(section("meta"))
+        self.data: Dict[str, Any] = json.loads(section("data"))
+        self._users_offset = sections["users"][0]
+        self._index_offset, index_length = sections["uindex"]
+        self._codes_offset, codes_length = sections["codes"]
+        self.user_count = index_length // _USER_INDEX.size
+        self._code_count = codes_length // _CODE_INDEX.size
+        # Snapshots from before these sections keep the ledger and referrals in data
+        self.ledger = LedgerSections(self._mmap, sections, self.meta.get("ledger_first")) \
+            if "ledger" in sections else None
+        self._referrals = sections.get("refs")
+    
+    def _record_offset(self, user_id: int) -> Optional[int]:
+        low, high = 0, self.user_count
+        while low < high:
+            middle = (low + high) // 2
+            found, offset = _USER_INDEX.unpack_from(self._mmap, self._index_offset + middle * _USER_INDEX.size)
+            if found < user_id:
+                low = middle + 1
+            elif found > user_id:
+                high = middle
+            else:
+                return self._users_offset + offset
+        return None
+    
+    def find_user(self, user_id: int) -> Optional[List[Any]]:
+        """Decode the row of one user, None if the snapshot does not have it"""
+        offset = self._record_offset(user_id)
+        return decode_user(self._mmap, offset) if offset is not None else None
+    
+    def find_referral(self, referral_code: str) -> Optional[int]:
+        """Look up the user ID owning a referral code"""
+        try:
+            key = code_key(referral_code)
+        except ValueError:
+            return None
+        
+        low, high = 0, self._code_count
+        while low < high:
+            middle = (low + high) // 2
+            found, user_id = _CODE_INDEX.unpack_from(self._mmap, self._codes_offset + middle * _CODE_INDEX.size)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return user_id
+        return None
+    
+    def records(self) -> Iterator[Tuple[int, bytes]]:
+        """Iterate (user_id, encoded record) in user_id order, without decoding"""
+        for position in range(self.user_count):
+            user_id, offset = _USER_INDEX.unpack_from(self._mmap, self._index_offset + position * _USER_INDEX.size)
+            start = self._users_offset + offset
+            (length,) = _LENGTH.unpack_from(self._mmap, start)
+            yield user_id, self._mmap[start:start + _LENGTH.size + length]
+    
+    def rows(self) -> Iterator[List[Any]]:
+        """Iterate decoded user rows in user_id order"""
+        for _, record in self.records():
+            yield decode_user(record, 0)
+    
+    def codes(self) -> Iterator[Tuple[bytes, int]]:
+        """Iterate (code_key, user_id) in referral code order"""
+        for position in range(self._code_count):
+            yield _CODE_INDEX.unpack_from(self._mmap, self._codes_offset + position * _CODE_INDEX.size)
+    
+    def referrals(self) -> Iterator[Dict[str, Any]]:
+        """Iterate referrals as {referrer_id, user_id, date, reward}"""
+        if self._referrals is None:
+            return
+        offset, length = self._referrals
+        end = offset + length
+        while offset < end:
+            line_end = self._mmap.find(b"\n", offset, end)
+            yield json.loads(self._mmap[offset:line_end])
+            offset = line_end + 1
+
+if __name__ == '__main__':
+    from storage import UserDataStorage
+    
+    parser = argparse.ArgumentParser(description="Convert storage snapshots between JSON and the binary format")
+    parser.add_argument("source", help="user_data.json or a binary snapshot such as user_data.snap")
+    parser.add_argument("destination", help="file to write, JSON if it ends in .json and binary otherwise")
+    args = parser.parse_args()
+    
+    # Pending journal records are replayed into the export
+    binary = not args.source.endswith(".json")
+    storage = UserDataStorage(args.source, journal=os.path.exists(args.source + ".journal"),
+                              activity_flush_interval=0, binary=binary)
+    storage.export(args.destination)
+    storage.close()
+    print(f"✅ Wrote {args.destination} with {len(storage._users)} users")
@@ -0,0 +1,140 @@
+import bisect
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+class SortedIndex:
+    """User IDs ordered by a numeric value, highest value first, ties by ascending user ID.
+    
+    Entries live in buckets of at most ``bucket_size``, each a pair of int64
+    arrays (negated values and user IDs), so an entry costs 16 bytes and an
+    update only shifts the entries of one bucket. Pages are read from a
+    cursor entry, without sorting anything.
+    """
+    
+    def __init__(self, entries: Iterable[Tuple[int, int]] = (), bucket_size: int = 1024):
+        self.bucket_size = bucket_size
+        self._values: List[array] = []
+        self._user_ids: List[array] = []
+        # Last (negated value, user_id) of each bucket
+        self._maxes: List[Tuple[int, int]] = []
+        self._len = 0
+        
+        ordered = sorted((-value, user_id) for value, user_id in entries)
+        for start in range(0, len(ordered), bucket_size):
+            chunk = ordered[start:start + bucket_size]
+            self._values.append(array('q', (key for key, _ in chunk)))
+            self._user_ids.append(array('q', (user_id for _, user_id in chunk)))
+            self._maxes.append(chunk[-1])
+        self._len = len(ordered)
+    
+    def __len__(self) -> int:
+        return self._len
+    
+    def _position(self, bucket: int, key: int, user_id: int) -> int:
+        values = self._values[bucket]
+        low = bisect.bisect_left(values, key)
+        high = bisect.bisect_right(values, key, low)
+        return bisect.bisect_left(self._user_ids[bucket], user_id, low, high)
+    
+    def _find(self, value: int, user_id: int) -> Tuple[int, int]:
+        """Bucket and position where the entry is or would be inserted"""
+        key = -value
+        bucket = bisect.bisect_left(self._maxes, (key, user_id))
+        if bucket == len(self._maxes):
+            return bucket, 0
+        return bucket, self._position(bucket, key, user_id)
+    
+    def add(self, value: int, user_id: int):
+        if not self._maxes:
+            self._values.append(array('q', [-value]))
+            self._user_ids.append(array('q', [user_id]))
+            self._maxes.append((-value, user_id))
+            self._len = 1
+            return
+        
+        bucket, position = self._find(value, user_id)
+        if bucket == len(self._maxes):
+            bucket = len(self._maxes) - 1
+            position = len(self._values[bucket])
+        self._values[bucket].insert(position, -value)
+        self._user_ids[bucket].insert(position, user_id)
+        self._maxes[bucket] = max(self._maxes[bucket], (-value, user_id))
+        self._len += 1
+        
+        if len(self._values[bucket]) > 2 * self.bucket_size:
+            self._split(bucket)
+    
+    def _split(self, bucket: int):
+        values, user_ids = self._values[bucket], self._user_ids[bucket]
+        half = len(values) // 2
+        self._values[bucket:bucket + 1] = [values[:half], values[half:]]
+        self._user_ids[bucket:bucket + 1] = [user_ids[:half], user_ids[half:]]
+        self._maxes[bucket:bucket + 1] = [(values[half - 1], user_ids[half - 1]), (values[-1], user_ids[-1])]
+    
+    def remove(self, value: int, user_id: int):
+        bucket, position = self._find(value, user_id)
+        if (bucket == len(self._maxes) or position == len(self._values[bucket])
+                or self._user_ids[bucket][position] != user_id or self._values[bucket][position] != -value):
+            raise KeyError((value, user_id))
+        
+        values, user_ids = self._values[bucket], self._user_ids[bucket]
+        del values[position]
+        del user_ids[position]
+        self._len -= 1
+        if not values:
+            del self._values[bucket], self._user_ids[bucket], self._maxes[bucket]
+        elif position == len(values):
+            self._maxes[bucket] = (values[-1], user_ids[-1])
+    
+    def move(self, old_value: int, new_value: int, user_id: int):
+        """Reposition a user whose value changed"""
+        if old_value != new_value:
+            self.remove(old_value, user_id)
+            self.add(new_value, user_id)
+    
+    def _iter_from(self, bucket: int, position: int) -> Iterator[Tuple[int, int]]:
+        while bucket < len(self._values):
+            values, user_ids = self._values[bucket], self._user_ids[bucket]
+            for index in range(position, len(values)):
+                yield -values[index], user_ids[index]
+            bucket, position = bucket + 1, 0
+    
+    def _iter_back_from(self, bucket: int, position: int) -> Iterator[Tuple[int, int]]:
+        """Entries before (bucket, position), nearest first"""
+        while bucket >= 0:
+            values, user_ids = self._values[bucket], self._user_ids[bucket]
+            for index in range(min(position, len(values)) - 1, -1, -1):
+                yield -values[index], user_ids[index]
+            bucket, position = bucket - 1, len(self._values[bucket - 1]) if bucket else 0
+    
+    def page_after(self, cursor: Optional[Tuple[int, int]], limit: int) -> List[Tuple[int, int]]:
+        """Up to ``limit`` (value, user_id) entries following ``cursor``, from the top without one"""
+        if cursor is None:
+            bucket, position = 0, 0
+        else:
+            bucket, position = self._find(*cursor)
+            if (bucket < len(self._maxes) and position < len(self._values[bucket])
+                    and self._user_ids[bucket][position] == cursor[1]
+                    and self._values[bucket][position] == -cursor[0]):
+                position += 1
+        
+        page = []
+        for entry in self._iter_from(bucket, position):
+            if len(page) >= limit:
+                break
+            page.append(entry)
+        return page
+    
+    def page_before(self, cursor: Tuple[int, int], limit: int) -> List[Tuple[int, int]]:
+        """Up to ``limit`` (value, user_id) entries preceding ``cursor``, in index order"""
+        bucket, position = self._find(*cursor)
+        if bucket == len(self._maxes):
+            bucket, position = len(self._maxes) - 1, len(self._values[-1]) if self._values else 0
+        
+        page = []
+        for entry in self._iter_back_from(bucket, position):
+            if len(page) >= limit:
+                break
+            page.append(entry)
+        page.reverse()
+        return page
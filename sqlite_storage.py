@@ -0,0 +1,993 @@
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from order_segments import OrderSegments
+from storage import FINAL_ORDER_STATUSES, SORT_FIELDS, UserRecord, refund_amount
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    balance INTEGER NOT NULL DEFAULT 0,
+    ads_watched INTEGER NOT NULL DEFAULT 0,
+    referral_code TEXT NOT NULL UNIQUE,
+    referred_by INTEGER,
+    referrals_count INTEGER NOT NULL DEFAULT 0,
+    join_date TEXT NOT NULL,
+    last_activity TEXT NOT NULL,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    last_ad_key TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_users_activity ON users (last_activity);
+
+CREATE TABLE IF NOT EXISTS referrals (
+    referrer_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    reward INTEGER NOT NULL,
+    PRIMARY KEY (referrer_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS orders (
+    order_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    video_link TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    total_cost INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance DESC, user_id);
+CREATE INDEX IF NOT EXISTS idx_users_referrals_count ON users (referrals_count DESC, user_id);
+CREATE INDEX IF NOT EXISTS idx_users_ads_watched ON users (ads_watched DESC, user_id);
+CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date DESC, user_id);
+
+CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at);
+-- Only the few orders whose final status is not known yet, found by the order status reconciler
+CREATE INDEX IF NOT EXISTS idx_orders_open ON orders (created_at, order_id)
+    WHERE status NOT IN ('completed', 'partial', 'canceled', 'failed');
+
+CREATE TABLE IF NOT EXISTS order_queue (
+    order_id TEXT PRIMARY KEY,
+    enqueued_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS ledger (
+    entry_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    reason TEXT NOT NULL,
+    key TEXT NOT NULL UNIQUE,
+    ref TEXT,
+    date TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id, entry_id);
+
+CREATE TABLE IF NOT EXISTS states (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+USER_COLUMNS = ("user_id", "username", "first_name", "balance", "ads_watched", "referral_code",
+                "referred_by", "referrals_count", "join_date", "last_activity", "blocked", "last_ad_key")
+# Values for user fields that older JSON snapshots may not have
+USER_DEFAULTS = {"blocked": False, "last_ad_key": None}
+ORDER_COLUMNS = ("order_id", "user_id", "video_link", "quantity", "total_cost", "status", "created_at")
+LEDGER_COLUMNS = ("entry_id", "user_id", "amount", "reason", "key", "ref", "date")
+
+class SQLiteUserDataStorage:
+    """UserDataStorage backed by SQLite in WAL mode, with the same public methods"""
+    
+    def __init__(self, filename: str = "user_data.db", activity_flush_interval: float = 60.0,
+                 referral_code_suffix: str = ""):
+        self.filename = filename
+        # Ends every new referral code, see UserDataStorage
+        self.referral_code_suffix = referral_code_suffix
+        self.activity_flush_interval = activity_flush_interval
+        
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._dirty_activity: Dict[int, str] = {}
+        
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Every commit is fsynced to the WAL, so a write that returned survives a power loss (see sync)
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript(SCHEMA)
+        self._upgrade_schema()
+        self._load_stats()
+        
+        if self.activity_flush_interval > 0:
+            threading.Thread(target=self._activity_flush_loop, name="storage-activity-flush", daemon=True).start()
+    
+    def _upgrade_schema(self):
+        """Add columns introduced after a database was created"""
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(users)")}
+        with self.conn:
+            if "blocked" not in columns:
+                self.conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+            if "last_ad_key" not in columns:
+                self.conn.execute("ALTER TABLE users ADD COLUMN last_ad_key TEXT")
+            
+            # Databases from before the ledger get one opening entry per balance
+            if self.conn.execute("SELECT 1 FROM ledger LIMIT 1").fetchone() is None:
+                self._open_ledger()
+    
+    def _open_ledger(self):
+        """Add an opening ledger entry for every non-zero balance without ledger entries"""
+        self.conn.execute(
+            "INSERT OR IGNORE INTO ledger (user_id, amount, reason, key, date) "
+            "SELECT user_id, balance, 'opening', 'opening:' || user_id, ? FROM users "
+            "WHERE balance != 0 AND NOT EXISTS (SELECT 1 FROM ledger WHERE ledger.user_id = users.user_id)",
+            (datetime.now().isoformat(),)
+        )
+    
+    def _post_entry(self, user_id: int, amount: int, reason: str, key: Optional[str], date: str,
+                    ref: Optional[str] = None) -> bool:
+        """Append a ledger entry and update the cached balance, unless the key was already used.
+        
+        A debit is conditional in SQL: the UPDATE only matches while the
+        balance covers it, and the ledger row is written only if it did.
+        """
+        key = key or uuid.uuid4().hex
+        if self.conn.execute("SELECT 1 FROM ledger WHERE key = ?", (key,)).fetchone() is not None:
+            return False
+        
+        if amount < 0:
+            cursor = self.conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ? AND balance >= ?",
+                                       (amount, user_id, -amount))
+            if cursor.rowcount != 1:
+                return False
+        else:
+            self.conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+        self.conn.execute(
+            "INSERT INTO ledger (user_id, amount, reason, key, ref, date) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, amount, reason, key, ref, date)
+        )
+        return True
+    
+    def _load_stats(self):
+        """Rebuild the running statistics that get_stats reads"""
+        users, total_balance, total_ads_watched = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(balance), 0), COALESCE(SUM(ads_watched), 0) FROM users"
+        ).fetchone()
+        self._stats = {
+            "total_users": users,
+            "total_orders": self.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0],
+            "total_referrals": self.conn.execute("SELECT COUNT(*) FROM referrals").fetchone()[0],
+            "total_balance": total_balance,
+            "total_ads_watched": total_ads_watched
+        }
+        
+        # Last active day of users active within the past week, and user count per day
+        week_start = (datetime.now().date() - timedelta(days=6)).isoformat()
+        self._active_days: Dict[int, str] = {}
+        self._activity_days: Counter = Counter()
+        for user_id, date in self.conn.execute(
+            "SELECT user_id, last_activity FROM users WHERE last_activity >= ?", (week_start,)
+        ):
+            self._active_days[user_id] = date[:10]
+            self._activity_days[date[:10]] += 1
+    
+    def _record_activity(self, user_id: int, day: str):
+        previous_day = self._active_days.get(user_id)
+        if previous_day == day:
+            return
+        
+        if previous_day is not None:
+            self._activity_days[previous_day] -= 1
+        self._active_days[user_id] = day
+        self._activity_days[day] += 1
+    
+    def _prune_activity(self):
+        """Forget activity older than a week"""
+        week_start = (datetime.now().date() - timedelta(days=6)).isoformat()
+        for day in [day for day in self._activity_days if day < week_start]:
+            del self._activity_days[day]
+        self._active_days = {user_id: day for user_id, day in self._active_days.items() if day >= week_start}
+    
+    def _activity_flush_loop(self):
+        """Flush buffered activity timestamps every activity_flush_interval seconds"""
+        while not self._closed.wait(self.activity_flush_interval):
+            try:
+                self.flush_activity()
+            except sqlite3.Error as e:
+                logging.error(f"Activity flush failed: {e}")
+    
+    def flush_activity(self):
+        """Persist all buffered last_activity updates in one transaction, and forget activity older than a week"""
+        with self._lock:
+            self._prune_activity()
+            if not self._dirty_activity:
+                return
+            
+            dirty, self._dirty_activity = self._dirty_activity, {}
+            with self.conn:
+                # A user who writes to the bot has unblocked it
+                self.conn.executemany(
+                    "UPDATE users SET last_activity = ?, blocked = 0 WHERE user_id = ?",
+                    [(date, user_id) for user_id, date in dirty.items()]
+                )
+    
+    def sync(self) -> Future:
+        """Future resolved once every change made so far is on disk, already the case once a write returns.
+        
+        With synchronous=FULL each commit fsyncs the WAL before returning.
+        """
+        future = Future()
+        future.set_result(None)
+        return future
+    
+    def compact(self):
+        """Checkpoint the WAL into the main database file"""
+        with self._lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    def close(self):
+        """Stop background work and flush everything to disk"""
+        if self._closed.is_set():
+            return
+        
+        self._closed.set()
+        self.flush_activity()
+        with self._lock:
+            self.conn.close()
+    
+    def create_user(self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None) -> bool:
+        """Create a new user if doesn't exist"""
+        now = datetime.now().isoformat()
+        
+        with self._lock, self.conn:
+            while True:
+                try:
+                    cursor = self.conn.execute(
+                        "INSERT OR IGNORE INTO users (user_id, username, first_name, referral_code, join_date, last_activity) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (user_id, username, first_name, str(uuid.uuid4())[:8] + self.referral_code_suffix, now, now)
+                    )
+                    if cursor.rowcount != 1:
+                        return False
+                    
+                    self._stats["total_users"] += 1
+                    self._record_activity(user_id, now[:10])
+                    return True
+                except sqlite3.IntegrityError:
+                    # Referral code collision, try another one
+                    continue
+    
+    def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get user data by ID"""
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            
+            user = dict(row)
+            if user_id in self._dirty_activity:
+                user["last_activity"] = self._dirty_activity[user_id]
+            return user
+    
+    def update_user_activity(self, user_id: int):
+        """Update user's last activity timestamp (persisted by the next flush_activity)"""
+        now = datetime.now().isoformat()
+        with self._lock:
+            self._dirty_activity[user_id] = now
+            self._record_activity(user_id, now[:10])
+    
+    def set_user_blocked(self, user_id: int, blocked: bool = True):
+        """Mark whether the user has blocked the bot, blocked users are skipped by broadcasts"""
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE users SET blocked = ? WHERE user_id = ?", (int(blocked), user_id))
+    
+    def add_balance(self, user_id: int, amount: int, reason: str = "admin", key: Optional[str] = None) -> bool:
+        """Add balance to user (amount in views), False if the user is unknown or key was already used"""
+        with self._lock, self.conn:
+            if self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is None:
+                return False
+            if not self._post_entry(user_id, amount, reason, key, datetime.now().isoformat()):
+                return False
+            
+            self._stats["total_balance"] += amount
+            return True
+    
+    def subtract_balance(self, user_id: int, amount: int, reason: str = "admin", key: Optional[str] = None) -> bool:
+        """Subtract balance from user if sufficient, False otherwise or if key was already used"""
+        with self._lock, self.conn:
+            if not self._post_entry(user_id, -amount, reason, key, datetime.now().isoformat()):
+                return False
+            
+            self._stats["total_balance"] -= amount
+            return True
+    
+    def add_ad_view(self, user_id: int, key: Optional[str] = None) -> int:
+        """Add ad view and return total views (every 10 views = reward).
+        
+        A repeated ``key`` (e.g. the same ad message clicked twice) is not counted again.
+        """
+        with self._lock, self.conn:
+            row = self.conn.execute("SELECT ads_watched, last_ad_key FROM users WHERE user_id = ?",
+                                    (user_id,)).fetchone()
+            if row is None:
+                return 0
+            if key is not None and row["last_ad_key"] == key:
+                return row["ads_watched"]
+            
+            ads_watched = self._apply_ad_view({"user_id": user_id, "key": key, "date": datetime.now().isoformat()})
+            self._stats["total_ads_watched"] += 1
+            if ads_watched % 10 == 0:
+                self._stats["total_balance"] += 1
+            return ads_watched
+    
+    def get_referral_link(self, user_id: int, bot_username: str) -> str:
+        """Get user's referral link"""
+        user = self.get_user(user_id)
+        if user:
+            referral_code = user["referral_code"]
+            return f"https://t.me/{bot_username}?start={referral_code}"
+        return ""
+    
+    def find_referrer(self, referral_code: str) -> Optional[int]:
+        """User ID owning a referral code, None if no user here has it"""
+        with self._lock:
+            row = self.conn.execute("SELECT user_id FROM users WHERE referral_code = ?", (referral_code,)).fetchone()
+            return row["user_id"] if row is not None else None
+    
+    def claim_referral(self, user_id: int, referrer_id: int) -> bool:
+        """Mark the user as referred by a referrer kept elsewhere, False if they already were"""
+        with self._lock, self.conn:
+            cursor = self.conn.execute("UPDATE users SET referred_by = ? WHERE user_id = ? AND referred_by IS NULL",
+                                       (referrer_id, user_id))
+            return cursor.rowcount > 0
+    
+    def credit_referral(self, referrer_id: int, user_id: int, reward: int = 100) -> bool:
+        """Reward the referrer of a user kept elsewhere, once per referred user"""
+        with self._lock, self.conn:
+            if self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (referrer_id,)).fetchone() is None:
+                return False
+            if not self._apply_referral_credit({
+                "user_id": user_id,
+                "referrer_id": referrer_id,
+                "reward": reward,
+                "date": datetime.now().isoformat()
+            }):
+                return False
+            
+            self._stats["total_referrals"] += 1
+            self._stats["total_balance"] += reward
+            return True
+    
+    def process_referral(self, user_id: int, referral_code: str) -> bool:
+        """Process referral when new user joins with code"""
+        with self._lock, self.conn:
+            row = self.conn.execute("SELECT user_id FROM users WHERE referral_code = ?", (referral_code,)).fetchone()
+            if row is None or row["user_id"] == user_id:
+                return False
+            
+            user = self.conn.execute("SELECT referred_by FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if user is None or user["referred_by"] is not None:
+                return False
+            
+            referrer_id = row["user_id"]
+            reward = 100
+            if not self._apply_referral({
+                "user_id": user_id,
+                "referrer_id": referrer_id,
+                "reward": reward,
+                "date": datetime.now().isoformat()
+            }):
+                return False
+            
+            self._stats["total_referrals"] += 1
+            self._stats["total_balance"] += reward
+            return True
+    
+    def create_order(self, user_id: int, video_link: str, quantity: int, total_cost: int) -> str:
+        """Create a new order"""
+        order_id = str(uuid.uuid4())[:12]
+        
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO orders (order_id, user_id, video_link, quantity, total_cost, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, 'pending', ?)",
+                (order_id, user_id, video_link, quantity, total_cost, datetime.now().isoformat())
+            )
+            self._stats["total_orders"] += 1
+        return order_id
+    
+    def reserve_order(self, user_id: int, video_link: str, quantity: int, key: Optional[str] = None) -> Optional[str]:
+        """Hold the order cost from the user's balance and queue the order for dispatch.
+        
+        Retrying with the same ``key`` returns the order placed the first time.
+        """
+        order_id = str(uuid.uuid4())[:12]
+        now = datetime.now().isoformat()
+        
+        with self._lock, self.conn:
+            if key is not None:
+                row = self.conn.execute("SELECT ref FROM ledger WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    return row["ref"]
+            
+            if not self._apply_reserve_order({
+                "key": key or f"order:{order_id}",
+                "order": {
+                    "order_id": order_id,
+                    "user_id": user_id,
+                    "video_link": video_link,
+                    "quantity": quantity,
+                    "total_cost": quantity,
+                    "status": "pending",
+                    "created_at": now
+                }
+            }):
+                return None
+            self._stats["total_orders"] += 1
+            self._stats["total_balance"] -= quantity
+        return order_id
+    
+    def get_order(self, order_id: str) -> Optional[Dict[str, Any]]:
+        """Get an order by ID"""
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            return dict(row) if row else None
+    
+    def get_queued_orders(self) -> list:
+        """Get reserved orders that have not been dispatched yet, oldest first"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT orders.* FROM order_queue JOIN orders USING (order_id) ORDER BY order_queue.rowid"
+            ).fetchall()
+            return [dict(row) for row in rows]
+    
+    def get_open_orders(self, limit: Optional[int] = None, after: Optional[str] = None) -> list:
+        """Get dispatched orders not final yet oldest first, at most ``limit``, only those after the order ID ``after``"""
+        # Same condition as idx_orders_open, so the query is served by it
+        query = ("SELECT * FROM orders WHERE status NOT IN ('completed', 'partial', 'canceled', 'failed')"
+                 " AND order_id NOT IN (SELECT order_id FROM order_queue)")
+        params: List[Any] = []
+        if after is not None:
+            query += " AND (created_at, order_id) > (SELECT created_at, order_id FROM orders WHERE order_id = ?)"
+            params.append(after)
+        query += " ORDER BY created_at, order_id LIMIT ?"
+        params.append(limit if limit is not None else -1)
+        
+        with self._lock:
+            return [dict(row) for row in self.conn.execute(query, params).fetchall()]
+    
+    def update_order_statuses(self, statuses: Dict[str, str], remains: Optional[Dict[str, int]] = None):
+        """Set the status of several orders in one transaction, refunding open orders that failed or were canceled.
+        
+        ``remains`` gives the views an order with status ``partial`` did not
+        get, their share of the cost is refunded.
+        """
+        if not statuses:
+            return
+        
+        with self._lock, self.conn:
+            self._stats["total_balance"] += self._apply_order_status(
+                {"statuses": statuses, "remains": remains or {}, "date": datetime.now().isoformat()}
+            )
+    
+    def get_user_orders(self, user_id: int, limit: Optional[int] = None, before: Optional[str] = None) -> list:
+        """Get a user's orders newest first, at most ``limit``, only those placed before the order ID ``before``"""
+        query = "SELECT * FROM orders WHERE user_id = ?"
+        params: List[Any] = [user_id]
+        if before is not None:
+            query += " AND (created_at, order_id) < (SELECT created_at, order_id FROM orders WHERE order_id = ?)"
+            params.append(before)
+        query += " ORDER BY created_at DESC, order_id DESC LIMIT ?"
+        params.append(limit if limit is not None else -1)
+        
+        with self._lock:
+            return [dict(row) for row in self.conn.execute(query, params).fetchall()]
+    
+    def get_orders_between(self, start: str, end: str, user_id: Optional[int] = None,
+                           limit: Optional[int] = None, after: Optional[str] = None) -> list:
+        """Get orders created from ``start`` up to, not including, ``end`` (ISO dates or timestamps), oldest first.
+        
+        Optionally only a user's orders, at most ``limit``, only those following the order ID ``after``.
+        """
+        query = "SELECT * FROM orders WHERE created_at >= ? AND created_at < ?"
+        params: List[Any] = [start, end]
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        if after is not None:
+            query += " AND (created_at, order_id) > (SELECT created_at, order_id FROM orders WHERE order_id = ?)"
+            params.append(after)
+        query += " ORDER BY created_at, order_id LIMIT ?"
+        params.append(limit if limit is not None else -1)
+        
+        with self._lock:
+            return [dict(row) for row in self.conn.execute(query, params).fetchall()]
+    
+    def get_ledger(self, user_id: int, limit: int = 20, before: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get a user's ledger entries newest first, only those with entry_id below ``before`` if given"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM ledger WHERE user_id = ? AND entry_id < ? ORDER BY entry_id DESC LIMIT ?",
+                (user_id, before if before is not None else 1 << 62, limit)
+            ).fetchall()
+            return [dict(row) for row in rows]
+    
+    def reconcile_balances(self) -> Dict[int, Tuple[int, int]]:
+        """Compare cached balances with ledger totals, returns {user_id: (cached, ledger)} for mismatches"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT users.user_id, users.balance, COALESCE(totals.amount, 0) FROM users "
+                "LEFT JOIN (SELECT user_id, SUM(amount) AS amount FROM ledger GROUP BY user_id) AS totals "
+                "USING (user_id) WHERE users.balance != COALESCE(totals.amount, 0)"
+            ).fetchall()
+            return {user_id: (cached, total) for user_id, cached, total in rows}
+    
+    def load_states(self, name: str) -> Dict[str, Tuple[Any, float]]:
+        """Get the persisted entries of a StateStore table"""
+        with self._lock:
+            rows = self.conn.execute("SELECT key, value, expires_at FROM states WHERE name = ?", (name,)).fetchall()
+            return {row["key"]: (json.loads(row["value"]), row["expires_at"]) for row in rows}
+    
+    def save_state(self, name: str, key: str, value: Any, expires_at: float):
+        """Persist one StateStore entry"""
+        with self._lock, self.conn:
+            self._apply_state_set({"name": name, "key": key, "value": value, "expires_at": expires_at})
+    
+    def delete_states(self, name: str, keys: List[str]):
+        """Remove persisted StateStore entries"""
+        with self._lock, self.conn:
+            self._apply_state_delete({"name": name, "keys": keys})
+    
+    def get_all_users(self) -> Dict[str, Any]:
+        """Get all users"""
+        with self._lock:
+            rows = self.conn.execute("SELECT * FROM users ORDER BY rowid").fetchall()
+            return {str(row["user_id"]): dict(row) for row in rows}
+    
+    def _iter_table(self, table: str, batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Stream the rows of a table in rowid order, holding the lock one batch at a time"""
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    f"SELECT rowid AS _rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            
+            last_rowid = rows[-1]["_rowid"]
+            for row in rows:
+                item = dict(row)
+                del item["_rowid"]
+                yield item
+    
+    def iter_users(self) -> Iterator[Dict[str, Any]]:
+        """Stream every user as a dict"""
+        for user in self._iter_table("users"):
+            user["last_activity"] = self._dirty_activity.get(user["user_id"], user["last_activity"])
+            user["blocked"] = bool(user["blocked"])
+            yield user
+    
+    def iter_orders(self) -> Iterator[Dict[str, Any]]:
+        """Stream every order"""
+        return self._iter_table("orders")
+    
+    def iter_referrals(self) -> Iterator[Dict[str, Any]]:
+        """Stream every referral as {referrer_id, user_id, date, reward}"""
+        return self._iter_table("referrals")
+    
+    def get_users_page(self, sort: str, limit: int = 10, after: Optional[int] = None,
+                       before: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get users ordered by ``sort`` (one of SORT_FIELDS) highest first, ties by user ID.
+        
+        Pages follow the user ID ``after`` or precede the user ID ``before``,
+        from the top without either. Each page is read from the field's index.
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"Cannot sort users by {sort}")
+        
+        with self._lock:
+            cursor_id = before if before is not None else after
+            row = self.conn.execute(f"SELECT {sort} FROM users WHERE user_id = ?", (cursor_id,)).fetchone() \
+                if cursor_id is not None else None
+            if row is None:
+                rows = self.conn.execute(
+                    f"SELECT * FROM users ORDER BY {sort} DESC, user_id LIMIT ?", (limit,)
+                ).fetchall()
+                return [dict(row) for row in rows]
+            
+            # Ties with the cursor first, then the rest of the index in the same direction
+            value = row[0]
+            if before is not None:
+                queries = (
+                    (f"SELECT * FROM users WHERE {sort} = ? AND user_id < ? ORDER BY user_id DESC LIMIT ?",
+                     (value, cursor_id)),
+                    (f"SELECT * FROM users WHERE {sort} > ? ORDER BY {sort}, user_id DESC LIMIT ?", (value,)),
+                )
+            else:
+                queries = (
+                    (f"SELECT * FROM users WHERE {sort} = ? AND user_id > ? ORDER BY user_id LIMIT ?",
+                     (value, cursor_id)),
+                    (f"SELECT * FROM users WHERE {sort} < ? ORDER BY {sort} DESC, user_id LIMIT ?", (value,)),
+                )
+            
+            rows = []
+            for query, params in queries:
+                if len(rows) < limit:
+                    rows.extend(self.conn.execute(query, params + (limit - len(rows),)).fetchall())
+            if before is not None:
+                rows.reverse()
+            return [dict(row) for row in rows]
+    
+    def sort_indexes_ready(self) -> bool:
+        """Whether get_users_page answers without waiting, always: the indexes are in the database"""
+        return True
+    
+    def get_broadcast_recipients(self) -> List[int]:
+        """Get IDs of users who have not blocked the bot, in ascending order"""
+        with self._lock:
+            rows = self.conn.execute("SELECT user_id FROM users WHERE blocked = 0 ORDER BY user_id").fetchall()
+            return [row[0] for row in rows]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get general statistics from the running counters"""
+        today = datetime.now().date()
+        with self._lock:
+            active_users_week = sum(
+                self._activity_days.get((today - timedelta(days=days_ago)).isoformat(), 0)
+                for days_ago in range(7)
+            )
+            
+            return {
+                **self._stats,
+                "active_users_today": self._activity_days.get(today.isoformat(), 0),
+                "active_users_week": active_users_week
+            }
+    
+    # Journal records written by the JSON backend, replayed by the migrator.
+    # Users touched by a record are always reset first (by the snapshot or by
+    # create_user), so re-running a migration never double-applies a record.
+    
+    def _apply(self, record: Dict[str, Any]):
+        getattr(self, f"_apply_{record['op']}")(record)
+    
+    def _apply_create_user(self, record: Dict[str, Any]):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, username, first_name, referral_code, join_date, last_activity) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (record["user_id"], record["username"], record["first_name"], record["referral_code"],
+             record["date"], record["date"])
+        )
+    
+    def _apply_activity_batch(self, record: Dict[str, Any]):
+        self.conn.executemany(
+            "UPDATE users SET last_activity = ? WHERE user_id = ?",
+            [(date, int(user_id)) for user_id, date in record["users"].items()]
+        )
+    
+    def _apply_blocked(self, record: Dict[str, Any]):
+        self.conn.execute("UPDATE users SET blocked = ? WHERE user_id = ?",
+                          (int(record["blocked"]), record["user_id"]))
+    
+    def _apply_balance(self, record: Dict[str, Any]):
+        self._post_entry(record["user_id"], record["amount"], record.get("reason", "admin"), record.get("key"),
+                         record.get("date", datetime.now().isoformat()))
+    
+    def _apply_ad_view(self, record: Dict[str, Any]) -> int:
+        """Count an ad view, returns the user's new ads_watched"""
+        user_id = record["user_id"]
+        key = record.get("key")
+        row = self.conn.execute("SELECT ads_watched, last_ad_key FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if key is not None and row["last_ad_key"] == key:
+            return row["ads_watched"]
+        
+        ads_watched = row["ads_watched"] + 1
+        self.conn.execute("UPDATE users SET ads_watched = ?, last_ad_key = COALESCE(?, last_ad_key) WHERE user_id = ?",
+                          (ads_watched, key, user_id))
+        
+        # Every 10 ad views = 1 view reward
+        if ads_watched % 10 == 0:
+            self._post_entry(user_id, 1, "ad_reward", f"ad_reward:{user_id}:{ads_watched}",
+                             record.get("date", datetime.now().isoformat()))
+        return ads_watched
+    
+    def _apply_referral(self, record: Dict[str, Any]) -> bool:
+        """Record a referral and reward the referrer, False if this user was already referred"""
+        if not self._apply_referral_credit(record):
+            return False
+        
+        self.conn.execute("UPDATE users SET referred_by = ? WHERE user_id = ?",
+                          (record["referrer_id"], record["user_id"]))
+        return True
+    
+    def _apply_referral_credit(self, record: Dict[str, Any]) -> bool:
+        # Give referrer the reward, once per referred user
+        if not self._post_entry(record["referrer_id"], record["reward"], "referral", f"referral:{record['user_id']}",
+                                record["date"], ref=str(record["user_id"])):
+            return False
+        
+        self.conn.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?",
+                          (record["referrer_id"],))
+        self.conn.execute(
+            "INSERT OR IGNORE INTO referrals (referrer_id, user_id, date, reward) VALUES (?, ?, ?, ?)",
+            (record["referrer_id"], record["user_id"], record["date"], record["reward"])
+        )
+        return True
+    
+    def _apply_create_order(self, record: Dict[str, Any]):
+        order = record["order"]
+        self.conn.execute(
+            f"INSERT OR IGNORE INTO orders ({', '.join(ORDER_COLUMNS)}) VALUES ({', '.join('?' * len(ORDER_COLUMNS))})",
+            tuple(order[column] for column in ORDER_COLUMNS)
+        )
+    
+    def _apply_reserve_order(self, record: Dict[str, Any]) -> bool:
+        """Debit the order cost and queue the order, False with nothing changed if the debit was not made"""
+        order = record["order"]
+        if not self._post_entry(order["user_id"], -order["total_cost"], "order",
+                                record.get("key", f"order:{order['order_id']}"), order["created_at"],
+                                ref=order["order_id"]):
+            return False
+        self._apply_create_order(record)
+        self.conn.execute("INSERT OR IGNORE INTO order_queue (order_id, enqueued_at) VALUES (?, ?)",
+                          (order["order_id"], order["created_at"]))
+        return True
+    
+    def _apply_order_status(self, record: Dict[str, Any]) -> int:
+        """Update order statuses, returns the total amount refunded"""
+        refunded = 0
+        remains = record.get("remains", {})
+        for order_id, status in record["statuses"].items():
+            order = self.conn.execute(
+                "SELECT user_id, quantity, total_cost, status FROM orders WHERE order_id = ?", (order_id,)
+            ).fetchone()
+            if order is None:
+                continue
+            
+            self.conn.execute("DELETE FROM order_queue WHERE order_id = ?", (order_id,))
+            if status in FINAL_ORDER_STATUSES and order["status"] not in FINAL_ORDER_STATUSES:
+                refund = refund_amount(order, status, remains.get(order_id))
+                if refund and self._post_entry(order["user_id"], refund, "refund", f"refund:{order_id}",
+                                               record.get("date", datetime.now().isoformat()), ref=order_id):
+                    refunded += refund
+            self.conn.execute("UPDATE orders SET status = ? WHERE order_id = ?", (status, order_id))
+        return refunded
+    
+    def _apply_state_set(self, record: Dict[str, Any]):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO states (name, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (record["name"], record["key"], json.dumps(record["value"]), record["expires_at"])
+        )
+    
+    def _apply_state_delete(self, record: Dict[str, Any]):
+        self.conn.executemany("DELETE FROM states WHERE name = ? AND key = ?",
+                              [(record["name"], key) for key in record["keys"]])
+
+class _JSONStream:
+    """Incremental reader for a JSON document, decoding one value at a time"""
+    
+    def __init__(self, file, chunk_size: int = 1 << 16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+    
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+    
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+    
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos} of the JSON buffer")
+        self.pos += 1
+    
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value ending exactly at the buffer edge may be a truncated number
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+    
+    def members(self) -> Iterator[str]:
+        """Iterate the keys of an object, leaving each value to be read next"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("}")
+            return
+    
+    def items(self) -> Iterator[Any]:
+        """Iterate the items of an array"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("]")
+            return
+
+def iter_json_data(filename: str) -> Iterator[Tuple[str, Optional[str], Any]]:
+    """Stream (section, key, value) entries from a user_data.json document"""
+    with open(filename, 'r', encoding='utf-8') as file:
+        stream = _JSONStream(file)
+        for section in stream.members():
+            if section == "users" and stream.peek() == "[":
+                # User rows in USER_FIELDS order, as written by UserDataStorage
+                for row in stream.items():
+                    yield section, None, UserRecord.from_row(row).to_dict()
+            elif section in ("users", "referrals", "order_queue", "states"):
+                for key in stream.members():
+                    yield section, key, stream.value()
+            elif section in ("orders", "ledger"):
+                for item in stream.items():
+                    yield section, None, item
+            else:
+                yield section, None, stream.value()
+
+def migrate_json_to_sqlite(json_filename: str = "user_data.json", db_filename: str = "user_data.db",
+                           batch_size: int = 1000) -> Dict[str, int]:
+    """Copy a JSON storage snapshot and its journal into a SQLite database.
+    
+    The snapshot is streamed in batches, so memory use does not grow with the
+    data size. Users are upserted and journal records replayed on top, so the
+    migration can be run against a live bot and re-run right before switching
+    STORAGE_BACKEND to catch up.
+    """
+    storage = SQLiteUserDataStorage(db_filename, activity_flush_interval=0)
+    conn = storage.conn
+    counts = {"users": 0, "referrals": 0, "orders": 0, "order_queue": 0, "states": 0, "ledger": 0, "journal": 0}
+    snapshot_seq = 0
+    batches: Dict[str, List[tuple]] = {
+        "users": [], "referrals": [], "orders": [], "order_queue": [], "states": [], "ledger": []
+    }
+    statements = {
+        "users": f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+                 f"VALUES ({', '.join('?' * len(USER_COLUMNS))})",
+        "referrals": "INSERT OR IGNORE INTO referrals (referrer_id, user_id, date, reward) VALUES (?, ?, ?, ?)",
+        "orders": f"INSERT OR REPLACE INTO orders ({', '.join(ORDER_COLUMNS)}) "
+                  f"VALUES ({', '.join('?' * len(ORDER_COLUMNS))})",
+        "order_queue": "INSERT OR IGNORE INTO order_queue (order_id, enqueued_at) VALUES (?, ?)",
+        "states": "INSERT OR REPLACE INTO states (name, key, value, expires_at) VALUES (?, ?, ?, ?)",
+        "ledger": f"INSERT INTO ledger ({', '.join(LEDGER_COLUMNS)}) VALUES ({', '.join('?' * len(LEDGER_COLUMNS))})",
+    }
+    
+    # The queue, states, ledger and the balances cached from it are rebuilt
+    # from the snapshot and journal on every run
+    with conn:
+        conn.execute("DELETE FROM order_queue")
+        conn.execute("DELETE FROM states")
+        conn.execute("DELETE FROM ledger")
+        conn.execute("UPDATE users SET balance = 0")
+    
+    def flush(section: str):
+        with conn:
+            conn.executemany(statements[section], batches[section])
+        counts[section] += len(batches[section])
+        batches[section] = []
+    
+    # Orders sealed into monthly segments go first, so the snapshot copy wins after an interrupted compaction
+    for order in OrderSegments(json_filename + ".orders").iter_orders():
+        batches["orders"].append(tuple(order[column] for column in ORDER_COLUMNS))
+        if len(batches["orders"]) >= batch_size:
+            flush("orders")
+    
+    for section, key, value in iter_json_data(json_filename):
+        if section == "users":
+            batches["users"].append(tuple(value.get(column, USER_DEFAULTS.get(column)) for column in USER_COLUMNS))
+        elif section == "referrals":
+            batches["referrals"].extend(
+                (int(key), referral["user_id"], referral["date"], referral["reward"]) for referral in value
+            )
+        elif section == "orders":
+            batches["orders"].append(tuple(value[column] for column in ORDER_COLUMNS))
+        elif section == "order_queue":
+            batches["order_queue"].append((key, value))
+        elif section == "states":
+            batches["states"].extend(
+                (key, state_key, json.dumps(state_value), expires_at)
+                for state_key, (state_value, expires_at) in value.items()
+            )
+        elif section == "ledger":
+            batches["ledger"].append(tuple(value[column] for column in LEDGER_COLUMNS))
+        elif section == "journal_seq":
+            snapshot_seq = value
+            continue
+        else:
+            continue
+        
+        if len(batches[section]) >= batch_size:
+            flush(section)
+    
+    for section in batches:
+        flush(section)
+    
+    # Snapshots from before the ledger carry balances without entries
+    with conn:
+        storage._open_ledger()
+    
+    # Replay journal records written since the snapshot, oldest first
+    for journal_filename in (json_filename + ".journal.old", json_filename + ".journal"):
+        try:
+            journal = open(journal_filename, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        
+        with journal, conn:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record["seq"] > snapshot_seq:
+                    storage._apply(record)
+                    counts["journal"] += 1
+    
+    storage.close()
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate user_data.json into a SQLite database")
+    parser.add_argument("json_filename", nargs="?", default="user_data.json")
+    parser.add_argument("db_filename", nargs="?", default="user_data.db")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    
+    counts = migrate_json_to_sqlite(args.json_filename, args.db_filename, args.batch_size)
+    print(f"✅ Migrated {counts['users']} users, {counts['referrals']} referrals, {counts['orders']} orders, "
+          f"{counts['ledger']} ledger entries and {counts['journal']} journal records")
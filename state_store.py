@@ -0,0 +1,110 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+_MISSING = object()
+
+class StateStore:
+    """Per-user table with expiry and a size cap, optionally persisted to storage.
+    
+    Entries expire ``ttl`` seconds after they were last set. When the table
+    holds ``max_entries`` entries the least recently used one is evicted.
+    With a ``backend`` (a UserDataStorage or SQLiteUserDataStorage) every
+    change is written through, and unexpired entries are loaded back at
+    startup, so conversations and cooldowns survive a restart.
+    """
+    
+    def __init__(self, name: str, ttl: float, max_entries: int = 100000, backend=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        
+        # user_id -> (value, expires_at), least recently used first
+        self._entries: "OrderedDict[int, Tuple[Any, float]]" = OrderedDict()
+        
+        if backend is not None:
+            self._load()
+    
+    def _load(self):
+        now = time.time()
+        expired = []
+        entries = sorted(self.backend.load_states(self.name).items(), key=lambda item: item[1][1])
+        for key, (value, expires_at) in entries:
+            if expires_at <= now:
+                expired.append(key)
+            else:
+                self._entries[int(key)] = (value, expires_at)
+        
+        # Keep the entries that expire last if the cap shrank since they were saved
+        while len(self._entries) > self.max_entries:
+            expired.append(str(self._entries.popitem(last=False)[0]))
+        
+        if expired:
+            self.backend.delete_states(self.name, expired)
+    
+    def get(self, key: int, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        
+        value, expires_at = entry
+        if expires_at <= time.time():
+            self._delete(key)
+            return default
+        
+        self._entries.move_to_end(key)
+        return value
+    
+    def set(self, key: int, value: Any, ttl: Optional[float] = None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        
+        if self.backend is not None:
+            self.backend.save_state(self.name, str(key), value, expires_at)
+        
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(str(self._entries.popitem(last=False)[0]))
+        if evicted and self.backend is not None:
+            self.backend.delete_states(self.name, evicted)
+    
+    def pop(self, key: int, default: Any = None) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        
+        self._delete(key)
+        return value
+    
+    def expire(self) -> int:
+        """Drop every expired entry, returns how many were removed"""
+        now = time.time()
+        expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        
+        if expired and self.backend is not None:
+            self.backend.delete_states(self.name, [str(key) for key in expired])
+        return len(expired)
+    
+    def _delete(self, key: int):
+        del self._entries[key]
+        if self.backend is not None:
+            self.backend.delete_states(self.name, [str(key)])
+    
+    def __contains__(self, key: int) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+    
+    def __getitem__(self, key: int) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key: int, value: Any):
+        self.set(key, value)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,13 +1,265 @@
+import bisect
+import heapq
+import itertools
 import json
 import os
-from datetime import datetime
-from typing import Dict, Any, Optional
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 import uuid
+from array import array
+
+import metrics
+from journal_writer import JournalWriter
+from ledger_segments import LedgerSegments
+from order_segments import OrderSegments
+from snapshot import BinarySnapshot, code_key, decode_user, encode_user, write_snapshot
+from sorted_index import SortedIndex
+
+# Field order of UserRecord, also the order of the values in snapshot user rows
+USER_FIELDS = ("user_id", "username", "first_name", "balance", "ads_watched", "referral_code", "referred_by",
+               "referrals_count", "join_date", "last_activity", "blocked", "last_ad_key")
+
+# Fields get_users_page can order users by, highest first
+SORT_FIELDS = ("balance", "referrals_count", "ads_watched", "join_date")
+
+# Order statuses that never change again, orders in any other status are still open
+FINAL_ORDER_STATUSES = ("completed", "partial", "canceled", "failed")
+
+def refund_amount(order: Dict[str, Any], status: str, remains: Optional[int] = None) -> int:
+    """Views of an order refunded when it ends up with ``status``, ``remains`` of them not delivered"""
+    if status in ("failed", "canceled"):
+        return order["total_cost"]
+    if status == "partial" and remains and order["quantity"]:
+        return order["total_cost"] * min(remains, order["quantity"]) // order["quantity"]
+    return 0
+
+def to_epoch(date: str) -> int:
+    """Convert a local ISO timestamp (as written by datetime.now().isoformat()) to epoch seconds"""
+    return int(datetime.fromisoformat(date).timestamp())
+
+def from_epoch(timestamp: int) -> str:
+    """Convert epoch seconds to a local ISO timestamp"""
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+def epoch_day(timestamp: int) -> str:
+    """Local date of epoch seconds as YYYY-MM-DD"""
+    return datetime.fromtimestamp(timestamp).date().isoformat()
+
+class UserRecord:
+    """A user held in memory: slotted attributes and epoch-second timestamps.
+    
+    Takes a fraction of the memory of the equivalent dict with ISO date
+    strings. ``to_dict`` gives the dict form handed out by get_user.
+    """
+    
+    __slots__ = USER_FIELDS
+    
+    def __init__(self, user_id: int, username: Optional[str], first_name: Optional[str], balance: int = 0,
+                 ads_watched: int = 0, referral_code: str = "", referred_by: Optional[int] = None,
+                 referrals_count: int = 0, join_date: int = 0, last_activity: int = 0, blocked: bool = False,
+                 last_ad_key: Optional[str] = None):
+        self.user_id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.balance = balance  # Balance in views
+        self.ads_watched = ads_watched
+        self.referral_code = referral_code
+        self.referred_by = referred_by
+        self.referrals_count = referrals_count
+        self.join_date = join_date
+        self.last_activity = last_activity
+        self.blocked = blocked
+        self.last_ad_key = last_ad_key
+    
+    @classmethod
+    def from_row(cls, row: List[Any]) -> "UserRecord":
+        return cls(*row)
+    
+    @classmethod
+    def from_dict(cls, user: Dict[str, Any]) -> "UserRecord":
+        """Build a record from the dict form, as found in snapshots written before user rows"""
+        return cls(
+            user["user_id"], user["username"], user["first_name"], user["balance"], user["ads_watched"],
+            user["referral_code"], user["referred_by"], user["referrals_count"], to_epoch(user["join_date"]),
+            to_epoch(user["last_activity"]), user.get("blocked", False), user.get("last_ad_key")
+        )
+    
+    def to_row(self) -> List[Any]:
+        return [getattr(self, field) for field in USER_FIELDS]
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "user_id": self.user_id,
+            "username": self.username,
+            "first_name": self.first_name,
+            "balance": self.balance,
+            "ads_watched": self.ads_watched,
+            "referral_code": self.referral_code,
+            "referred_by": self.referred_by,
+            "referrals_count": self.referrals_count,
+            "join_date": from_epoch(self.join_date),
+            "last_activity": from_epoch(self.last_activity),
+            "blocked": self.blocked,
+            "last_ad_key": self.last_ad_key
+        }
+
+class LazyUsers:
+    """user_id -> UserRecord backed by a BinarySnapshot, decoding each record on first access.
+    
+    Decoded records stay cached and take all later changes, the snapshot is
+    never written to. Iterating decodes the records that are not cached yet
+    on the fly without keeping them, so it is only meant for reading.
+    """
+    
+    def __init__(self, snapshot: Optional[BinarySnapshot]):
+        self.snapshot = snapshot
+        self._loaded: Dict[int, UserRecord] = {}
+        # Users created since the snapshot was written
+        self._added: set = set()
+    
+    def get(self, user_id: int, default: Any = None) -> Any:
+        user = self._loaded.get(user_id)
+        if user is not None:
+            return user
+        
+        snapshot = self.snapshot
+        row = snapshot.find_user(user_id) if snapshot is not None else None
+        if row is None:
+            return default
+        # Another thread may have decoded the same record meanwhile, keep a single copy
+        return self._loaded.setdefault(user_id, UserRecord.from_row(row))
+    
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+    
+    def __getitem__(self, user_id: int) -> UserRecord:
+        user = self.get(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+    
+    def __setitem__(self, user_id: int, user: UserRecord):
+        if user_id not in self:
+            self._added.add(user_id)
+        self._loaded[user_id] = user
+    
+    def __len__(self) -> int:
+        return (self.snapshot.user_count if self.snapshot is not None else 0) + len(self._added)
+    
+    def values(self):
+        if self.snapshot is not None:
+            for row in self.snapshot.rows():
+                yield self._loaded.get(row[0]) or UserRecord.from_row(row)
+        for user_id in sorted(self._added):
+            yield self._loaded[user_id]
+    
+    def items(self):
+        for user in self.values():
+            yield user.user_id, user
+    
+    def reopen(self, snapshot: BinarySnapshot, written: set):
+        """Switch to a newer snapshot that includes the ``written`` users created before it was taken"""
+        self.snapshot = snapshot
+        self._added -= written
+
+class LazyReferralCodes:
+    """referral_code -> user_id looked up in a BinarySnapshot, plus the codes of users created since"""
+    
+    def __init__(self, snapshot: Optional[BinarySnapshot]):
+        self.snapshot = snapshot
+        self._added: Dict[str, int] = {}
+    
+    def get(self, referral_code: str, default: Any = None) -> Any:
+        user_id = self._added.get(referral_code)
+        if user_id is None and self.snapshot is not None:
+            user_id = self.snapshot.find_referral(referral_code)
+        return default if user_id is None else user_id
+    
+    def __contains__(self, referral_code: str) -> bool:
+        return self.get(referral_code) is not None
+    
+    def __setitem__(self, referral_code: str, user_id: int):
+        self._added[referral_code] = user_id
+    
+    def reopen(self, snapshot: BinarySnapshot, written: set):
+        self.snapshot = snapshot
+        self._added = {code: user_id for code, user_id in self._added.items() if user_id not in written}
 
 class UserDataStorage:
-    def __init__(self, filename: str = "user_data.json"):
+    def __init__(self, filename: str = "user_data.json", journal: bool = False,
+                 compact_every: int = 1000, compact_interval: float = 300.0,
+                 activity_flush_interval: float = 60.0, binary: bool = False, referral_code_suffix: str = ""):
+        """Storage in a JSON snapshot file, or with ``binary`` in a memory-mapped
+        binary snapshot (see snapshot.py) whose users are decoded on first access.
+        ``referral_code_suffix`` ends every new referral code (a shard's one)."""
         self.filename = filename
-        self.data = self._load_data()
+        self.referral_code_suffix = referral_code_suffix
+        self.binary = binary
+        self.journal = journal
+        self.journal_filename = filename + ".journal"
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self.activity_flush_interval = activity_flush_interval
+        
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._compact_wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._journal: Optional[JournalWriter] = None
+        self._journal_records = 0
+        
+        # Without a journal: whether data changed since the last snapshot, and the
+        # futures of commits waiting for the next snapshot or the one being written
+        self._dirty = False
+        self._waiters: List[Future] = []
+        self._inflight: Optional[List[Future]] = None
+        # While a snapshot is written: rows of users changed since it started, by
+        # user_id, and users referred since (see _begin_snapshot)
+        self._preimages: Optional[Dict[int, List[Any]]] = None
+        self._new_referrals: Optional[set] = None
+        
+        # Write-behind buffer of last_activity timestamps not yet persisted
+        self._dirty_activity: Dict[str, str] = {}
+        
+        if self.binary:
+            reader = BinarySnapshot(filename) if os.path.exists(filename) else None
+            self.data = reader.data if reader is not None else {"referrals": {}, "orders": []}
+            self._users = LazyUsers(reader)
+            # Ledger entries in the snapshot, those posted since are in self.data["ledger"]
+            self._ledger_snapshot = reader.ledger if reader is not None else None
+        else:
+            self.data = self._load_data()
+            self._users = self._load_users(self.data.pop("users"))
+            self._ledger_snapshot = None
+        self._seq = self.data.get("journal_seq", 0)
+        # Orders from past months, moved out of the snapshot by seal_orders
+        self._order_segments = OrderSegments(filename + ".orders")
+        # Ledger entries of past months, moved out of the snapshot by seal_ledger. The
+        # snapshot records the last entry_id sealed: entries sealed after it was written
+        # are still in it, or in the journal. Without that record (no snapshot yet, or
+        # one that could not be read) the segments are kept as they are.
+        self._ledger_segments = LedgerSegments(filename + ".ledger")
+        self._ledger_sealed = self.data.pop("ledger_sealed", None)
+        if self._ledger_sealed is None:
+            self._ledger_sealed = self._ledger_segments.last_id
+        else:
+            self._ledger_segments.truncate(self._ledger_sealed)
+        self._build_indexes()
+        
+        if self.journal:
+            self._open_journal()
+        self.seal_orders()
+        self.seal_ledger()
+        
+        threading.Thread(target=self._compaction_loop, name="storage-snapshots", daemon=True).start()
+        threading.Thread(target=self._build_sort_indexes, name="storage-sort-indexes", daemon=True).start()
+        if self.activity_flush_interval > 0:
+            threading.Thread(target=self._activity_flush_loop, name="storage-activity-flush", daemon=True).start()
     
     def _load_data(self) -> Dict[str, Any]:
         """Load data from JSON file, create if doesn't exist"""
@@ -17,7 +269,7 @@ class UserDataStorage:
                 "referrals": {},
                 "orders": []
             }
-            self._save_data(initial_data)
+            self._write_file(self.filename, json.dumps(initial_data).encode('utf-8'))
             return initial_data
         
         try:
@@ -26,129 +278,841 @@ class UserDataStorage:
         except (json.JSONDecodeError, FileNotFoundError):
             return {"users": {}, "referrals": {}, "orders": []}
     
-    def _save_data(self, data: Optional[Dict[str, Any]] = None):
-        """Save data to JSON file"""
-        if data is None:
-            data = self.data
+    def _load_users(self, users: Any) -> Dict[int, UserRecord]:
+        """Turn the users of a snapshot (rows, or dicts keyed by ID string in older snapshots) into records"""
+        if isinstance(users, dict):
+            return {user["user_id"]: UserRecord.from_dict(user) for user in users.values()}
+        return {row[0]: UserRecord.from_row(row) for row in users}
+    
+    def _write_file(self, filename: str, payload: bytes) -> int:
+        """Atomically replace ``filename`` with ``payload``, return the size written"""
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'wb') as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, filename)
+        return len(payload)
+    
+    def _reopen_snapshot(self, state: Dict[str, Any]):
+        """Map the snapshot file just written from ``state``, in place of the previous one"""
+        reader = BinarySnapshot(self.filename)
+        written = set(state["user_ids"])
+        self._users.reopen(reader, written)
+        self._referral_codes.reopen(reader, written)
+        
+        # Ledger entries and referrals it holds are read from it from now on
+        self._ledger_snapshot = reader.ledger
+        self.data["ledger"] = self.data["ledger"][state["ledger_length"]:]
+        self._ledger_base = max(self._ledger_sealed, reader.ledger.last_id)
+        self._index_ledger()
+        referrals = {}
+        for referrer_id, made in self.data["referrals"].items():
+            kept = [referral for referral in made if referral["user_id"] in self._new_referrals]
+            if kept:
+                referrals[referrer_id] = kept
+        self.data["referrals"] = referrals
+    
+    def _begin_snapshot(self, include_sealed: bool = False) -> Dict[str, Any]:
+        """Capture what a snapshot is written from, call with the lock held.
+        
+        Only cheap copies are taken here. Users and referrals are read later in
+        batches while writes go on, so from now on _touch keeps the row a user
+        had at this point before changing it (copy on write), and referrals
+        made meanwhile are left out.
+        """
+        self._preimages = {}
+        self._new_referrals = set()
+        lazy = isinstance(self._users, LazyUsers)
+        sections = ("referrals", "orders", "order_queue", "open_orders", "states", "ledger")
+        return {
+            # Binary snapshot holding the users not created since it was written
+            "reader": self._users.snapshot if lazy else None,
+            "user_ids": list(self._users._added) if lazy else list(self._users),
+            "referrers": list(self.data["referrals"]),
+            "orders": [dict(order) for order in self.data["orders"]],
+            # Whether sealed orders and ledger entries are written too
+            "include_sealed": include_sealed,
+            "order_queue": dict(self.data["order_queue"]),
+            "open_orders": dict(self.data["open_orders"]),
+            "states": {name: dict(table) for name, table in self.data["states"].items()},
+            # The ledger is append-only, its first entries never change
+            "ledger": self.data["ledger"],
+            "ledger_length": len(self.data["ledger"]),
+            "ledger_snapshot": self._ledger_snapshot,
+            "ledger_skip": self._ledger_skip(),
+            "ledger_sealed": self._ledger_sealed,
+            "other": {key: value for key, value in self.data.items() if key not in sections},
+            "meta": {
+                "stats": {"total_balance": self._stats["total_balance"],
+                          "total_ads_watched": self._stats["total_ads_watched"],
+                          "total_referrals": self._stats["total_referrals"]},
+                "activity_days": dict(self._activity_days)
+            }
+        }
+    
+    def _end_snapshot(self):
+        self._preimages = None
+        self._new_referrals = None
+    
+    def _touch(self, user: UserRecord):
+        """Keep the row of a user about to change while a snapshot is written"""
+        if self._preimages is not None and user.user_id not in self._preimages:
+            self._preimages[user.user_id] = user.to_row()
+    
+    def _snapshot_users(self, state: Dict[str, Any], batch_size: int = 1000) -> Iterator[List[Tuple[int, Any, Any]]]:
+        """Batches of (user_id, encoded record, row) as of the snapshot start, in user_id order.
+        
+        The record is the one in the binary snapshot, None for users created
+        since; the row is set for users held in memory. Each batch is read
+        under the lock, so writers wait for one batch at most.
+        """
+        reader = state["reader"]
+        old = reader.records() if reader is not None else ()
+        source = heapq.merge(old, ((user_id, None) for user_id in sorted(state["user_ids"])))
+        loaded = self._users._loaded if isinstance(self._users, LazyUsers) else self._users
+        while True:
+            chunk = list(itertools.islice(source, batch_size))
+            if not chunk:
+                return
+            with self._lock:
+                batch = []
+                for user_id, record in chunk:
+                    row = self._preimages.get(user_id)
+                    if row is None and (record is None or user_id in loaded):
+                        row = loaded[user_id].to_row()
+                    batch.append((user_id, record, row))
+            yield batch
+    
+    def _snapshot_data(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Every section except users as of the snapshot start.
+        
+        Only the ledger entries and referrals held in memory are included,
+        not those read from a binary snapshot or sealed.
+        """
+        referrals = {}
+        referrers = state["referrers"]
+        for start in range(0, len(referrers), 1000):
+            with self._lock:
+                for referrer_id in referrers[start:start + 1000]:
+                    referrals[referrer_id] = [referral for referral in self.data["referrals"][referrer_id]
+                                              if referral["user_id"] not in self._new_referrals]
+        
+        orders = state["orders"]
+        if state["include_sealed"]:
+            hot_ids = {order["order_id"] for order in orders}
+            with self._lock:
+                sealed = [order for order in self._order_segments.iter_orders() if order["order_id"] not in hot_ids]
+            orders = sealed + orders
+        
+        return {
+            "referrals": referrals,
+            "orders": orders,
+            "order_queue": state["order_queue"],
+            "open_orders": state["open_orders"],
+            "states": state["states"],
+            "ledger": state["ledger"][:state["ledger_length"]],
+            "ledger_sealed": 0 if state["include_sealed"] else state["ledger_sealed"],
+            **state["other"]
+        }
+    
+    def _write_snapshot(self, state: Dict[str, Any], filename: str, binary: bool) -> int:
+        """Atomically write a snapshot captured by _begin_snapshot to ``filename``, return its size"""
+        if binary:
+            new_codes = []
+            
+            def records():
+                for batch in self._snapshot_users(state):
+                    for user_id, record, row in batch:
+                        if record is None:
+                            new_codes.append((code_key(row[5]), user_id))
+                        yield user_id, encode_user(row) if row is not None else record
+            
+            def codes():
+                # Read by write_snapshot after every record, once new_codes is complete
+                old = state["reader"].codes() if state["reader"] is not None else ()
+                yield from heapq.merge(old, sorted(new_codes))
+            
+            # The ledger and referrals go to their own sections: those of the
+            # previous snapshot copied as they are, then the ones in memory
+            data = self._snapshot_data(state)
+            ledger = [data["ledger"]]
+            if state["ledger_snapshot"] is not None:
+                ledger.insert(0, (state["ledger_snapshot"], state["ledger_skip"], len(state["ledger_snapshot"])))
+            if state["include_sealed"]:
+                ledger[:0] = [(segment, 0, len(segment)) for segment in self._ledger_segments.segments()]
+            referrals = itertools.chain(
+                state["reader"].referrals() if state["reader"] is not None else (),
+                ({"referrer_id": int(referrer_id), **referral}
+                 for referrer_id, made in data["referrals"].items() for referral in made)
+            )
+            data.update(ledger=[], referrals={})
+            
+            # Streamed to the file, never holding the whole snapshot in memory
+            tmp_filename = filename + ".tmp"
+            with open(tmp_filename, 'wb') as file:
+                size = write_snapshot(file, records(), codes(), data, state["meta"], ledger, referrals)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_filename, filename)
+            return size
+        
+        def dumps(value: Any) -> str:
+            return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+        
+        # Streamed a batch at a time, never holding the whole document in memory
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as file:
+            file.write('{"users":[')
+            separator = ''
+            for batch in self._snapshot_users(state):
+                file.write(separator + dumps([row if row is not None else decode_user(record, 0)
+                                             for _, record, row in batch])[1:-1])
+                separator = ','
+            file.write(']')
+            
+            data = self._snapshot_data(state)
+            if state["ledger_snapshot"] is not None:
+                data["ledger"] = itertools.chain(state["ledger_snapshot"].entries(state["ledger_skip"]), data["ledger"])
+            if state["include_sealed"]:
+                data["ledger"] = itertools.chain(self._ledger_segments.iter_entries(), data["ledger"])
+            if state["reader"] is not None:
+                referrals: Dict[str, List[Dict[str, Any]]] = {}
+                for referral in state["reader"].referrals():
+                    referrals.setdefault(str(referral.pop("referrer_id")), []).append(referral)
+                for referrer_id, made in data["referrals"].items():
+                    referrals.setdefault(referrer_id, []).extend(made)
+                data["referrals"] = referrals
+            
+            for key, value in data.items():
+                file.write(',' + dumps(key) + ':')
+                if isinstance(value, (list, Iterator)):
+                    items = iter(value)
+                    file.write('[')
+                    separator = ''
+                    for batch in iter(lambda: list(itertools.islice(items, 1000)), []):
+                        file.write(separator + dumps(batch)[1:-1])
+                        separator = ','
+                    file.write(']')
+                else:
+                    file.write(dumps(value))
+            file.write('}')
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+        os.replace(tmp_filename, filename)
+        return size
+    
+    def export(self, filename: str):
+        """Write the current data to ``filename``: JSON if it ends in .json, a binary snapshot otherwise.
+        
+        Sealed orders and ledger entries are included, so the file stands on its own.
+        """
+        with self._compact_lock:
+            with self._lock:
+                state = self._begin_snapshot(include_sealed=True)
+            try:
+                self._write_snapshot(state, filename, not filename.endswith(".json"))
+            finally:
+                with self._lock:
+                    self._end_snapshot()
+    
+    def _build_indexes(self):
+        """Build secondary indexes and running statistics over the loaded data"""
+        # referral_code -> user_id
+        self._referral_codes: Dict[str, int] = {}
+        # Running totals for get_stats, and number of users by last_activity day
+        self._stats = {"total_referrals": 0, "total_balance": 0, "total_ads_watched": 0}
+        self._activity_days: Counter = Counter()
+        if self.binary:
+            # Kept in the snapshot so opening it does not touch every user
+            reader = self._users.snapshot
+            meta = reader.meta if reader is not None else {}
+            self._referral_codes = LazyReferralCodes(reader)
+            self._stats.update(meta.get("stats", {}))
+            self._activity_days.update(meta.get("activity_days", {}))
+        else:
+            for user_id, user in self._users.items():
+                self._referral_codes[user.referral_code] = user_id
+                self._stats["total_balance"] += user.balance
+                self._stats["total_ads_watched"] += user.ads_watched
+                self._activity_days[epoch_day(user.last_activity)] += 1
+        
+        # Referrals in a binary snapshot are counted in its meta, those in data here
+        self._stats["total_referrals"] += sum(len(refs) for refs in self.data["referrals"].values())
+        
+        self._index_orders()
+        
+        # field -> SortedIndex of users, built by _build_sort_indexes on its own thread
+        self._sort_indexes: Dict[str, SortedIndex] = {}
+        self._sort_indexes_ready = threading.Event()
+        
+        # Reserved orders waiting to be dispatched to the order API, oldest first
+        self.data.setdefault("order_queue", {})
+        
+        # Dispatched orders whose final status is not known yet, oldest first.
+        # Snapshots from before the index get it from their open orders.
+        if "open_orders" not in self.data:
+            self.data["open_orders"] = {
+                order["order_id"]: order["created_at"] for order in self.data["orders"]
+                if order["status"] not in FINAL_ORDER_STATUSES and order["order_id"] not in self.data["order_queue"]
+            }
+        
+        # Persisted StateStore tables: name -> key -> [value, expires_at]
+        self.data.setdefault("states", {})
+        
+        # Append-only balance ledger, user balances are a cache of its totals.
+        # Snapshots from before the ledger get one opening entry per balance.
+        if "ledger" not in self.data:
+            now = datetime.now().isoformat()
+            self.data["ledger"] = [
+                {"entry_id": entry_id, "user_id": user.user_id, "amount": user.balance, "reason": "opening",
+                 "key": f"opening:{user.user_id}", "ref": None, "date": now}
+                for entry_id, user in enumerate((user for user in self._users.values() if user.balance), start=1)
+            ]
+        
+        # entry_id of the entry before the first one in self.data["ledger"]
+        if self.data["ledger"]:
+            self._ledger_base = self.data["ledger"][0]["entry_id"] - 1
+        else:
+            self._ledger_base = max(self._ledger_sealed,
+                                    self._ledger_snapshot.last_id if self._ledger_snapshot is not None else 0)
+        self._index_ledger()
+    
+    def _index_ledger(self):
+        # idempotency key -> position in self.data["ledger"], user_id -> positions
+        self._ledger_keys: Dict[str, int] = {}
+        self._user_ledger: Dict[int, List[int]] = {}
+        for position, entry in enumerate(self.data["ledger"]):
+            self._ledger_keys[entry["key"]] = position
+            self._user_ledger.setdefault(entry["user_id"], []).append(position)
+    
+    def _ledger_skip(self) -> int:
+        """Position of the first entry of the binary snapshot not sealed since it was written"""
+        snapshot = self._ledger_snapshot
+        if snapshot is None:
+            return 0
+        return min(len(snapshot), max(0, self._ledger_sealed - snapshot.first_id + 1))
+    
+    def _ledger_entry(self, key: Optional[str]) -> Optional[Dict[str, Any]]:
+        """The ledger entry posted with an idempotency key, looked up in memory, the snapshot, then sealed months"""
+        if key is None:
+            return None
+        position = self._ledger_keys.get(key)
+        if position is not None:
+            return self.data["ledger"][position]
+        if self._ledger_snapshot is not None:
+            # Entries sealed since the snapshot was written are the same as their sealed copies
+            entry = self._ledger_snapshot.find_key(key)
+            if entry is not None:
+                return entry
+        return self._ledger_segments.find_key(key)
+    
+    def _build_sort_indexes(self):
+        """Build the SortedIndex of every SORT_FIELDS field, off the caller's thread.
+        
+        Users are read like a snapshot does (see _begin_snapshot), a batch at a
+        time with values as of the start, then users changed or created
+        meanwhile are caught up under the lock before the indexes go live.
+        """
+        try:
+            with self._compact_lock:
+                with self._lock:
+                    state = self._begin_snapshot()
+                try:
+                    # One int64 per user and field until the indexes are built
+                    user_ids = array('q')
+                    values = {field: array('q') for field in SORT_FIELDS}
+                    positions = {field: USER_FIELDS.index(field) for field in SORT_FIELDS}
+                    for batch in self._snapshot_users(state):
+                        for user_id, record, row in batch:
+                            if row is None:
+                                row = decode_user(record, 0)
+                            user_ids.append(user_id)
+                            for field, position in positions.items():
+                                values[field].append(row[position])
+                    
+                    indexes = {}
+                    for field in SORT_FIELDS:
+                        indexes[field] = SortedIndex(zip(values.pop(field), user_ids))
+                    
+                    with self._lock:
+                        if isinstance(self._users, LazyUsers):
+                            created = self._users._added.difference(state["user_ids"])
+                        else:
+                            # Users are only ever added, after the ones there at the start
+                            created = set(itertools.islice(self._users, len(state["user_ids"]), None))
+                        for field, index in indexes.items():
+                            position = positions[field]
+                            for user_id, row in self._preimages.items():
+                                if user_id not in created:
+                                    index.move(row[position], getattr(self._users[user_id], field), user_id)
+                            for user_id in created:
+                                index.add(getattr(self._users[user_id], field), user_id)
+                        self._sort_indexes = indexes
+                finally:
+                    with self._lock:
+                        self._end_snapshot()
+        except Exception:
+            logging.exception("Building the user sort indexes failed")
+        finally:
+            self._sort_indexes_ready.set()
+    
+    def _index_orders(self):
+        # user_id -> positions in self.data["orders"], order_id -> position
+        self._user_orders: Dict[int, List[int]] = {}
+        self._order_positions: Dict[str, int] = {}
+        for position, order in enumerate(self.data["orders"]):
+            self._user_orders.setdefault(order["user_id"], []).append(position)
+            self._order_positions[order["order_id"]] = position
+        
+        # Orders sealed by a compaction whose snapshot was not written are in both until
+        # seal_orders moves them again; counted once. Only orders of sealed months are looked up.
+        sealed_months = set(self._order_segments.months)
+        self._sealed_copies = sum(1 for order in self.data["orders"]
+                                  if order["created_at"][:7] in sealed_months and order["order_id"] in self._order_segments)
+    
+    def _post_entry(self, user_id: int, amount: int, reason: str, key: Optional[str], date: str,
+                    ref: Optional[str] = None) -> bool:
+        """Append a ledger entry and update the cached balance, unless the key was already used"""
+        if key is None:
+            key = uuid.uuid4().hex
+        if self._ledger_entry(key) is not None:
+            return False
+        
+        ledger = self.data["ledger"]
+        self._ledger_keys[key] = len(ledger)
+        self._user_ledger.setdefault(user_id, []).append(len(ledger))
+        ledger.append({
+            "entry_id": self._ledger_base + len(ledger) + 1,
+            "user_id": user_id,
+            "amount": amount,
+            "reason": reason,
+            "key": key,
+            "ref": ref,
+            "date": date
+        })
+        
+        self._increment(self._users[user_id], "balance", amount)
+        self._stats["total_balance"] += amount
+        return True
+    
+    def _increment(self, user: UserRecord, field: str, amount: int):
+        """Change a counter of a user, keeping its sorted index in step"""
+        self._touch(user)
+        value = getattr(user, field)
+        setattr(user, field, value + amount)
+        index = self._sort_indexes.get(field)
+        if index is not None:
+            index.move(value, value + amount, user.user_id)
+    
+    def _set_last_activity(self, user: UserRecord, timestamp: int):
+        self._touch(user)
+        previous_day = epoch_day(user.last_activity)
+        self._activity_days[previous_day] -= 1
+        if not self._activity_days[previous_day]:
+            del self._activity_days[previous_day]
+        
+        self._activity_days[epoch_day(timestamp)] += 1
+        user.last_activity = timestamp
+    
+    # Journal mode: every mutation is appended as one compact JSON line to
+    # ``<filename>.journal`` by the JournalWriter thread. The JSON file itself
+    # becomes a snapshot that is rewritten only by compaction. Without a journal
+    # the snapshot is rewritten after changes instead, coalescing those made
+    # while the previous one was written. Either way snapshots are written on
+    # the background thread, so callers never wait on the disk.
+    
+    def _open_journal(self):
+        """Replay pending journal records and start appending to the journal"""
+        rotated = self.journal_filename + ".old"
+        replayed = self._replay_journal(rotated) + self._replay_journal(self.journal_filename)
+        
+        self._journal = JournalWriter(self.journal_filename)
+        self._journal_records = replayed
+        
+        # A leftover rotated journal means a compaction was interrupted
+        if os.path.exists(rotated) or replayed >= self.compact_every:
+            self.compact()
+    
+    def _replay_journal(self, path: str) -> int:
+        """Apply journal records newer than the snapshot, return how many were applied"""
+        if not os.path.exists(path):
+            return 0
+        
+        applied = 0
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn write at the tail of the journal after a crash
+                    logging.warning(f"Skipping corrupt journal record in {path}")
+                    continue
+                
+                if record["seq"] <= self._seq:
+                    continue
+                
+                self._apply(record)
+                self._seq = record["seq"]
+                self.data["journal_seq"] = self._seq
+                applied += 1
+        
+        return applied
+    
+    def _apply(self, record: Dict[str, Any]):
+        """Apply a mutation record to the in-memory data"""
+        getattr(self, f"_apply_{record['op']}")(record)
+    
+    def _commit(self, record: Dict[str, Any]) -> Future:
+        """Apply a mutation record and queue it for writing, returns a Future resolved once it is on disk"""
+        with self._lock:
+            self._apply(record)
+            
+            if not self.journal:
+                future = Future()
+                self._waiters.append(future)
+                self._dirty = True
+                self._compact_wakeup.set()
+                return future
+            
+            self._seq += 1
+            record["seq"] = self._seq
+            self.data["journal_seq"] = self._seq
+            # Queued under the lock, so lines reach the journal in seq order
+            future = self._journal.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+            self._journal_records += 1
+            
+            if self._journal_records >= self.compact_every:
+                self._compact_wakeup.set()
+            return future
+    
+    def sync(self) -> Future:
+        """Future resolved once every change made so far is on disk, for callers that need durability"""
+        with self._lock:
+            if self.journal:
+                return self._journal.sync()
+            
+            future = Future()
+            if self._dirty:
+                self._waiters.append(future)
+                self._compact_wakeup.set()
+            elif self._inflight is not None:
+                self._inflight.append(future)
+            else:
+                future.set_result(None)
+            return future
+    
+    def _compaction_loop(self):
+        """Write snapshots: every compact_interval seconds (unless 0, when the caller
+        schedules compact() itself), when the journal grows past compact_every, and
+        after changes without one"""
+        while not self._closed.is_set():
+            self._compact_wakeup.wait(self.compact_interval or None)
+            self._compact_wakeup.clear()
+            if self._closed.is_set():
+                break
+            try:
+                self.compact()
+            except OSError as e:
+                logging.error(f"Snapshot write failed: {e}")
+    
+    def compact(self):
+        """Write a fresh snapshot if anything changed and discard the journal records it covers.
+        
+        Only capturing the snapshot holds the lock, it is written while
+        changes go on and replaces the old one atomically.
+        """
+        rotated = self.journal_filename + ".old"
+        with self._compact_lock:
+            with self._lock:
+                if self.journal:
+                    if self._journal_records == 0 and not os.path.exists(rotated):
+                        return
+                elif not self._dirty:
+                    return
+                
+                self.seal_orders()
+                self.seal_ledger()
+                state = self._begin_snapshot()
+                self._dirty = False
+                waiters = self._inflight = self._waiters
+                self._waiters = []
+                if self.journal:
+                    # New records go to a fresh journal while the snapshot is written
+                    rotation = self._journal.rotate(rotated)
+                    self._journal_records = 0
+            
+            try:
+                started = time.perf_counter()
+                size = self._write_snapshot(state, self.filename, self.binary)
+                metrics.record_write("compact" if self.journal else "save", started, size)
+                if self.binary:
+                    with self._lock:
+                        self._reopen_snapshot(state)
+                if self.journal:
+                    rotation.result()
+                    os.remove(rotated)
+            except Exception as e:
+                with self._lock:
+                    self._dirty = self._dirty or not self.journal
+                    self._end_snapshot()
+                    self._inflight = None
+                for waiter in waiters:
+                    waiter.set_exception(e)
+                raise
+            
+            with self._lock:
+                self._end_snapshot()
+                self._inflight = None
+            for waiter in waiters:
+                waiter.set_result(None)
+    
+    def _activity_flush_loop(self):
+        """Flush buffered activity timestamps every activity_flush_interval seconds"""
+        while not self._closed.wait(self.activity_flush_interval):
+            try:
+                self.flush_activity()
+            except OSError as e:
+                logging.error(f"Activity flush failed: {e}")
+    
+    def flush_activity(self):
+        """Persist all buffered last_activity updates as a single batch"""
+        with self._lock:
+            if not self._dirty_activity:
+                return
+            
+            dirty, self._dirty_activity = self._dirty_activity, {}
+            self._commit({"op": "activity_batch", "users": dirty})
+    
+    def close(self):
+        """Stop background work and flush everything to disk"""
+        if self._closed.is_set():
+            return
+        
+        self._closed.set()
+        self.flush_activity()
         
-        with open(self.filename, 'w', encoding='utf-8') as file:
-            json.dump(data, file, indent=2, ensure_ascii=False)
+        self._compact_wakeup.set()
+        self.compact()
+        if self.journal:
+            self._journal.close()
     
     def create_user(self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None) -> bool:
         """Create a new user if doesn't exist"""
-        user_id_str = str(user_id)
-        
-        if user_id_str not in self.data["users"]:
+        if user_id not in self._users:
             # Generate unique referral code
-            referral_code = str(uuid.uuid4())[:8]
-            while any(user.get("referral_code") == referral_code for user in self.data["users"].values()):
-                referral_code = str(uuid.uuid4())[:8]
+            referral_code = str(uuid.uuid4())[:8] + self.referral_code_suffix
+            while referral_code in self._referral_codes:
+                referral_code = str(uuid.uuid4())[:8] + self.referral_code_suffix
             
-            self.data["users"][user_id_str] = {
+            self._commit({
+                "op": "create_user",
                 "user_id": user_id,
                 "username": username,
                 "first_name": first_name,
-                "balance": 0,  # Balance in views
-                "ads_watched": 0,
                 "referral_code": referral_code,
-                "referred_by": None,
-                "referrals_count": 0,
-                "join_date": datetime.now().isoformat(),
-                "last_activity": datetime.now().isoformat()
-            }
-            self._save_data()
+                "date": datetime.now().isoformat()
+            })
             return True
         
         return False
     
+    def _apply_create_user(self, record: Dict[str, Any]):
+        timestamp = to_epoch(record["date"])
+        self._referral_codes[record["referral_code"]] = record["user_id"]
+        user = self._users[record["user_id"]] = UserRecord(
+            record["user_id"], record["username"], record["first_name"],
+            referral_code=record["referral_code"], join_date=timestamp, last_activity=timestamp
+        )
+        self._activity_days[epoch_day(timestamp)] += 1
+        for field, index in self._sort_indexes.items():
+            index.add(getattr(user, field), user.user_id)
+    
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user data by ID"""
-        return self.data["users"].get(str(user_id))
+        user = self._users.get(user_id)
+        return user.to_dict() if user is not None else None
     
     def update_user_activity(self, user_id: int):
-        """Update user's last activity timestamp"""
-        user_id_str = str(user_id)
-        if user_id_str in self.data["users"]:
-            self.data["users"][user_id_str]["last_activity"] = datetime.now().isoformat()
-            self._save_data()
-    
-    def add_balance(self, user_id: int, amount: int) -> bool:
-        """Add balance to user (amount in views)"""
-        user_id_str = str(user_id)
-        if user_id_str in self.data["users"]:
-            self.data["users"][user_id_str]["balance"] += amount
-            self._save_data()
-            return True
-        return False
+        """Update user's last activity timestamp (persisted by the next flush_activity)"""
+        user = self._users.get(user_id)
+        if user is not None:
+            now = datetime.now()
+            with self._lock:
+                self._set_last_activity(user, int(now.timestamp()))
+                self._dirty_activity[str(user_id)] = now.isoformat()
+            
+            # A user who writes to the bot has unblocked it
+            if user.blocked:
+                self.set_user_blocked(user_id, False)
     
-    def subtract_balance(self, user_id: int, amount: int) -> bool:
-        """Subtract balance from user if sufficient"""
-        user_id_str = str(user_id)
-        if user_id_str in self.data["users"]:
-            if self.data["users"][user_id_str]["balance"] >= amount:
-                self.data["users"][user_id_str]["balance"] -= amount
-                self._save_data()
-                return True
-        return False
+    def _apply_activity_batch(self, record: Dict[str, Any]):
+        for user_id_str, date in record["users"].items():
+            user = self._users.get(int(user_id_str))
+            if user is not None:
+                self._set_last_activity(user, to_epoch(date))
+    
+    def set_user_blocked(self, user_id: int, blocked: bool = True):
+        """Mark whether the user has blocked the bot, blocked users are skipped by broadcasts"""
+        user = self._users.get(user_id)
+        if user is not None and user.blocked != blocked:
+            self._commit({"op": "blocked", "user_id": user_id, "blocked": blocked})
     
-    def add_ad_view(self, user_id: int) -> int:
-        """Add ad view and return total views (every 10 views = reward)"""
-        user_id_str = str(user_id)
-        if user_id_str in self.data["users"]:
-            self.data["users"][user_id_str]["ads_watched"] += 1
-            ads_watched = self.data["users"][user_id_str]["ads_watched"]
+    def _apply_blocked(self, record: Dict[str, Any]):
+        user = self._users[record["user_id"]]
+        self._touch(user)
+        user.blocked = record["blocked"]
+    
+    def add_balance(self, user_id: int, amount: int, reason: str = "admin", key: Optional[str] = None) -> bool:
+        """Add balance to user (amount in views), False if the user is unknown or key was already used"""
+        with self._lock:
+            if user_id not in self._users or self._ledger_entry(key) is not None:
+                return False
             
-            # Every 10 ad views = 1 view reward
-            if ads_watched % 10 == 0:
-                self.add_balance(user_id, 1)
+            self._commit({
+                "op": "balance",
+                "user_id": user_id,
+                "amount": amount,
+                "reason": reason,
+                "key": key or uuid.uuid4().hex,
+                "date": datetime.now().isoformat()
+            })
+            return True
+    
+    def subtract_balance(self, user_id: int, amount: int, reason: str = "admin", key: Optional[str] = None) -> bool:
+        """Subtract balance from user if sufficient, False otherwise or if key was already used"""
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None or user.balance < amount or self._ledger_entry(key) is not None:
+                return False
             
-            self._save_data()
-            return ads_watched
+            return self.add_balance(user_id, -amount, reason, key)
+    
+    def _apply_balance(self, record: Dict[str, Any]):
+        self._post_entry(record["user_id"], record["amount"], record.get("reason", "admin"), record.get("key"),
+                         record.get("date", datetime.now().isoformat()))
+    
+    def add_ad_view(self, user_id: int, key: Optional[str] = None) -> int:
+        """Add ad view and return total views (every 10 views = reward).
+        
+        A repeated ``key`` (e.g. the same ad message clicked twice) is not counted again.
+        """
+        if user_id in self._users:
+            self._commit({"op": "ad_view", "user_id": user_id, "key": key, "date": datetime.now().isoformat()})
+            return self._users[user_id].ads_watched
         return 0
     
+    def _apply_ad_view(self, record: Dict[str, Any]):
+        user = self._users[record["user_id"]]
+        key = record.get("key")
+        if key is not None:
+            if user.last_ad_key == key:
+                return
+            self._touch(user)
+            user.last_ad_key = key
+        
+        self._increment(user, "ads_watched", 1)
+        self._stats["total_ads_watched"] += 1
+        
+        # Every 10 ad views = 1 view reward
+        if user.ads_watched % 10 == 0:
+            self._post_entry(user.user_id, 1, "ad_reward", f"ad_reward:{user.user_id}:{user.ads_watched}",
+                             record.get("date", datetime.now().isoformat()))
+    
     def get_referral_link(self, user_id: int, bot_username: str) -> str:
         """Get user's referral link"""
-        user = self.get_user(user_id)
+        user = self._users.get(user_id)
         if user:
-            referral_code = user["referral_code"]
+            referral_code = user.referral_code
             return f"https://t.me/{bot_username}?start={referral_code}"
         return ""
     
     def process_referral(self, user_id: int, referral_code: str) -> bool:
         """Process referral when new user joins with code"""
-        user_id_str = str(user_id)
-        
         # Find referrer by referral code
-        referrer_id = None
-        for uid, user_data in self.data["users"].items():
-            if user_data.get("referral_code") == referral_code:
-                referrer_id = uid
-                break
+        referrer_id = self._referral_codes.get(referral_code)
         
-        if referrer_id and referrer_id != user_id_str:
-            # Set referral relationship
-            if user_id_str in self.data["users"]:
-                self.data["users"][user_id_str]["referred_by"] = int(referrer_id)
-                
-                # Give referrer +100 views reward
-                self.data["users"][referrer_id]["balance"] += 100
-                self.data["users"][referrer_id]["referrals_count"] += 1
-                
-                # Track referral in separate section
-                if referrer_id not in self.data["referrals"]:
-                    self.data["referrals"][referrer_id] = []
-                
-                self.data["referrals"][referrer_id].append({
+        if referrer_id is not None and referrer_id != user_id:
+            user = self._users.get(user_id)
+            if user is not None and user.referred_by is None and self._ledger_entry(f"referral:{user_id}") is None:
+                self._commit({
+                    "op": "referral",
                     "user_id": user_id,
-                    "date": datetime.now().isoformat(),
-                    "reward": 100
+                    "referrer_id": referrer_id,
+                    "reward": 100,
+                    "date": datetime.now().isoformat()
                 })
-                
-                self._save_data()
                 return True
         
         return False
     
+    def find_referrer(self, referral_code: str) -> Optional[int]:
+        """User ID owning a referral code, None if no user here has it"""
+        return self._referral_codes.get(referral_code)
+    
+    # With sharded workers the referred user and the referrer may live in
+    # different stores: the user's shard claims the referral, then the
+    # referrer's shard credits it (see bot.process_referral).
+    
+    def claim_referral(self, user_id: int, referrer_id: int) -> bool:
+        """Mark the user as referred by a referrer kept elsewhere, False if they already were"""
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None or user.referred_by is not None:
+                return False
+            
+            self._commit({"op": "referred", "user_id": user_id, "referrer_id": referrer_id})
+            return True
+    
+    def credit_referral(self, referrer_id: int, user_id: int, reward: int = 100) -> bool:
+        """Reward the referrer of a user kept elsewhere, once per referred user"""
+        with self._lock:
+            if referrer_id not in self._users or self._ledger_entry(f"referral:{user_id}") is not None:
+                return False
+            
+            self._commit({
+                "op": "referral_credit",
+                "user_id": user_id,
+                "referrer_id": referrer_id,
+                "reward": reward,
+                "date": datetime.now().isoformat()
+            })
+            return True
+    
+    def _apply_referral(self, record: Dict[str, Any]):
+        if self._apply_referral_credit(record):
+            self._apply_referred(record)
+    
+    def _apply_referred(self, record: Dict[str, Any]):
+        user = self._users[record["user_id"]]
+        self._touch(user)
+        user.referred_by = record["referrer_id"]
+    
+    def _apply_referral_credit(self, record: Dict[str, Any]) -> bool:
+        referrer_id = str(record["referrer_id"])
+        
+        # Give referrer the reward, once per referred user
+        if not self._post_entry(record["referrer_id"], record["reward"], "referral", f"referral:{record['user_id']}",
+                                record["date"], ref=str(record["user_id"])):
+            return False
+        
+        self._increment(self._users[record["referrer_id"]], "referrals_count", 1)
+        self._stats["total_referrals"] += 1
+        
+        # Track referral in separate section
+        if self._new_referrals is not None:
+            self._new_referrals.add(record["user_id"])
+        if referrer_id not in self.data["referrals"]:
+            self.data["referrals"][referrer_id] = []
+        
+        self.data["referrals"][referrer_id].append({
+            "user_id": record["user_id"],
+            "date": record["date"],
+            "reward": record["reward"]
+        })
+        return True
+    
     def create_order(self, user_id: int, video_link: str, quantity: int, total_cost: int) -> str:
         """Create a new order"""
         order_id = str(uuid.uuid4())[:12]
@@ -163,27 +1127,403 @@ class UserDataStorage:
             "created_at": datetime.now().isoformat()
         }
         
-        self.data["orders"].append(order)
-        self._save_data()
+        self._commit({"op": "create_order", "order": order})
         return order_id
     
-    def get_user_orders(self, user_id: int) -> list:
-        """Get all orders for a user"""
-        return [order for order in self.data["orders"] if order["user_id"] == user_id]
+    def _apply_create_order(self, record: Dict[str, Any]):
+        self._add_order(record["order"])
+        self.data["open_orders"][record["order"]["order_id"]] = record["order"]["created_at"]
+    
+    def _add_order(self, order: Dict[str, Any]):
+        order = dict(order)
+        self._user_orders.setdefault(order["user_id"], []).append(len(self.data["orders"]))
+        self._order_positions[order["order_id"]] = len(self.data["orders"])
+        self.data["orders"].append(order)
+    
+    def reserve_order(self, user_id: int, video_link: str, quantity: int, key: Optional[str] = None) -> Optional[str]:
+        """Hold the order cost from the user's balance and queue the order for dispatch.
+        
+        Retrying with the same ``key`` returns the order placed the first time.
+        """
+        with self._lock:
+            entry = self._ledger_entry(key)
+            if entry is not None:
+                return entry["ref"]
+            
+            user = self._users.get(user_id)
+            if user is None or user.balance < quantity:
+                return None
+            
+            order_id = str(uuid.uuid4())[:12]
+            self._commit({
+                "op": "reserve_order",
+                "key": key or f"order:{order_id}",
+                "order": {
+                    "order_id": order_id,
+                    "user_id": user_id,
+                    "video_link": video_link,
+                    "quantity": quantity,
+                    "total_cost": quantity,
+                    "status": "pending",
+                    "created_at": datetime.now().isoformat()
+                }
+            })
+            return order_id
+    
+    def _apply_reserve_order(self, record: Dict[str, Any]):
+        order = record["order"]
+        self._post_entry(order["user_id"], -order["total_cost"], "order",
+                         record.get("key", f"order:{order['order_id']}"), order["created_at"], ref=order["order_id"])
+        self._add_order(order)
+        self.data["order_queue"][order["order_id"]] = order["created_at"]
+    
+    def get_order(self, order_id: str) -> Optional[Dict[str, Any]]:
+        """Get an order by ID"""
+        position = self._order_positions.get(order_id)
+        if position is not None:
+            return self.data["orders"][position]
+        with self._lock:
+            return self._order_segments.get(order_id)
+    
+    def get_queued_orders(self) -> list:
+        """Get reserved orders that have not been dispatched yet, oldest first"""
+        return [self.get_order(order_id) for order_id in self.data["order_queue"]]
+    
+    def get_open_orders(self, limit: Optional[int] = None, after: Optional[str] = None) -> list:
+        """Get dispatched orders not final yet oldest first, at most ``limit``, only those after the order ID ``after``"""
+        with self._lock:
+            order_ids = iter(self.data["open_orders"])
+            if after is not None and after in self.data["open_orders"]:
+                for order_id in order_ids:
+                    if order_id == after:
+                        break
+            return [self.get_order(order_id) for order_id in itertools.islice(order_ids, limit)]
+    
+    def update_order_statuses(self, statuses: Dict[str, str], remains: Optional[Dict[str, int]] = None):
+        """Set the status of several orders in one write, refunding open orders that failed or were canceled.
+        
+        ``remains`` gives the views an order with status ``partial`` did not
+        get, their share of the cost is refunded.
+        """
+        if statuses:
+            record = {"op": "order_status", "statuses": statuses, "date": datetime.now().isoformat()}
+            if remains:
+                record["remains"] = remains
+            self._commit(record)
+    
+    def _apply_order_status(self, record: Dict[str, Any]):
+        sealed = []
+        remains = record.get("remains", {})
+        for order_id, status in record["statuses"].items():
+            order = self.get_order(order_id)
+            if order is None:
+                continue
+            
+            queued = self.data["order_queue"].pop(order_id, None) is not None
+            if status not in FINAL_ORDER_STATUSES:
+                # Keeps its place if it was open already
+                self.data["open_orders"].setdefault(order_id, order["created_at"])
+            elif queued or self.data["open_orders"].pop(order_id, None) is not None:
+                refund = refund_amount(order, status, remains.get(order_id))
+                if refund:
+                    self._post_entry(order["user_id"], refund, "refund", f"refund:{order_id}",
+                                     record.get("date", datetime.now().isoformat()), ref=order_id)
+            order["status"] = status
+            if order_id not in self._order_positions:
+                sealed.append(order)
+        
+        if sealed:
+            self._order_segments.seal(sealed)
+    
+    def seal_orders(self) -> int:
+        """Move orders of past months that are no longer queued or open into sealed segments, returns how many"""
+        current_month = datetime.now().strftime("%Y-%m")
+        with self._lock:
+            orders = self.data["orders"]
+            sealed = [order for order in orders
+                      if order["created_at"][:7] < current_month and order["order_id"] not in self.data["order_queue"]
+                      and order["order_id"] not in self.data["open_orders"]]
+            if not sealed:
+                return 0
+            
+            # Segments are written before the orders leave the snapshot
+            self._order_segments.seal(sealed)
+            sealed_ids = {order["order_id"] for order in sealed}
+            self.data["orders"] = [order for order in orders if order["order_id"] not in sealed_ids]
+            self._index_orders()
+            return len(sealed)
+    
+    def seal_ledger(self) -> int:
+        """Move ledger entries of past months into sealed segments, returns how many.
+        
+        Entries are sealed oldest first up to the first one of the current
+        month, so the entries left in the snapshot and in memory follow every
+        sealed one. Call it only while no snapshot is being written.
+        """
+        current_month = datetime.now().strftime("%Y-%m")
+        with self._lock:
+            snapshot = self._ledger_snapshot
+            skip = self._ledger_skip()
+            in_snapshot = len(snapshot) - skip if snapshot is not None else 0
+            unsealed = itertools.chain(snapshot.entries(skip) if snapshot is not None else (), self.data["ledger"])
+            
+            # [month, number of entries] of each run of entries sealed in the same month.
+            # Segments follow each other in month order, a late entry joins the month before it.
+            runs: List[List[Any]] = []
+            month = max(self._ledger_segments.months, default="")
+            for entry in unsealed:
+                month = max(entry["date"][:7], month)
+                if month >= current_month:
+                    break
+                if runs and runs[-1][0] == month:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([month, 1])
+            if not runs:
+                return 0
+            
+            # Segments are written before the entries leave memory and the snapshot
+            start = 0
+            for month, count in runs:
+                parts: List[Any] = []
+                if start < in_snapshot:
+                    parts.append((snapshot, skip + start, skip + min(start + count, in_snapshot)))
+                if start + count > in_snapshot:
+                    parts.append(self.data["ledger"][max(start - in_snapshot, 0):start + count - in_snapshot])
+                self._ledger_segments.seal(month, parts)
+                start += count
+            
+            self._ledger_sealed = self._ledger_segments.last_id
+            dropped = max(0, start - in_snapshot)
+            if dropped:
+                self.data["ledger"] = self.data["ledger"][dropped:]
+                self._ledger_base += dropped
+                self._index_ledger()
+            return start
+    
+    def get_user_orders(self, user_id: int, limit: Optional[int] = None, before: Optional[str] = None) -> list:
+        """Get a user's orders newest first, at most ``limit``, only those placed before the order ID ``before``
+        
+        Sealed months are read only as far as the page reaches.
+        """
+        with self._lock:
+            orders = self.data["orders"]
+            hot = [orders[position] for position in reversed(self._user_orders.get(user_id, []))]
+            before_month = self._order_segments.month_of(before) if before is not None else None
+            if before_month is not None and before not in self._order_positions:
+                hot = []
+            
+            def newest_first():
+                yield from hot
+                for month in self._order_segments.user_months(user_id):
+                    if before_month is None or month <= before_month:
+                        for order in reversed(self._order_segments.user_orders(user_id, month)):
+                            # Sealed copies of orders still in the snapshot after an interrupted compaction
+                            if order["order_id"] not in self._order_positions:
+                                yield order
+            
+            page = []
+            skipping = before is not None
+            for order in newest_first():
+                if skipping:
+                    skipping = order["order_id"] != before
+                    continue
+                if limit is not None and len(page) >= limit:
+                    break
+                page.append(order)
+            return page
+    
+    def get_orders_between(self, start: str, end: str, user_id: Optional[int] = None,
+                           limit: Optional[int] = None, after: Optional[str] = None) -> list:
+        """Get orders created from ``start`` up to, not including, ``end`` (ISO dates or timestamps), oldest first.
+        
+        Optionally only a user's orders, at most ``limit``, only those following the order ID ``after``.
+        Only the sealed months inside the range are read.
+        """
+        with self._lock:
+            def matches(order: Dict[str, Any]) -> bool:
+                return start <= order["created_at"] < end and (user_id is None or order["user_id"] == user_id)
+            
+            found = [order for order in self.data["orders"] if matches(order)]
+            for month in self._order_segments.months:
+                first, last = self._order_segments.range_of(month)
+                if start <= last and first < end:
+                    found.extend(order for order in self._order_segments.load(month).values()
+                                 if matches(order) and order["order_id"] not in self._order_positions)
+            found.sort(key=lambda order: (order["created_at"], order["order_id"]))
+            
+            if after is not None:
+                positions = [position for position, order in enumerate(found) if order["order_id"] == after]
+                found = found[positions[0] + 1:] if positions else []
+            return found[:limit] if limit is not None else found
+    
+    def get_ledger(self, user_id: int, limit: int = 20, before: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get a user's ledger entries newest first, only those with entry_id below ``before`` if given"""
+        with self._lock:
+            ledger = self.data["ledger"]
+            snapshot = self._ledger_snapshot
+            
+            def newest_first():
+                positions = self._user_ledger.get(user_id, [])
+                if before is not None:
+                    positions = positions[:bisect.bisect_left(positions, before - self._ledger_base - 1)]
+                for position in reversed(positions):
+                    yield ledger[position]
+                if snapshot is not None:
+                    positions = snapshot.user_positions(user_id)
+                    stop = len(positions)
+                    if before is not None:
+                        stop = bisect.bisect_left(positions, before - snapshot.first_id)
+                    for position in reversed(positions[bisect.bisect_left(positions, self._ledger_skip()):stop]):
+                        yield snapshot.entry(position)
+                yield from self._ledger_segments.user_entries(user_id, before)
+            
+            return list(itertools.islice(newest_first(), max(limit, 0)))
+    
+    def iter_ledger(self) -> Iterator[Dict[str, Any]]:
+        """Stream every ledger entry in entry_id order"""
+        with self._lock:
+            sealed = self._ledger_segments.iter_entries()
+            snapshot = self._ledger_snapshot.entries(self._ledger_skip()) if self._ledger_snapshot is not None else ()
+            ledger = list(self.data["ledger"])
+        yield from sealed
+        yield from snapshot
+        yield from ledger
+    
+    def reconcile_balances(self) -> Dict[int, Tuple[int, int]]:
+        """Compare cached balances with ledger totals, returns {user_id: (cached, ledger)} for mismatches"""
+        with self._lock:
+            totals: Counter = Counter()
+            for entry in self.iter_ledger():
+                totals[entry["user_id"]] += entry["amount"]
+            mismatches = {}
+            for user_id, user in self._users.items():
+                if totals[user_id] != user.balance:
+                    mismatches[user_id] = (user.balance, totals[user_id])
+            return mismatches
+    
+    def load_states(self, name: str) -> Dict[str, Tuple[Any, float]]:
+        """Get the persisted entries of a StateStore table"""
+        return {key: (value, expires_at) for key, (value, expires_at) in self.data["states"].get(name, {}).items()}
+    
+    def save_state(self, name: str, key: str, value: Any, expires_at: float):
+        """Persist one StateStore entry"""
+        self._commit({"op": "state_set", "name": name, "key": key, "value": value, "expires_at": expires_at})
+    
+    def _apply_state_set(self, record: Dict[str, Any]):
+        self.data["states"].setdefault(record["name"], {})[record["key"]] = [record["value"], record["expires_at"]]
+    
+    def delete_states(self, name: str, keys: List[str]):
+        """Remove persisted StateStore entries"""
+        table = self.data["states"].get(name, {})
+        keys = [key for key in keys if key in table]
+        if keys:
+            self._commit({"op": "state_delete", "name": name, "keys": keys})
+    
+    def _apply_state_delete(self, record: Dict[str, Any]):
+        table = self.data["states"].get(record["name"], {})
+        for key in record["keys"]:
+            table.pop(key, None)
     
     def get_all_users(self) -> Dict[str, Any]:
-        """Get all users (for admin broadcast)"""
-        return self.data["users"]
+        """Get all users"""
+        return {str(user_id): user.to_dict() for user_id, user in self._users.items()}
+    
+    def iter_users(self) -> Iterator[Dict[str, Any]]:
+        """Stream every user as a dict without copying the user table"""
+        if self.binary:
+            # The snapshot and the users created since, taken together: a compaction
+            # moves users from one to the other. Records not loaded yet are decoded
+            # one at a time and not cached.
+            with self._lock:
+                snapshot = self._users.snapshot
+                user_ids = list(self._users._added)
+            loaded = self._users._loaded
+            users = itertools.chain(
+                (loaded.get(row[0]) or UserRecord.from_row(row) for row in (snapshot.rows() if snapshot else ())),
+                (loaded.get(user_id) for user_id in sorted(user_ids))
+            )
+        else:
+            with self._lock:
+                user_ids = list(self._users)
+            users = (self._users.get(user_id) for user_id in user_ids)
+        
+        for user in users:
+            if user is not None:
+                yield user.to_dict()
+    
+    def iter_orders(self) -> Iterator[Dict[str, Any]]:
+        """Stream every order, sealed months first, reading one segment at a time"""
+        with self._lock:
+            hot = list(self.data["orders"])
+        hot_ids = {order["order_id"] for order in hot}
+        
+        for order in self._order_segments.iter_orders():
+            if order["order_id"] not in hot_ids:
+                yield order
+        yield from hot
+    
+    def iter_referrals(self) -> Iterator[Dict[str, Any]]:
+        """Stream every referral as {referrer_id, user_id, date, reward}"""
+        with self._lock:
+            reader = self._users.snapshot if self.binary else None
+            referrers = list(self.data["referrals"].items())
+        
+        if reader is not None:
+            yield from reader.referrals()
+        for referrer_id, referrals in referrers:
+            for referral in list(referrals):
+                yield {"referrer_id": int(referrer_id), **referral}
+    
+    def get_users_page(self, sort: str, limit: int = 10, after: Optional[int] = None,
+                       before: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get users ordered by ``sort`` (one of SORT_FIELDS) highest first, ties by user ID.
+        
+        Pages follow the user ID ``after`` or precede the user ID ``before``,
+        from the top without either. Right after opening the storage this
+        waits for the sorted indexes, built on a background thread; callers
+        that must not block check sort_indexes_ready first.
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"Cannot sort users by {sort}")
+        
+        self._sort_indexes_ready.wait()
+        with self._lock:
+            index = self._sort_indexes.get(sort)
+            if index is None:
+                raise RuntimeError(f"The {sort} index of users could not be built")
+            
+            cursor_id = before if before is not None else after
+            cursor_user = self._users.get(cursor_id) if cursor_id is not None else None
+            cursor = (getattr(cursor_user, sort), cursor_id) if cursor_user is not None else None
+            if before is not None and cursor is not None:
+                entries = index.page_before(cursor, limit)
+            else:
+                entries = index.page_after(cursor, limit)
+            return [self._users[user_id].to_dict() for _, user_id in entries]
+    
+    def sort_indexes_ready(self) -> bool:
+        """Whether get_users_page answers without waiting for the sorted indexes to be built"""
+        return self._sort_indexes_ready.is_set()
+    
+    def get_broadcast_recipients(self) -> List[int]:
+        """Get IDs of users who have not blocked the bot, in ascending order"""
+        return sorted(user_id for user_id, user in self._users.items() if not user.blocked)
     
     def get_stats(self) -> Dict[str, Any]:
-        """Get general statistics"""
-        total_users = len(self.data["users"])
-        total_orders = len(self.data["orders"])
-        total_referrals = sum(len(refs) for refs in self.data["referrals"].values())
+        """Get general statistics from the running counters"""
+        today = datetime.now().date()
+        active_users_week = sum(
+            self._activity_days.get((today - timedelta(days=days_ago)).isoformat(), 0)
+            for days_ago in range(7)
+        )
         
         return {
-            "total_users": total_users,
-            "total_orders": total_orders,
-            "total_referrals": total_referrals,
-            "active_users_today": 0  # Can be enhanced later
-        }
\ No newline at end of file
+            "total_users": len(self._users),
+            "total_orders": len(self.data["orders"]) + len(self._order_segments) - self._sealed_copies,
+            "total_referrals": self._stats["total_referrals"],
+            "total_balance": self._stats["total_balance"],
+            "total_ads_watched": self._stats["total_ads_watched"],
+            "active_users_today": self._activity_days.get(today.isoformat(), 0),
+            "active_users_week": active_users_week
+        }
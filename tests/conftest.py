@@ -0,0 +1,24 @@
+import pytest
+
+from fake_order_api import start_fake_order_api
+from sqlite_storage import SQLiteUserDataStorage
+from storage import UserDataStorage
+
+@pytest.fixture(params=["json", "binary", "sqlite"])
+def storage(request, tmp_path):
+    """A fresh storage of every backend, the JSON one with a journal"""
+    if request.param == "sqlite":
+        store = SQLiteUserDataStorage(str(tmp_path / "user_data.db"), activity_flush_interval=0)
+    elif request.param == "binary":
+        store = UserDataStorage(str(tmp_path / "user_data.snap"), binary=True, activity_flush_interval=0)
+    else:
+        store = UserDataStorage(str(tmp_path / "user_data.json"), journal=True, activity_flush_interval=0)
+    yield store
+    store.close()
+
+@pytest.fixture
+def fake_api():
+    server, _ = start_fake_order_api()
+    yield server
+    server.shutdown()
+    server.server_close()
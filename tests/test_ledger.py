@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+import storage as storage_module
+from storage import UserDataStorage
+
+def test_credit_with_a_used_key_is_ignored(storage):
+    storage.create_user(1)
+    assert storage.add_balance(1, 10, key="ad:1")
+    assert not storage.add_balance(1, 10, key="ad:1")
+    
+    assert storage.get_user(1)["balance"] == 10
+    assert [entry["amount"] for entry in storage.get_ledger(1)] == [10]
+
+def test_debit_needs_the_balance(storage):
+    storage.create_user(1)
+    storage.add_balance(1, 5, key="grant")
+    
+    assert not storage.subtract_balance(1, 6, key="spend:1")
+    assert storage.get_user(1)["balance"] == 5
+    assert len(storage.get_ledger(1)) == 1
+    
+    assert storage.subtract_balance(1, 5, key="spend:1")
+    assert storage.get_user(1)["balance"] == 0
+
+def test_debit_with_a_used_key_is_ignored(storage):
+    storage.create_user(1)
+    storage.add_balance(1, 10, key="grant")
+    
+    assert storage.subtract_balance(1, 4, key="spend:1")
+    assert not storage.subtract_balance(1, 4, key="spend:1")
+    assert storage.get_user(1)["balance"] == 6
+    assert [entry["amount"] for entry in storage.get_ledger(1)] == [-4, 10]
+
+def test_reserving_again_with_the_key_returns_the_first_order(storage):
+    storage.create_user(1)
+    storage.add_balance(1, 10, key="grant")
+    
+    order_id = storage.reserve_order(1, "https://example.com/v", 4, key="order:tap")
+    assert order_id is not None
+    assert storage.reserve_order(1, "https://example.com/v", 4, key="order:tap") == order_id
+    assert storage.get_user(1)["balance"] == 6
+    assert storage.reserve_order(1, "https://example.com/v", 7) is None
+    assert storage.get_user(1)["balance"] == 6
+
+def test_balances_match_the_ledger(storage):
+    for user_id in (1, 2):
+        storage.create_user(user_id)
+        storage.add_balance(user_id, 10, key=f"grant:{user_id}")
+    storage.subtract_balance(1, 3, key="spend")
+    storage.reserve_order(2, "https://example.com/v", 5)
+    
+    assert storage.reconcile_balances() == {}
+
+def test_keys_of_sealed_months_stay_used(tmp_path, monkeypatch):
+    class NextMonth(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) + timedelta(days=40)
+    
+    for binary in (False, True):
+        filename = str(tmp_path / ("user_data.snap" if binary else "user_data.json"))
+        store = UserDataStorage(filename, binary=binary, activity_flush_interval=0)
+        store.create_user(1)
+        store.add_balance(1, 10, key="grant")
+        store.subtract_balance(1, 3, key="spend")
+        store.compact()
+        
+        monkeypatch.setattr(storage_module, "datetime", NextMonth)
+        store.add_balance(1, 1, key="later")
+        store.compact()
+        assert store.seal_ledger() == 0
+        assert len(store._ledger_segments) == 2
+        store.close()
+        
+        store = UserDataStorage(filename, binary=binary, activity_flush_interval=0)
+        assert not store.add_balance(1, 10, key="grant")
+        assert not store.subtract_balance(1, 3, key="spend")
+        assert [entry["amount"] for entry in store.get_ledger(1)] == [1, -3, 10]
+        assert store.get_user(1)["balance"] == 8
+        assert store.reconcile_balances() == {}
+        store.close()
+        monkeypatch.undo()
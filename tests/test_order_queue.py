@@ -0,0 +1,155 @@
+import asyncio
+import random
+
+from order_client import OrderAPIClient
+from order_queue import OrderDispatcher, OrderReconciler
+
+VIDEO = "https://example.com/v"
+
+async def _client(fake_api) -> OrderAPIClient:
+    client = OrderAPIClient(fake_api.url, status_url=fake_api.status_url, timeout=5.0)
+    await client.start()
+    return client
+
+async def _dispatch(storage, client, **options) -> dict:
+    """Run a dispatcher until every queued order is done, return {order_id: status} it reported"""
+    results = {}
+    
+    async def on_result(order, status):
+        results[order["order_id"]] = status
+    
+    dispatcher = OrderDispatcher(storage, client, base_delay=0.01, max_delay=0.05, **options)
+    await dispatcher.start(on_result)
+    try:
+        for _ in range(500):
+            if not storage.get_queued_orders() and not dispatcher.pending_count():
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await dispatcher.stop()
+    return results
+
+def _reserve(storage, user_id: int, balance: int, *quantities: int) -> list:
+    storage.create_user(user_id)
+    storage.add_balance(user_id, balance, key=f"grant:{user_id}")
+    return [storage.reserve_order(user_id, VIDEO, quantity) for quantity in quantities]
+
+def test_dispatched_orders_are_submitted_once(storage, fake_api):
+    order_ids = _reserve(storage, 1, 100, 10, 20)
+    
+    async def run():
+        client = await _client(fake_api)
+        try:
+            return await _dispatch(storage, client)
+        finally:
+            await client.close()
+    
+    assert asyncio.run(run()) == {order_id: "submitted" for order_id in order_ids}
+    assert sorted(order["ref"] for order in fake_api.orders) == sorted(order_ids)
+    assert storage.get_user(1)["balance"] == 70
+
+def test_transient_failures_are_retried(storage, fake_api):
+    random.seed(1)
+    fake_api.failure_rate = 0.5
+    order_ids = _reserve(storage, 1, 100, *[5] * 5)
+    
+    async def run():
+        client = await _client(fake_api)
+        try:
+            return await _dispatch(storage, client, max_attempts=40)
+        finally:
+            await client.close()
+    
+    assert asyncio.run(run()) == {order_id: "submitted" for order_id in order_ids}
+    assert sorted(order["ref"] for order in fake_api.orders) == sorted(order_ids)
+
+def test_orders_failing_every_attempt_are_refunded(storage, fake_api):
+    fake_api.failure_rate = 1.0
+    [order_id] = _reserve(storage, 1, 100, 30)
+    
+    async def run():
+        client = await _client(fake_api)
+        try:
+            return await _dispatch(storage, client, max_attempts=3)
+        finally:
+            await client.close()
+    
+    assert asyncio.run(run()) == {order_id: "failed"}
+    assert storage.get_order(order_id)["status"] == "failed"
+    assert storage.get_user(1)["balance"] == 100
+    assert storage.reconcile_balances() == {}
+
+def test_a_failed_status_write_does_not_submit_again(storage, fake_api, monkeypatch):
+    order_ids = _reserve(storage, 1, 100, 10, 20)
+    update_order_statuses = storage.update_order_statuses
+    failures = []
+    
+    def flaky_update(statuses, remains=None):
+        if len(failures) < 2:
+            failures.append(statuses)
+            raise OSError("disk full")
+        update_order_statuses(statuses, remains)
+    
+    monkeypatch.setattr(storage, "update_order_statuses", flaky_update)
+    
+    async def run():
+        client = await _client(fake_api)
+        try:
+            return await _dispatch(storage, client, workers=1)
+        finally:
+            await client.close()
+    
+    assert asyncio.run(run()) == {order_id: "submitted" for order_id in order_ids}
+    assert len(failures) == 2
+    assert sorted(order["ref"] for order in fake_api.orders) == sorted(order_ids)
+    assert all(storage.get_order(order_id)["status"] == "submitted" for order_id in order_ids)
+    assert storage.get_queued_orders() == []
+
+def _dispatch_and_reconcile(storage, fake_api, runs: int, **options) -> list:
+    """Dispatch every queued order, then run one reconciler ``runs`` times, return each run's result"""
+    async def run():
+        client = await _client(fake_api)
+        try:
+            await _dispatch(storage, client)
+            reconciler = OrderReconciler(storage, client, **options)
+            return [(await reconciler.reconcile(), reconciler._after) for _ in range(runs)]
+        finally:
+            await client.close()
+    
+    return asyncio.run(run())
+
+def test_canceled_orders_are_refunded_once(storage, fake_api):
+    fake_api.cancel_rate = 1.0
+    order_ids = _reserve(storage, 1, 100, 10, 25)
+    
+    assert [changed for changed, _ in _dispatch_and_reconcile(storage, fake_api, 2)] == [2, 0]
+    assert all(storage.get_order(order_id)["status"] == "canceled" for order_id in order_ids)
+    assert storage.get_user(1)["balance"] == 100
+    assert storage.get_open_orders() == []
+    assert storage.reconcile_balances() == {}
+
+def test_partial_orders_refund_the_undelivered_share(storage, fake_api):
+    random.seed(2)
+    fake_api.partial_rate = 1.0
+    order_ids = _reserve(storage, 1, 100, 10, 30)
+    
+    assert [changed for changed, _ in _dispatch_and_reconcile(storage, fake_api, 2)] == [2, 0]
+    refunds = 0
+    for order_id in order_ids:
+        order = storage.get_order(order_id)
+        assert order["status"] == "partial"
+        remains = fake_api.outcomes[order_id][2]
+        refunds += order["total_cost"] * remains // order["quantity"]
+    assert storage.get_user(1)["balance"] == 60 + refunds
+    assert storage.reconcile_balances() == {}
+
+def test_reconciler_goes_round_the_open_orders(storage, fake_api):
+    fake_api.completion_time = 60
+    order_ids = _reserve(storage, 1, 100, 1, 2, 3)
+    
+    runs = _dispatch_and_reconcile(storage, fake_api, 3, max_orders=2, batch_size=1)
+    _, second, _ = [order["order_id"] for order in storage.get_open_orders()]
+    # Two orders, then the last one, then from the oldest again, where nothing changed any more
+    assert runs == [(2, second), (1, None), (0, second)]
+    assert all(storage.get_order(order_id)["status"] == "in_progress" for order_id in order_ids)
+    assert storage.get_user(1)["balance"] == 94
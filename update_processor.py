@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import sys
+from typing import Any, Awaitable, Dict
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, but one at a time per user.
+    
+    Updates from different users run in parallel (up to
+    ``max_concurrent_updates``), while updates from the same user wait on a
+    per-user lock and run in arrival order. This keeps balance checks and
+    conversation states consistent when a user double-taps a button.
+    
+    A concurrency slot is only taken once the user's lock is held, so
+    updates queued behind one user's slow handler hold no slot and cannot
+    starve other users. PTB's own semaphore, which process_update takes
+    before do_process_update, is therefore made unbounded, and the updates
+    waiting per user are capped instead: beyond ``max_waiting_per_user``
+    (a user hammering a button, or a flood from one account) further
+    updates of that user are dropped.
+    """
+    
+    def __init__(self, max_concurrent_updates: int, max_waiting_per_user: int = 10):
+        super().__init__(sys.maxsize)
+        self.limit = max_concurrent_updates
+        self.max_waiting_per_user = max_waiting_per_user
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiters: Dict[int, int] = {}
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        
+        user_id = user.id
+        if self._waiters.get(user_id, 0) >= self.max_waiting_per_user:
+            # Never awaited, closed so it is not reported as such
+            coroutine.close()
+            metrics.UPDATES_DROPPED.inc()
+            logging.warning(f"Dropped an update of user {user_id}, {self.max_waiting_per_user} already waiting")
+            return
+        
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._waiters[user_id] = self._waiters.get(user_id, 0) + 1
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            # Drop the lock once nobody is queued behind it
+            self._waiters[user_id] -= 1
+            if not self._waiters[user_id]:
+                del self._waiters[user_id]
+                del self._locks[user_id]
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
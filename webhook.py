@@ -0,0 +1,100 @@
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, Optional
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+import exports
+import metrics
+
+WEBHOOK_PATH = "/telegram"
+
+def create_asgi_app(application: Application, webhook_url: str, secret_token: Optional[str] = None,
+                    storage: Any = None, export_token: Optional[str] = None) -> Starlette:
+    """Serve Telegram webhook updates, /, /health, /metrics and /export from one ASGI app.
+    
+    The app owns the lifecycle of ``application``: its lifespan initializes
+    and starts it, runs the application's post_init and post_shutdown hooks
+    (which PTB only calls itself from run_polling/run_webhook) and registers
+    the webhook with Telegram. Exports of ``storage`` are served to requests
+    carrying ``Authorization: Bearer <export_token>`` when a token is set.
+    """
+    
+    @asynccontextmanager
+    async def lifespan(_: Starlette):
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            
+            await application.bot.set_webhook(
+                url=webhook_url.rstrip("/") + WEBHOOK_PATH,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+            await application.start()
+            logging.info("🚀 Bot started with webhook...")
+            
+            yield
+            
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+    
+    async def telegram(request: Request) -> Response:
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return Response(status_code=403)
+        
+        try:
+            data = await request.json()
+        except ValueError:
+            return Response(status_code=400)
+        if not isinstance(data, dict):
+            return Response(status_code=400)
+        
+        update = Update.de_json(data, application.bot)
+        await application.update_queue.put(update)
+        return Response()
+    
+    async def home(request: Request) -> JSONResponse:
+        return JSONResponse({
+            "status": "Bot is running",
+            "mode": "webhook",
+            "timestamp": datetime.now().isoformat()
+        })
+    
+    async def health(request: Request) -> JSONResponse:
+        return JSONResponse({"status": "healthy"})
+    
+    async def metrics_endpoint(request: Request) -> Response:
+        return Response(metrics.REGISTRY.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+    
+    async def export_endpoint(request: Request) -> Response:
+        name, fmt = request.path_params["name"], request.path_params["fmt"]
+        if not export_token or storage is None or name not in exports.EXPORTS or fmt not in exports.FORMATS:
+            return Response(status_code=404)
+        if request.headers.get("Authorization") != f"Bearer {export_token}":
+            return Response(status_code=403)
+        
+        # Starlette iterates a sync generator in its thread pool, off the event loop
+        return StreamingResponse(
+            exports.iter_export(storage, name, fmt),
+            media_type=exports.FORMATS[fmt],
+            headers={"Content-Disposition": f"attachment; filename={exports.export_filename(name, fmt)}"}
+        )
+    
+    return Starlette(
+        routes=[
+            Route(WEBHOOK_PATH, telegram, methods=["POST"]),
+            Route("/", home),
+            Route("/health", health),
+            Route("/metrics", metrics_endpoint),
+            Route("/export/{name}.{fmt}", export_endpoint),
+        ],
+        lifespan=lifespan
+    )
@@ -1,4 +1,8 @@
 from bot import app  # Import the Flask app from bot.py
+from bot import create_webhook_app
+
+# Production entry point for webhook mode, the app is only built by uvicorn:
+#   uvicorn --factory wsgi:create_webhook_app
 
 if __name__ == "__main__":
     app.run()